@@ -15,11 +15,7 @@ from presubmit_rules import java_style
 import re
 
 def _GetFileType(input_api, filetype):
-  result = []
-  for f in input_api.GetAffectedFiles():
-    if f.LocalPath().endswith('.' + filetype):
-      result.append(f)
-  return result
+  return input_api.AffectedFiles(include=[r'.+\.%s$' % re.escape(filetype)])
 
 
 def CheckChangeOnUpload(input_api, output_api):
@@ -13,6 +13,8 @@ import sys, os, traceback, optparse
 import time
 import re
 
+import presubmit_support
+
 def main():
   global options, args
   # TODO(Sean Kirmani): Do something more interesting here...
@@ -22,17 +24,19 @@ class Changelist(object):
   def __init__(self, branchref=None, issue=None, auth_config=None):
     pass
 
-  def RunHook(self, may_prompt, verbose, change):
-    """Calls sys.exit() if the hook fails; returns a HooksResults otherwise."""
+  def RunHook(self, may_prompt, verbose, change=None):
+    """Calls sys.exit() if the hook fails; returns a HooksResults otherwise.
+
+    Without a change, the files changed against the upstream branch are
+    checked, and line-based checks only look at the lines that changed.
+    """
 
     try:
-      # TODO: create change
-      # TODO: create verbose
-      # TODO: create may_prompt
-      return presubmit_support.DoPresubmitChecks(change, verbose=verbose,
+      return presubmit_support.DoPresubmitChecks(verbose=verbose,
           output_stream=sys.stdout, input_stream=sys.stdin,
-          default_presubmit=None, may_prompt=may_prompt)
-    # TODO: write presubmit_support.PresubmitFailure
+          default_presubmit=None, may_prompt=may_prompt,
+          diff_base=presubmit_support.DIFF_BASE_UPSTREAM, change=change,
+          changed_lines=True)
     except presubmit_support.PresubmitFailure, e:
       DieWithError(e)
 
@@ -1,14 +1,21 @@
-#!public  /usr/bin/env python
+#! /usr/bin/env python
 # -*- coding: utf-8 -*-
 # vim:fenc=utf-8
 #
 # Copyright © 2015 Sean Kirmani <sean@kirmani.io>
 #
 # Distributed under terms of the MIT license.
-"""TODO(Sean Kirmani): DO NOT SUBMIT without one-line documentation for test
+"""Parses Java source into a tree of packages, imports, classes, methods and
+variables.
 
-TODO(Sean Kirmani): DO NOT SUBMIT without a detailed description of test.
+The source is split into a stream of tokens in a single pass, and the tree is
+built from that stream in a second pass, so parsing takes time linear in the
+size of the file. Only the header, the package and import statements, can be
+parsed instead, which costs next to nothing on long files.
 """
+import collections
+import itertools
+import re
 
 SEMICOLON = ';'
 OPEN_BRACE = '{'
@@ -17,9 +24,13 @@ BRACES_SET = OPEN_BRACE + CLOSE_BRACE
 OPEN_PAREN = '('
 CLOSE_PAREN = ')'
 COMMA = ','
-COMMENT_BLOCK_BEGIN = '/**'
+COMMENT_BLOCK_BEGIN = '/*'
 COMMENT_BLOCK_END = '*/'
 CONDITIONALS = ['if', 'else', 'for', 'do', 'while']
+# Other keywords that open a block of statements.
+CONTROL_BLOCKS = CONDITIONALS + ['try', 'catch', 'finally', 'switch',
+    'synchronized']
+TYPE_DECLARATIONS = ['class', 'interface', 'enum']
 
 PACKAGE_START_STRING = 'package '
 IMPORT_START_STRING = 'import '
@@ -33,50 +44,115 @@ METHOD = 'method'
 VARIABLE = 'variable'
 PARAMETERS = 'parameters'
 CONDITIONAL = 'conditional'
+BLOCK = 'block'
+
+# Token kinds
+WORD = 'word'
+NUMBER = 'number'
+STRING = 'string'
+CHAR = 'char'
+OPERATOR = 'op'
+
+# A token of Java source. line and column are 1-based.
+Token = collections.namedtuple('Token', 'kind text line column')
+
+# Matches the whitespace and comments before the next token of a line, then
+# the token itself. A block comment left open continues on the following
+# lines, and the end group matches once only whitespace and comments are left.
+_TOKEN_RE = re.compile(r'''
+  (?:\s+|//.*|/\*.*?\*/)*
+  (?:
+    (?P<end>$)
+  | (?P<comment>/\*)
+  | (?P<word>[A-Za-z_$\x80-\xff][\w$\x80-\xff]*)
+  | (?P<number>\.?\d(?:[eEpP][-+]|[\w.])*)
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<char>'(?:[^'\\]|\\.)*')
+  | (?P<op>>>>=|<<=|>>=|->|::|\.\.\.|\+\+|--|&&|\|\||[-+*/%&|^!=<>]=|.)
+  )
+  ''', re.VERBOSE)
+
+def Tokenize(text):
+  """Splits Java source into tokens, dropping whitespace and comments.
+
+  Lines are split on \n only, like the lines of AffectedFile.ReadFileLines,
+  so that line numbers of tokens index those. A lone \r is whitespace.
+
+  Args:
+    text: The Java source.
+
+  Return:
+    List of Token objects, in source order.
+  """
+  return list(IterTokens(text))
+
+def IterTokens(text):
+  """Like Tokenize, but splits the lines into tokens as they are read, so
+  that a reader that stops early does not pay for the rest of the file.
+  """
+  return itertools.chain.from_iterable(_LineTokens(text))
+
+def _LineTokens(text):
+  """Yields the list of tokens of each line of text."""
+  in_comment = False
+  line_num = 0
+  for line in text.split('\n'):
+    line_num += 1
+    pos = 0
+    if in_comment:
+      end = line.find(COMMENT_BLOCK_END)
+      if end < 0:
+        continue
+      pos = end + len(COMMENT_BLOCK_END)
+      in_comment = False
+    tokens = []
+    for match in _TOKEN_RE.finditer(line, pos):
+      kind = match.lastgroup
+      if kind == 'end':
+        break
+      if kind == 'comment':
+        in_comment = True
+        break
+      tokens.append(Token(kind, match.group(kind), line_num,
+          match.start(kind) + 1))
+    yield tokens
 
 class JavaLexer(object):
-  def __init__(self, f):
-    self._file = f
-    self._file_lines = [l for l in f.readlines()]
+  def __init__(self, f, header_only=False):
+    """
+    Args:
+      f: A file object or a string holding the Java source.
+      header_only: Only parse the package and import statements, which come
+        before the first block of the file.
+    """
+    text = f if isinstance(f, basestring) else f.read()
     self.thing = ROOT
-    self.children = _CreateTree(self._RemoveComments(self._RawText()))
-
-  def _RawText(self):
-    return ''.join([l.strip() for l in self._file_lines])
-
-  def _RemoveComments(self, text):
-    result = ''
-    in_comment = False
-    for index in range(len(text)):
-      if text[index : index + len(COMMENT_BLOCK_BEGIN)] == COMMENT_BLOCK_BEGIN:
-        in_comment = True
-      if not in_comment:
-        result += text[index]
-      if text[index + 1 - len(COMMENT_BLOCK_END) : index + 1] == \
-          COMMENT_BLOCK_END:
-        in_comment = False
-    return result
+    self.header_only = header_only
+    # Only the tree is kept; the source and its tokens are dropped.
+    self.children = _CreateTree(IterTokens(text), header_only)
 
   def Printable(self):
     return self.thing
 
 class JavaPackage(object):
-  def __init__(self, block):
-    self.package = block[len(PACKAGE_START_STRING):][:-len(SEMICOLON)]
+  def __init__(self, tokens):
+    self.package = ''.join(t.text for t in tokens[1:])
     self.thing = PACKAGE
+    self.line = tokens[0].line
 
   def Printable(self):
     return '%s: %s' % (self.thing, self.package)
 
 class JavaImport(object):
-  def __init__(self, block):
+  def __init__(self, tokens):
     self.thing = IMPORT
-    imported = block[len(IMPORT_START_STRING):][:-len(SEMICOLON)]
+    self.line = tokens[0].line
+    tokens = tokens[1:]
     self.is_static = False
-    if 'static' in imported:
+    if tokens and tokens[0].text == 'static':
       self.is_static = True
-      imported = imported[imported.find('static') + len('static'):]
-    import_path = imported.split('.')
+      tokens = tokens[1:]
+    import_path = ''.join(t.text for t in tokens).split('.')
     self.package = import_path[:len(import_path) - 1]
     self.name = import_path[len(import_path) - 1]
     self.has_children = False
@@ -87,50 +163,44 @@ class JavaImport(object):
     return '%s: %s %s' % (self.thing, self.package, self.name)
 
 class JavaClass(object):
-  def __init__(self, block, leftover):
-    self.qualifiers = self._GetQualifiers(block[:-len(BRACES_SET)])
-    self.name = self._GetName(block[:-len(BRACES_SET)])
-    self.children = _CreateTree(leftover)
+  def __init__(self, tokens):
+    words = _Words(tokens)
+    self.qualifiers = []
+    self.name = None
+    for index, word in enumerate(words):
+      if word in TYPE_DECLARATIONS:
+        self.qualifiers = words[:index]
+        if index + 1 < len(words):
+          self.name = words[index + 1]
+        break
+    self.children = []
     self.thing = CLASS
-
-  def _GetQualifiers(self, block):
-    result = []
-    words = block.split()
-    for word in words:
-      if word == 'class':
-        return result
-      result.append(word)
-
-  def _GetName(self, block):
-    words = block.split()
-    is_next = False
-    for word in words:
-      if is_next:
-        return word
-      if word == 'class':
-        is_next = True
+    self.line = tokens[0].line
 
   def Printable(self):
     return '%s: %s %s' % (self.thing, self.qualifiers, self.name)
 
 class JavaMethod(object):
-  def __init__(self, block, leftover):
-    leftside = block[:block.find(OPEN_PAREN)].rstrip()
-    words = leftside.split()
-    rightside = block[block.find(OPEN_PAREN) + len(OPEN_PAREN) :
-        block.find(CLOSE_PAREN)]
+  def __init__(self, tokens, paren_index):
+    """
+    Args:
+      tokens: The tokens of the method declaration, up to its body.
+      paren_index: Index in tokens of the parenthesis opening the parameters.
+    """
+    words = _Words(tokens[:paren_index])
     self.qualifiers = words[:len(words) - 1]
     self.name = words[len(words) - 1]
-    parameters = JavaParameters(rightside)
+    close_index = _FindClosingParen(tokens, paren_index)
+    parameters = JavaParameters(tokens[paren_index + 1:close_index])
     self.children = [parameters] if len(parameters.children) > 0 else []
-    self.children += _CreateTree(leftover)
     self.thing = METHOD
+    self.line = tokens[0].line
 
   def Printable(self):
     return '%s: %s %s' % (self.thing, self.qualifiers, self.name)
 
 class JavaVariable(object):
-  def __init__(self, words):
+  def __init__(self, words, line=None):
     self.thing = VARIABLE
     if len(words) > 2:
       self.qualifiers = words[:len(words) - 2]
@@ -138,132 +208,252 @@ class JavaVariable(object):
       self.qualifiers = []
     self.object_type = words[len(words) - 2]
     self.name = words[len(words) - 1]
+    self.line = line
 
   def Printable(self):
     return '%s: %s %s %s' % (self.thing, self.qualifiers, self.object_type,
         self.name)
 
-# TODO: Finish Implementation of this
 class JavaConditional(object):
-  def __init__(self, block):
+  def __init__(self, tokens):
     self.thing = CONDITIONAL
-    for cond in CONDITIONALS:
-      if cond in block:
-        self.conditional = cond
-    leftover = block[block.find(OPEN_PAREN) + 1: block.find(CLOSE_PAREN)]
-    self.children = _CreateTree(leftover)
+    self.conditional = tokens[0].text
+    self.children = []
+    self.line = tokens[0].line
 
   def Printable(self):
     return '%s: %s' % (self.thing, self.conditional)
 
+class JavaBlock(object):
+  """A block that is not a class, method or conditional, e.g. an initializer.
+  """
+  def __init__(self, tokens):
+    self.thing = BLOCK
+    self.children = []
+    self.line = tokens[0].line if tokens else None
+
+  def Printable(self):
+    return self.thing
+
 class JavaParameters(object):
-  def __init__(self, block):
+  def __init__(self, tokens):
     self.thing = PARAMETERS
-    params = [param.split() for param in block.split(COMMA)]
-    self.children = [JavaVariable(param) for param in params
+    params = [_Words(param) for param in _SplitTopLevel(tokens, COMMA)]
+    self.children = [JavaVariable(param, tokens[0].line) for param in params
         if len(param) >= 2]
 
   def Printable(self):
     return self.thing
 
-def _GetTree(text):
-  result = ''
-  removed = ''
-  stack = []
-  for index in range(len(text)):
-    if index - 1 > 0 and text[index - 1] == OPEN_BRACE:
-      stack.append(OPEN_BRACE)
-    if len(stack) == 0:
-      result += text[index]
+def _Words(tokens):
+  """Joins tokens that touch in the source, giving the whitespace separated
+  words of the declaration they came from. Type arguments are kept in one
+  word, e.g. Map<String, Integer>.
+  """
+  words = []
+  previous = None
+  angles = 0
+  for token in tokens:
+    if (previous and previous.line == token.line and
+        previous.column + len(previous.text) == token.column):
+      words[-1] += token.text
+    elif angles > 0:
+      words[-1] += ' ' + token.text
     else:
-      removed += text[index]
-    if index + 1 < len(text) and text[index + 1] == CLOSE_BRACE:
-      if len(stack) > 0:
-        stack.pop()
-  return result, removed
-
-def _GetBlocks(text):
-  text, leftover = _GetTree(text)
+      words.append(token.text)
+    if token.text == '<':
+      angles += 1
+    elif token.text == '>' and angles > 0:
+      angles -= 1
+    previous = token
+  return words
+
+def _SplitTopLevel(tokens, separator):
+  """Splits tokens on separator, ignoring those nested in brackets."""
+  result = [[]]
+  depth = 0
+  for token in tokens:
+    if token.text in ('(', '[', '<', '{'):
+      depth += 1
+    elif token.text in (')', ']', '>', '}'):
+      depth -= 1
+    elif token.text == separator and depth <= 0:
+      result.append([])
+      continue
+    result[-1].append(token)
+  return [r for r in result if r]
+
+def _FindClosingParen(tokens, index):
+  depth = 0
+  for i in xrange(index, len(tokens)):
+    if tokens[i].text == OPEN_PAREN:
+      depth += 1
+    elif tokens[i].text == CLOSE_PAREN:
+      depth -= 1
+      if depth == 0:
+        return i
+  return len(tokens)
+
+def _StripAnnotations(tokens):
+  """Removes annotations such as @Override or @SuppressWarnings("x")."""
+  if not any(t.text == '@' for t in tokens):
+    return tokens
   result = []
-  current_block = ''
-  for index in range(len(text)):
-    current_block += text[index]
-    if text[index] == ';' or text[index + 1 - len(BRACES_SET) : index + 1] == \
-        BRACES_SET:
-      result.append(current_block)
-      current_block = ''
-  return result, leftover
-
-def _CreateTree(text):
-    blocks, leftover = _GetBlocks(text)
-    root = []
-    for block in blocks:
-      if 'class' in block and block.endswith(BRACES_SET):
-        root.append(JavaClass(block, leftover))
-      elif block.endswith(BRACES_SET):
-        root.append(JavaMethod(block, leftover))
-      if block.startswith(PACKAGE_START_STRING) and block.endswith(SEMICOLON):
-        root.append(JavaPackage(block))
-      if block.startswith(IMPORT_START_STRING) and block.endswith(SEMICOLON):
-        root.append(JavaImport(block))
-      if '=' in block and block.endswith(SEMICOLON):
-        leftside = block[:block.find('=')].rstrip()
-        words = leftside.split()
-        if len(words) > 1:
-          root.append(JavaVariable(words))
-    return root
+  index = 0
+  while index < len(tokens):
+    if tokens[index].text == '@' and index + 1 < len(tokens) and \
+        tokens[index + 1].text != 'interface':
+      index += 2
+      # Qualified annotation names, e.g. @java.lang.Override.
+      while index + 1 < len(tokens) and tokens[index].text == '.':
+        index += 2
+      if index < len(tokens) and tokens[index].text == OPEN_PAREN:
+        index = _FindClosingParen(tokens, index) + 1
+      continue
+    result.append(tokens[index])
+    index += 1
+  return result
+
+def _MethodParenIndex(tokens):
+  """Returns the index of the parenthesis opening the parameters of a method
+  declaration, or None if tokens do not declare a method.
+  """
+  for index, token in enumerate(tokens):
+    if token.text == OPEN_PAREN:
+      if index > 0 and tokens[index - 1].kind == WORD:
+        return index
+      return None
+  return None
+
+def _IsExpression(tokens):
+  """Whether a brace following tokens belongs to an expression, such as an
+  array initializer, an anonymous class or a lambda, rather than opening a
+  declaration or statement block.
+  """
+  if tokens and tokens[0].text in CONTROL_BLOCKS:
+    return False
+  parens = 0
+  for token in tokens:
+    if token.text == OPEN_PAREN:
+      parens += 1
+    elif token.text == CLOSE_PAREN:
+      parens -= 1
+    elif parens == 0 and token.text in ('=', '->', 'new', 'return'):
+      return True
+  return False
+
+def _CreateBlockNode(tokens):
+  """Returns the node for the declaration or statement opening a block."""
+  if not tokens:
+    return JavaBlock(tokens)
+  if tokens[0].text in CONTROL_BLOCKS:
+    return JavaConditional(tokens)
+  for token in tokens:
+    if token.text in TYPE_DECLARATIONS:
+      return JavaClass(tokens)
+  paren_index = _MethodParenIndex(tokens)
+  if paren_index is not None:
+    return JavaMethod(tokens, paren_index)
+  return JavaBlock(tokens)
+
+def _AddStatement(parent, children, tokens):
+  """Adds the node for a statement ending in a semicolon, if it has one."""
+  tokens = _StripAnnotations(tokens)
+  if not tokens:
+    return
+  first = tokens[0].text
+  if first == 'package':
+    children.append(JavaPackage(tokens))
+    return
+  if first == 'import':
+    children.append(JavaImport(tokens))
+    return
+  for index, token in enumerate(tokens):
+    if token.text == '=':
+      words = _Words(tokens[:index])
+      if len(words) > 1:
+        children.append(JavaVariable(words, tokens[0].line))
+      return
+  if isinstance(parent, JavaClass):
+    paren_index = _MethodParenIndex(tokens)
+    if paren_index is not None:
+      # A method without a body, e.g. abstract or in an interface.
+      children.append(JavaMethod(tokens, paren_index))
+      return
+    words = _Words(tokens)
+    if len(words) > 1 and len(_SplitTopLevel(tokens, COMMA)) == 1:
+      # A field without an initializer. Type arguments may hold commas.
+      children.append(JavaVariable(words, tokens[0].line))
+
+def _CreateTree(tokens, header_only=False):
+  """Builds the tree of a file from its tokens in a single pass.
+
+  Args:
+    tokens: Iterable of the tokens of the file.
+    header_only: Stop at the first block, leaving out everything from the
+      first type declaration on.
+
+  Return:
+    The list of top-level nodes.
+  """
+  root = []
+  # (node, children) of every block enclosing the current token.
+  stack = [(None, root)]
+  statement = []
+  parens = 0
+  # Depth of the braces of an expression within the current statement.
+  expression_braces = 0
+  for token in tokens:
+    text = token.text
+    if expression_braces:
+      statement.append(token)
+      if text == OPEN_BRACE:
+        expression_braces += 1
+      elif text == CLOSE_BRACE:
+        expression_braces -= 1
+      continue
+    if token.kind != OPERATOR:
+      statement.append(token)
+      continue
+    if text == OPEN_PAREN:
+      parens += 1
+    elif text == CLOSE_PAREN:
+      if parens:
+        parens -= 1
+    elif parens:
+      # Semicolons and braces inside parentheses, e.g. in a for loop header
+      # or a lambda argument, belong to the enclosing statement.
+      pass
+    elif text == SEMICOLON:
+      _AddStatement(stack[-1][0], stack[-1][1], statement)
+      statement = []
+      continue
+    elif text == OPEN_BRACE:
+      if header_only:
+        return root
+      header = _StripAnnotations(statement)
+      if _IsExpression(header):
+        statement.append(token)
+        expression_braces = 1
+        continue
+      node = _CreateBlockNode(header)
+      stack[-1][1].append(node)
+      stack.append((node, node.children))
+      statement = []
+      continue
+    elif text == CLOSE_BRACE:
+      # E.g. the constants of an enum have no closing semicolon.
+      _AddStatement(stack[-1][0], stack[-1][1], statement)
+      statement = []
+      if len(stack) > 1:
+        stack.pop()
+      continue
+    statement.append(token)
+  _AddStatement(stack[-1][0], stack[-1][1], statement)
+  return root
 
 def _PrintTree(root, spaces=''):
   print(spaces + root.Printable())
   if hasattr(root, 'children'):
     for child in root.children:
       _PrintTree(child, spaces + '  ')
-
-"""All code below this line is an attempted revision to the generation of the
-Java object tree
-
-TODO (kirmani): COME BACK TO THIS"""
-# TODO: Potentially use this
-class JavaNode(object):
-  def __init__(self, text, children):
-    self.text = text
-    self.children = children
-
-def _GetTreeNew(text, spaces=''):
-  indenters = [(OPEN_PAREN, CLOSE_PAREN), (OPEN_BRACE, CLOSE_BRACE)]
-  result = text
-  remaining = []
-  last_end_brace = 0
-  for index in range(len(result)):
-    if index > last_end_brace:
-      for indenter in indenters:
-        if result[index] == indenter[0]:
-          end_brace = index + 1 + \
-              _GetEndBrace(result[index + 1:], indenter[0], indenter[1])
-          subtext = result[index + 1 : end_brace]
-          remaining.append(subtext)
-          last_end_brace = end_brace
-
-  for r in remaining:
-    result = result.replace(r, '')
-  root = JavaNode(result, [])
-  for r in remaining:
-    root.children.append(_GetTree(r))
-  return root
-
-def _GetEndBrace(text, start, end):
-  count = 0
-  for index in range(len(text)):
-    if text[index] == start:
-      count += 1
-    if text[index] == end:
-      if count > 0:
-        count -= 1
-      else:
-        return index
-  return None
-
-def _PrintTextTree(node, spaces=''):
-  print(spaces + node.text)
-  for child in node.children:
-    _PrintTextTree(child, spaces + '  ')
@@ -0,0 +1,373 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2015 Sean Kirmani <sean@kirmani.io>
+#
+# Distributed under terms of the MIT license.
+"""Measures how fast presubmit checks run on a synthetic Java repository.
+
+The repository is generated from a seed, so the same options always produce
+the same files and runs on different revisions can be compared. The results
+are written as JSON; pass an older results file to --compare to see the
+difference.
+"""
+import sys, os, traceback, optparse
+import contextlib
+import json
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+import presubmit_support
+from parsers import java_parser
+from presubmit_rules import java_style
+
+DEFAULT_OUTPUT = 'presubmit_benchmark.json'
+
+# The imports of every generated file, in the order that
+# _CheckImportOrderingAndSpacing wants. None is a blank line.
+_IMPORTS = (
+    'import static org.junit.Assert.assertEquals;',
+    None,
+    'import com.google.common.base.Preconditions;',
+    None,
+    'import org.junit.Test;',
+    None,
+    'import java.util.ArrayList;',
+    'import java.util.List;',
+    None,
+    'import javax.annotation.Nullable;',
+    )
+
+_TOP_LEVEL_PRESUBMIT = '''from presubmit_rules import java_style
+
+def CheckChangeOnUpload(input_api, output_api):
+  java_files = [f for f in input_api.GetAffectedFiles()
+      if f.LocalPath().endswith('.java')]
+  return java_style.DoJavaChecks(input_api, output_api, java_files)
+'''
+
+_NESTED_PRESUBMIT = '''def CheckChangeOnUpload(input_api, output_api):
+  return []
+'''
+
+def main():
+  global options, args
+  parameters = {
+      'files': options.files,
+      'file_size': options.file_size,
+      'depth': options.depth,
+      'presubmits': options.presubmits,
+      'violation_rate': options.violation_rate,
+      'seed': options.seed,
+      }
+  repo_dir = options.repo_dir or tempfile.mkdtemp(prefix='presubmit_bench')
+  try:
+    start_time = time.time()
+    repository = GenerateRepository(repo_dir, **parameters)
+    print('Generated %d files, %.1f MB, in %s in %.1fs.' % (
+        repository['files'], repository['bytes'] / float(1 << 20), repo_dir,
+        time.time() - start_time))
+    benchmarks = RunBenchmarks(repo_dir, repository, options.repeat,
+        options.jobs)
+  finally:
+    if not options.repo_dir:
+      shutil.rmtree(repo_dir, ignore_errors=True)
+  report = {
+      'revision': _Revision(),
+      'python': platform.python_version(),
+      'time': time.time(),
+      'parameters': parameters,
+      'repeat': options.repeat,
+      'jobs': options.jobs,
+      'repository': repository,
+      'benchmarks': benchmarks,
+      }
+  WriteReport(report, sys.stdout)
+  with open(options.output, 'w') as f:
+    json.dump(report, f, indent=2, sort_keys=True)
+  print('Results written to %s.' % options.output)
+  if options.compare:
+    with open(options.compare) as f:
+      WriteComparison(json.load(f), report, sys.stdout)
+
+def GenerateRepository(root, files=500, file_size=8192, depth=3,
+    presubmits=4, violation_rate=0.02, seed=0):
+  """Writes a repository of Java files with presubmit checks under root.
+
+  Args:
+    root: The directory to write to. It is created if needed.
+    files: Number of Java files.
+    file_size: Approximate size of each Java file, in bytes.
+    depth: Number of directory levels the files are spread over.
+    presubmits: Number of PRESUBMIT.py files in subdirectories, besides the
+      one at the root that runs the Java checks.
+    violation_rate: Chance of each kind of violation (long line, tab, octal
+      escape) in each method, and of out of order imports in each file.
+    seed: Seed of the generator. The same arguments give the same files.
+
+  Return:
+    A dict with the number of files, Java files and bytes written, and the
+    number of PRESUBMIT.py files.
+  """
+  rng = random.Random(seed)
+  fanout = max(2, int(round(files ** (1.0 / (depth + 1)))))
+  directories = set()
+  total_bytes = 0
+  for index in xrange(files):
+    dirs = ['d%d' % rng.randrange(fanout) for _ in xrange(depth)]
+    directories.add(os.path.join(*dirs) if dirs else '')
+    class_name = 'Generated%d' % index
+    source = _JavaSource(rng, class_name, '.'.join(['bench'] + dirs),
+        file_size, violation_rate)
+    _WriteFile(os.path.join(root, *(dirs + [class_name + '.java'])), source)
+    total_bytes += len(source)
+  _WriteFile(os.path.join(root, presubmit_support.PRESUBMIT_PREF_FILE),
+      '<?xml version="1.0" encoding="utf-8"?>\n'
+      '<presubmit name="benchmark" basedir="."></presubmit>\n')
+  _WriteFile(os.path.join(root, 'PRESUBMIT.py'), _TOP_LEVEL_PRESUBMIT)
+  nested = rng.sample(sorted(d for d in directories if d),
+      min(presubmits, len(directories) - ('' in directories)))
+  for directory in nested:
+    _WriteFile(os.path.join(root, directory, 'PRESUBMIT.py'),
+        _NESTED_PRESUBMIT)
+  return {
+      'files': files + len(nested) + 2,
+      'java_files': files,
+      'bytes': total_bytes,
+      'presubmits': len(nested) + 1,
+      }
+
+def _JavaSource(rng, class_name, package, size, violation_rate):
+  """Returns the text of a Java file of about size bytes."""
+  lines = ['package %s;' % package, '']
+  imports = list(_IMPORTS)
+  if rng.random() < violation_rate:
+    imports[6], imports[7] = imports[7], imports[6]
+  lines += [line or '' for line in imports]
+  lines += ['', 'public class %s {' % class_name]
+  length = sum(len(line) + 1 for line in lines)
+  method = 0
+  while length < size:
+    value = rng.randrange(1000)
+    body = [
+        '  public int method%d(int value) {' % method,
+        '    int result = value * %d;' % value,
+        '    String text = "value %d";' % value,
+        '    if (result > %d) {' % (value * 7),
+        '      result -= text.length();',
+        '    }',
+        '    return result;',
+        '  }',
+        '',
+        ]
+    if rng.random() < violation_rate:
+      body.insert(1, '    // %s' % ('x' * 110))
+    if rng.random() < violation_rate:
+      body[2] = '\t' + body[2].lstrip()
+    if rng.random() < violation_rate:
+      body[3] = '    String text = "value\\012%d";' % value
+    lines += body
+    length += sum(len(line) + 1 for line in body)
+    method += 1
+  lines.append('}')
+  return '\n'.join(lines) + '\n'
+
+def _WriteFile(path, text):
+  directory = os.path.dirname(path)
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  with open(path, 'wb') as f:
+    f.write(text)
+
+def RunBenchmarks(root, repository, repeat=3, jobs=None):
+  """Times each part of a presubmit run on the repository under root.
+
+  Args:
+    root: A repository written by GenerateRepository.
+    repository: The dict returned by GenerateRepository.
+    repeat: Number of times to run each benchmark. The fastest run counts.
+    jobs: Number of worker processes of full runs, see DoPresubmitChecks.
+
+  Return:
+    A list of dicts with the name, seconds, files per second and MB per
+    second of each benchmark.
+  """
+  main_path = os.getcwd()
+  os.chdir(root)
+  try:
+    return _RunBenchmarks(root, repository, repeat, jobs)
+  finally:
+    os.chdir(main_path)
+
+def _RunBenchmarks(root, repository, repeat, jobs):
+  benchmarks = []
+  def Add(name, seconds, files, size):
+    benchmarks.append({
+        'name': name,
+        'seconds': seconds,
+        'files_per_second': files / seconds if seconds else None,
+        'mb_per_second': size / float(1 << 20) / seconds if seconds else None,
+        })
+
+  java_files = repository['java_files']
+  java_bytes = repository['bytes']
+  config = presubmit_support.LoadConfig()
+
+  def Discover():
+    change = presubmit_support.BuildChange(None, config)
+    presubmit_support.ListRelevantPresubmitFiles(
+        [path for _, path in change.AffectedPaths()], root)
+    return change
+  with _Quiet():
+    seconds, change = _Time(Discover, repeat)
+  Add('discovery', seconds, repository['files'], 0)
+
+  files = [f for f in change.AffectedFiles()
+      if f.LocalPath().endswith('.java')]
+  sources = [f.ReadFile() for f in files]
+  seconds, _ = _Time(lambda: [java_parser.JavaLexer(s) for s in sources],
+      repeat)
+  Add('parse', seconds, java_files, java_bytes)
+  seconds, _ = _Time(
+      lambda: [java_parser.JavaLexer(s, header_only=True) for s in sources],
+      repeat)
+  Add('parse header', seconds, java_files, java_bytes)
+
+  input_api = presubmit_support.InputApi(os.path.join(root, 'PRESUBMIT.py'),
+      False, change)
+  output_api = presubmit_support.OutputApi()
+  for f in files:
+    f.ReadFileStrippedLines()
+    f.JavaTree()
+  with _Quiet():
+    for check in java_style.JAVA_CHECKS:
+      # The first run builds any tables the check shares between files.
+      check(input_api, output_api, files[0])
+      seconds, _ = _Time(
+          lambda: [check(input_api, output_api, f) for f in files], repeat)
+      Add(check.__name__.lstrip('_'), seconds, java_files, java_bytes)
+
+  def Run(**kwargs):
+    with open(os.devnull, 'w') as devnull:
+      with _Quiet():
+        presubmit_support.DoPresubmitChecks(verbose=False,
+            output_stream=devnull, input_stream=None, default_presubmit=None,
+            may_prompt=False, jobs=jobs, **kwargs)
+  seconds, _ = _Time(lambda: Run(use_cache=False), repeat)
+  Add('full run', seconds, java_files, java_bytes)
+  cache_dir = tempfile.mkdtemp(prefix='presubmit_bench_cache')
+  try:
+    Run(cache_dir=cache_dir)
+    seconds, _ = _Time(lambda: Run(cache_dir=cache_dir), repeat)
+    Add('full run, warm cache', seconds, java_files, java_bytes)
+  finally:
+    shutil.rmtree(cache_dir, ignore_errors=True)
+  return benchmarks
+
+def _Time(function, repeat):
+  """Returns the fastest of repeat runs of function, and what it returned."""
+  best = None
+  for _ in xrange(max(1, repeat)):
+    start_time = time.time()
+    value = function()
+    elapsed = time.time() - start_time
+    if best is None or elapsed < best:
+      best = elapsed
+  return best, value
+
+@contextlib.contextmanager
+def _Quiet():
+  """Drops what checks print to stdout while timing them."""
+  stdout = sys.stdout
+  with open(os.devnull, 'w') as devnull:
+    sys.stdout = devnull
+    try:
+      yield
+    finally:
+      sys.stdout = stdout
+
+def _Revision():
+  """Returns the git revision of the presubmit checks, or None."""
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+        cwd=presubmit_support.PRESUBMIT_PREF_FILE_PATH,
+        stderr=open(os.devnull, 'w')).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def _FormatBenchmark(benchmark):
+  text = '%-36s %9.3fs' % (benchmark['name'], benchmark['seconds'])
+  if benchmark['files_per_second']:
+    text += ' %10.1f files/s' % benchmark['files_per_second']
+  if benchmark['mb_per_second']:
+    text += ' %8.2f MB/s' % benchmark['mb_per_second']
+  return text
+
+def WriteReport(report, output):
+  output.write('Revision %s, Python %s:\n'
+      % (report['revision'], report['python']))
+  for benchmark in report['benchmarks']:
+    output.write('  %s\n' % _FormatBenchmark(benchmark))
+
+def WriteComparison(old, new, output):
+  """Writes how much faster or slower each benchmark of new is than in old.
+  """
+  if old['parameters'] != new['parameters']:
+    output.write('Warning, the results were generated with different '
+        'parameters.\n')
+  output.write('Compared to revision %s:\n' % old['revision'])
+  old_seconds = dict((b['name'], b['seconds']) for b in old['benchmarks'])
+  for benchmark in new['benchmarks']:
+    name = benchmark['name']
+    if not old_seconds.get(name):
+      continue
+    output.write('  %-36s %9.3fs -> %9.3fs  %6.2fx\n' % (name,
+        old_seconds[name], benchmark['seconds'],
+        old_seconds[name] / max(benchmark['seconds'], 1e-9)))
+
+if __name__ == '__main__':
+  try:
+    parser = optparse.OptionParser(formatter=optparse.TitledHelpFormatter(), \
+        usage=globals()['__doc__'], version='$Id$')
+    parser.add_option('--files', type='int', default=500, \
+        help='number of Java files to generate (default: %default)')
+    parser.add_option('--file-size', type='int', default=8192, \
+        help='approximate size of each Java file in bytes (default: '
+        '%default)')
+    parser.add_option('--depth', type='int', default=3, \
+        help='number of directory levels (default: %default)')
+    parser.add_option('--presubmits', type='int', default=4, \
+        help='number of nested PRESUBMIT.py files (default: %default)')
+    parser.add_option('--violation-rate', type='float', default=0.02, \
+        help='chance of each kind of style violation per method '
+        '(default: %default)')
+    parser.add_option('--seed', type='int', default=0, \
+        help='seed of the generated repository (default: %default)')
+    parser.add_option('--repeat', type='int', default=3, \
+        help='runs of each benchmark, the fastest counts (default: %default)')
+    parser.add_option('-j', '--jobs', type='int', default=None, \
+        help='number of processes of full runs (default: as presubmit)')
+    parser.add_option('--repo-dir', default=None, \
+        help='generate the repository here and keep it (default: a '
+        'temporary directory)')
+    parser.add_option('-o', '--output', default=DEFAULT_OUTPUT, \
+        help='file to write the JSON results to (default: %default)')
+    parser.add_option('--compare', metavar='FILE', \
+        help='compare with the JSON results of an earlier run')
+    (options, args) = parser.parse_args()
+    main()
+    sys.exit(0)
+  except KeyboardInterrupt, e: # Ctrl-C
+    raise e
+  except SystemExit, e: # sys.exit()
+    raise e
+  except Exception, e:
+    print('ERROR, UNEXPECTED EXCEPTION')
+    print(str(e))
+    traceback.print_exc()
+    os._exit(1)
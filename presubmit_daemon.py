@@ -0,0 +1,305 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2015 Sean Kirmani <sean@kirmani.io>
+#
+# Distributed under terms of the MIT license.
+"""Runs presubmit checks in a long-running process.
+
+  presubmit_daemon.py serve &
+  presubmit_daemon.py check [--diff-base upstream] ...
+  presubmit_daemon.py stop
+
+The daemon listens on a Unix socket and keeps the listing of the tree,
+presubmit.xml, the compiled PRESUBMIT.py scripts, and the contents, content
+hashes and parsed Java trees of the files warm between runs, see
+presubmit_support.WarmState. check sends a request from the current directory
+and writes the output as it arrives. Without a daemon, check runs the checks
+itself.
+
+The daemon restarts itself when its own source files change.
+"""
+import sys, os, traceback, optparse
+import json
+import socket
+import SocketServer
+import struct
+import tempfile
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(),
+    'presubmit-%d.sock' % os.getuid())
+
+def main():
+  global options, args
+  command = args[0] if args else 'check'
+  if command == 'serve':
+    Serve(options.socket)
+  elif command == 'stop':
+    if SendRequest(options.socket, {'command': 'stop'}) is None:
+      print('No presubmit daemon at %s.' % options.socket)
+  elif command == 'check':
+    request = {
+        'command': 'check',
+        'cwd': os.getcwd(),
+        'may_prompt': sys.stdin.isatty(),
+        'options': {
+            'diff_base': options.diff_base,
+            'jobs': options.jobs,
+            'cache_dir': options.cache_dir,
+            'use_cache': not options.no_cache,
+            'stream': options.stream,
+            'json_output': options.json_output,
+            'timings': options.timings,
+            'changed_lines': options.changed_lines,
+            },
+        }
+    exit_code = SendRequest(options.socket, request, sys.stdout, sys.stdin)
+    if exit_code is None:
+      exit_code = _CheckInProcess(request)
+    sys.exit(exit_code)
+  else:
+    parser.error('unknown command "%s"' % command)
+
+def SendRequest(socket_path, request, output_stream=None, input_stream=None):
+  """Sends request to the daemon and relays its output and prompts.
+
+  Args:
+    socket_path: The socket the daemon listens on.
+    request: A dict with the command and its arguments.
+    output_stream: A stream to write the output of the daemon to.
+    input_stream: A stream to read answers to prompts from.
+
+  Return:
+    The exit code of the request, or None if no daemon could run it.
+  """
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(socket_path)
+  except socket.error:
+    sock.close()
+    return None
+  try:
+    rfile = sock.makefile('rb')
+    wfile = sock.makefile('wb', 0)
+    _WriteMessage(wfile, request)
+    for line in iter(rfile.readline, ''):
+      message = json.loads(line)
+      if 'output' in message:
+        if output_stream:
+          output_stream.write(message['output'].encode('utf-8'))
+          output_stream.flush()
+      elif 'input' in message:
+        answer = input_stream.readline() if input_stream else ''
+        _WriteMessage(wfile, {'input': answer})
+      elif 'error' in message:
+        sys.stderr.write('%s\n' % message['error'])
+        return 1
+      elif 'stale' in message:
+        # The daemon is restarting; this run cannot wait for it.
+        return None
+      elif 'exit' in message:
+        return message['exit']
+    sys.stderr.write('The presubmit daemon closed the connection.\n')
+    return 1
+  finally:
+    sock.close()
+
+def _WriteMessage(wfile, message):
+  wfile.write(json.dumps(message))
+  wfile.write('\n')
+
+def _CheckInProcess(request):
+  """Runs a check request without a daemon. Returns the exit code."""
+  import presubmit_support
+  kwargs = dict(request['options'])
+  json_output = None
+  if kwargs['json_output']:
+    json_output = kwargs['json_output'] = open(kwargs['json_output'], 'w')
+  try:
+    output = presubmit_support.DoPresubmitChecks(verbose=True,
+        output_stream=sys.stdout, input_stream=sys.stdin,
+        default_presubmit=None, may_prompt=request['may_prompt'], **kwargs)
+  except presubmit_support.PresubmitFailure, e:
+    sys.stderr.write('%s\n' % e)
+    return 1
+  finally:
+    if json_output:
+      json_output.close()
+  return 0 if output.should_continue() else 1
+
+class _RemoteOutput(object):
+  """The output stream of a run, forwarded to the client."""
+
+  def __init__(self, wfile):
+    self._wfile = wfile
+
+  def write(self, s):
+    if isinstance(s, str):
+      s = s.decode('utf-8', 'replace')
+    _WriteMessage(self._wfile, {'output': s})
+
+  def flush(self):
+    pass
+
+class _RemoteInput(object):
+  """The input stream of a run, read from the client when prompting."""
+
+  def __init__(self, rfile, wfile):
+    self._rfile = rfile
+    self._wfile = wfile
+
+  def readline(self):
+    _WriteMessage(self._wfile, {'input': None})
+    line = self._rfile.readline()
+    if not line:
+      return ''
+    return json.loads(line)['input']
+
+def Serve(socket_path):
+  """Runs check requests sent to socket_path, one at a time, until stopped.
+  """
+  import presubmit_support
+  # Import the checks now, so that their sources are watched from the start.
+  from presubmit_rules import java_style
+
+  class Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+      if not _FromSameUser(self.request):
+        return
+      request = json.loads(self.rfile.readline())
+      if request['command'] == 'ping':
+        _WriteMessage(self.wfile, {'exit': 0})
+      elif request['command'] == 'stop':
+        self.server.stopped = True
+        _WriteMessage(self.wfile, {'exit': 0})
+      elif _SourceStamps() != self.server.source_stamps:
+        self.server.stopped = self.server.restart = True
+        _WriteMessage(self.wfile, {'stale': True})
+      else:
+        _HandleCheck(request, self.rfile, self.wfile, self.server.state)
+
+  if SendRequest(socket_path, {'command': 'ping'}) is not None:
+    raise presubmit_support.PresubmitFailure(
+        'A presubmit daemon already listens on %s.' % socket_path)
+  if os.path.exists(socket_path):
+    os.remove(socket_path)
+  # Only this user may connect: requests run code as this user.
+  old_umask = os.umask(077)
+  try:
+    server = SocketServer.UnixStreamServer(socket_path, Handler)
+  finally:
+    os.umask(old_umask)
+  server.state = presubmit_support.WarmState()
+  server.source_stamps = _SourceStamps()
+  server.stopped = server.restart = False
+  print('Presubmit daemon listening on %s.' % socket_path)
+  try:
+    while not server.stopped:
+      server.handle_request()
+  finally:
+    server.server_close()
+    os.remove(socket_path)
+  if server.restart:
+    print('Sources changed, restarting.')
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+def _HandleCheck(request, rfile, wfile, state):
+  import presubmit_support
+  kwargs = dict(request['options'])
+  main_path = os.getcwd()
+  json_output = None
+  try:
+    os.chdir(request['cwd'])
+    if kwargs['json_output']:
+      json_output = kwargs['json_output'] = open(kwargs['json_output'], 'w')
+    output = presubmit_support.DoPresubmitChecks(verbose=True,
+        output_stream=_RemoteOutput(wfile),
+        input_stream=_RemoteInput(rfile, wfile), default_presubmit=None,
+        may_prompt=request['may_prompt'], state=state, **kwargs)
+    _WriteMessage(wfile, {'exit': 0 if output.should_continue() else 1})
+    # The client is done. Read what worker processes read during the run,
+    # for the next one.
+    state.Warm()
+  except presubmit_support.PresubmitFailure, e:
+    _WriteMessage(wfile, {'error': str(e)})
+  except socket.error:
+    # The client went away.
+    pass
+  except Exception:
+    _WriteMessage(wfile, {'error': traceback.format_exc()})
+  finally:
+    if json_output:
+      json_output.close()
+    os.chdir(main_path)
+
+def _FromSameUser(sock):
+  """Whether the peer of sock runs as this user, where that can be told."""
+  so_peercred = getattr(socket, 'SO_PEERCRED', 17 if
+      sys.platform.startswith('linux') else None)
+  if so_peercred is None:
+    return True
+  credentials = sock.getsockopt(socket.SOL_SOCKET, so_peercred,
+      struct.calcsize('3i'))
+  _, uid, _ = struct.unpack('3i', credentials)
+  return uid == os.getuid()
+
+def _SourceStamps():
+  """Returns the mtimes of the source files of this package that are loaded.
+  """
+  package_dir = os.path.dirname(os.path.abspath(__file__))
+  stamps = {}
+  for module in sys.modules.values():
+    path = getattr(module, '__file__', None)
+    if not path:
+      continue
+    path = os.path.abspath(path)
+    if path.endswith(('.pyc', '.pyo')):
+      path = path[:-1]
+    if path.startswith(package_dir + os.sep):
+      try:
+        stamps[path] = os.stat(path).st_mtime
+      except OSError:
+        stamps[path] = None
+  return stamps
+
+if __name__ == '__main__':
+  try:
+    parser = optparse.OptionParser(formatter=optparse.TitledHelpFormatter(), \
+        usage=globals()['__doc__'], version='$Id$')
+    parser.add_option('--socket', default=DEFAULT_SOCKET, \
+        help='the socket the daemon listens on (default: %default)')
+    parser.add_option('--diff-base', default=None, \
+        help='only check files changed against this base, see '
+        'presubmit_support.py')
+    parser.add_option('-j', '--jobs', type='int', default=None, \
+        help='number of processes to run presubmit scripts and the Java '
+        'checks in')
+    parser.add_option('--cache-dir', default=None, \
+        help='directory to cache compiled presubmit scripts and check '
+        'results in')
+    parser.add_option('--no-cache', action='store_true', default=False, \
+        help='do not read or write any cached results')
+    parser.add_option('--stream', action='store_true', default=False, \
+        help='write results as soon as they are available')
+    parser.add_option('--json-output', metavar='FILE', \
+        help='also write one JSON record per result to FILE')
+    parser.add_option('--timings', action='store_const', default=0, \
+        const=10, help='report the slowest presubmit scripts, checks and files')
+    parser.add_option('--changed-lines', action='store_true', default=False, \
+        help='with --diff-base, only check the lines that changed')
+    (options, args) = parser.parse_args()
+    if options.changed_lines and not options.diff_base:
+      parser.error('--changed-lines needs --diff-base')
+    if options.json_output:
+      options.json_output = os.path.abspath(options.json_output)
+    main()
+  except KeyboardInterrupt, e: # Ctrl-C
+    raise e
+  except SystemExit, e: # sys.exit()
+    raise e
+  except Exception, e:
+    print('ERROR, UNEXPECTED EXCEPTION')
+    print(str(e))
+    traceback.print_exc()
+    os._exit(1)
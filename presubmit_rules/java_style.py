@@ -9,30 +9,281 @@
 
 TODO(Sean Kirmani): DO NOT SUBMIT without a detailed description of test.
 """
+import bisect
+import hashlib
+import multiprocessing
 import operator
+import os
+import re
 import sys
+import time
 import unicodedata
 
+from parsers import java_parser
+
 COLUMN_LIMIT = 100
 
-def DoJavaChecks(input_api, output_api, files):
+# Fewer files than this per worker process are checked serially, since
+# starting the pool would cost more than it saves.
+MIN_FILES_PER_JOB = 8
+
+# _ScanLines times the line rules one by one on every this many lines.
+_TIMED_LINE_INTERVAL = 16
+
+# Seconds to wait for a worker process at a time. Waiting without a timeout
+# could not be cancelled by the time budget of the presubmit script.
+_POOL_WAIT = 1.0
+
+def DoJavaChecks(input_api, output_api, files, jobs=None):
+  """Runs every Java style check on files.
+
+  Args:
+    jobs: Number of worker processes to check the files in. Defaults to the
+      jobs of input_api.Config(), which -j overrides, or the number of CPUs.
+      Small changes are checked serially, and so is every change when already
+      running inside a worker process.
+
+  Return:
+    List of results, in the order of files.
+  """
+  if jobs is None:
+    jobs = input_api.Config().jobs or multiprocessing.cpu_count()
+  jobs = min(jobs, len(files) // MIN_FILES_PER_JOB)
+  # Build these in the parent so forked workers inherit them.
+  _BannedWhitespace()
+  _RulesVersion(input_api)
+  if jobs <= 1 or multiprocessing.current_process().daemon:
+    results = []
+    for f in files:
+      file_results = _DoJavaCheck(input_api, output_api, f)
+      output_api.StreamResults(file_results)
+      results += file_results
+    return results
+
+  pool = multiprocessing.Pool(jobs, _InitJavaCheckWorker,
+      (input_api, output_api, files))
+  # Workers are handed ranges of files. Chunking is not left to imap, whose
+  # chunked results cannot be waited for with a timeout.
+  chunk_size = max(1, len(files) // (jobs * 4))
+  chunks = [(start, min(start + chunk_size, len(files)))
+      for start in range(0, len(files), chunk_size)]
   results = []
-  for f in files:
-    results +=  _DoJavaCheck(input_api, output_api, f)
+  try:
+    pool_results = pool.imap(_DoJavaChecksInWorker, chunks)
+    for chunk_results, counts, timings in input_api.WaitForPoolResults(pool,
+        pool_results, _POOL_WAIT):
+      if input_api.result_cache:
+        input_api.result_cache.AddCounts(*counts)
+      input_api.timings.Merge(timings)
+      for file_results in chunk_results:
+        output_api.StreamResults(file_results)
+        results += file_results
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
   return results
 
+# The arguments of DoJavaChecks, inherited by each worker process.
+_worker_args = None
+
+def _InitJavaCheckWorker(input_api, output_api, files):
+  global _worker_args
+  _worker_args = (input_api, output_api, files)
+  # Forget what the parent counted before the fork, it reports that itself.
+  if input_api.result_cache:
+    input_api.result_cache.TakeCounts()
+  input_api.timings.Take()
+
+def _DoJavaChecksInWorker(chunk):
+  """Checks the files in the range chunk of files in a worker process.
+
+  Return:
+    The results of each file, and the result cache counts and timings of the
+    worker.
+  """
+  input_api, output_api, files = _worker_args
+  start, stop = chunk
+  results = [_DoJavaCheck(input_api, output_api, f)
+      for f in files[start:stop]]
+  timings = input_api.timings.Take()
+  if input_api.result_cache:
+    return results, input_api.result_cache.TakeCounts(), timings
+  return results, (0, 0, 0), timings
+
 def _DoJavaCheck(input_api, output_api, f):
+  config = input_api.Config()
+  timings = input_api.timings
+  file_start_time = time.time()
+  checks = [check for check in JAVA_CHECKS
+      if config.CheckEnabled(check.__name__.lstrip('_'))]
+  # check -> (results, elapsed)
+  check_results = {}
+  try:
+    # The line rules that have no cached results share one pass over the
+    # lines.
+    scanned = []
+    for check in checks:
+      if check in _LINE_RULES:
+        start_time = time.time()
+        results = _GetCachedResults(check, input_api, output_api, f)
+        if results is None:
+          scanned.append(check)
+        else:
+          check_results[check] = (results, time.time() - start_time)
+    if scanned:
+      budgets = [config.CheckTimeBudget(check.__name__.lstrip('_'))
+          for check in scanned]
+      budgets = [budget for budget in budgets if budget is not None]
+      with input_api.TimeBudget(min(budgets) if budgets else None) as budget:
+        scans = _ScanLines(input_api, output_api, f,
+            [_LINE_RULES[check] for check in scanned])
+      if budget.expired:
+        # Run the rules one by one to tell which of them ran out of time.
+        # Their results are known not to be cached.
+        for check in scanned:
+          start_time = time.time()
+          results = _RunCheck(check, input_api, output_api, f)
+          check_results[check] = (results, time.time() - start_time)
+      else:
+        for check, (results, elapsed) in zip(scanned, scans):
+          _PutCachedResults(check, input_api, f, results)
+          check_results[check] = (results, elapsed)
+    for check in checks:
+      if check not in check_results:
+        start_time = time.time()
+        results = _GetCachedResults(check, input_api, output_api, f)
+        if results is None:
+          results = _RunCheck(check, input_api, output_api, f)
+        check_results[check] = (results, time.time() - start_time)
+  finally:
+    # Every check has seen the file, so its contents can go.
+    f.Release()
+    timings.Add('file', f.LocalPath(), time.time() - file_start_time)
   results = []
-  results += _CheckFileName(input_api, output_api, f)
-  results += _CheckWhiteSpaceCharacter(input_api, output_api, f)
-  results += _CheckSpecialEscapeSequences(input_api, output_api, f)
-  results += _CheckNonAsciiCharacters(input_api, output_api, f)
-  results += _CheckLicense(input_api, output_api, f)
-  results += _CheckWildcardImports(input_api, output_api, f)
-  results += _CheckColumnLimit(input_api, output_api, f)
-  results += _CheckImportOrderingAndSpacing(input_api, output_api, f)
+  for check in checks:
+    results_of_check, elapsed = check_results[check]
+    timings.Add('check', check.__name__, elapsed)
+    for result in results_of_check:
+      result.check_name = check.__name__
+      result.elapsed = elapsed
+    results += results_of_check
+  return results
+
+def _RunCheck(check, input_api, output_api, f):
+  """Runs check on f within its time budget, and caches its results.
+
+  Return:
+    The results of check, or a timeout result if it was cancelled.
+  """
+  name = check.__name__.lstrip('_')
+  time_budget = input_api.Config().CheckTimeBudget(name)
+  with input_api.TimeBudget(time_budget) as budget:
+    results = check(input_api, output_api, f)
+  if budget.expired:
+    return [output_api.PresubmitTimeout('%s did not finish within its time '
+        'budget of %gs.' % (name, time_budget), [f.LocalPath()])]
+  _PutCachedResults(check, input_api, f, results)
   return results
 
+def _ResultCacheKey(check, input_api, f):
+  changed_lines = f.ChangedLineNumbers()
+  return (__name__, check.__name__, _RulesVersion(input_api), f.LocalPath(),
+      f.ContentHash(), _ColumnLimit(input_api), input_api.License(),
+      changed_lines and tuple(changed_lines))
+
+def _GetCachedResults(check, input_api, output_api, f):
+  """Returns the cached results of check on f, or None."""
+  cache = input_api.result_cache
+  if not cache:
+    return None
+  return cache.Get(_ResultCacheKey(check, input_api, f), output_api)
+
+def _PutCachedResults(check, input_api, f, results):
+  cache = input_api.result_cache
+  if cache:
+    cache.Put(_ResultCacheKey(check, input_api, f), results)
+
+class _LineRule(object):
+  """A check that looks at one line at a time.
+
+  The line rules run on a file share one reading of its changed lines, see
+  _ScanLines, so another rule costs a call per line rather than another read
+  of the file. An instance checks one file, and warns with message about the
+  items it adds to errors.
+  """
+  message = ''
+
+  def __init__(self, input_api, output_api, f):
+    self.input_api = input_api
+    self.output_api = output_api
+    self.f = f
+    self.errors = []
+
+  def Line(self, line_num, line):
+    """Looks at one line, without its trailing whitespace."""
+
+  def Results(self):
+    """Returns the results, once every line was seen."""
+    return _GenerateWarnings(self.message, self.errors, self.output_api)
+
+def _ScanLines(input_api, output_api, f, rule_types):
+  """Feeds each changed line of f to a new rule of each of rule_types, in a
+  single pass over the lines.
+
+  Timing every call would cost more than most rules do, so the rules are only
+  timed one by one on every _TIMED_LINE_INTERVAL-th line. The time of the
+  pass is split between the rules in proportion to those samples.
+
+  Return:
+    (results, elapsed) of each rule, in the order of rule_types.
+  """
+  rules = [rule_type(input_api, output_api, f) for rule_type in rule_types]
+  handlers = [rule.Line for rule in rules]
+  sampled = [0.0] * len(rules)
+  start_time = time.time()
+  for line_num, line in f.ChangedContents():
+    if line_num % _TIMED_LINE_INTERVAL:
+      for handler in handlers:
+        handler(line_num, line)
+    else:
+      for index, handler in enumerate(handlers):
+        handler_start_time = time.time()
+        handler(line_num, line)
+        sampled[index] += time.time() - handler_start_time
+  elapsed = time.time() - start_time
+  total_sampled = sum(sampled)
+  scans = []
+  for rule, rule_sampled in zip(rules, sampled):
+    if total_sampled:
+      share = elapsed * rule_sampled / total_sampled
+    else:
+      # Too few lines to tell the rules apart.
+      share = elapsed / len(rules)
+    start_time = time.time()
+    results = rule.Results()
+    scans.append((results, share + time.time() - start_time))
+  return scans
+
+# The version of the checks used in result cache keys. It is the hash of this
+# file, of the parser the checks use and of presubmit_support, which reads the
+# files and builds the results, so that editing any of them invalidates the
+# results cached for them.
+_rules_version = None
+
+def _RulesVersion(input_api):
+  global _rules_version
+  if _rules_version is None:
+    digest = hashlib.sha1()
+    for module in (sys.modules[__name__], java_parser,
+        sys.modules[type(input_api).__module__]):
+      with open(os.path.splitext(module.__file__)[0] + '.py', 'rb') as f:
+        digest.update(f.read())
+    _rules_version = digest.hexdigest()
+  return _rules_version
+
 def _CheckFileName(input_api, output_api, f):
   """2.1 File name
 
@@ -60,33 +311,67 @@ def _CheckWhiteSpaceCharacter(input_api, output_api, f):
      escaped.
   2. Tab characters are not used for indentation.
   """
-  errors = []
-  banned_whitespace_characters = []
-  for c in xrange(sys.maxunicode + 1):
-    u = unichr(c)
-    cat = unicodedata.category(u)
-    if (cat == 'Zs' or cat == 'Zl' or cat == 'Zp') and \
-        unicodedata.name(u) != 'SPACE':
-      banned_whitespace_characters.append({'name': unicodedata.name(u),
-        'char': u})
-  banned_whitespace_characters += [
-      {'name': 'CHARACTER TABULATION', 'char': '\x09'},
-      {'name': 'LINE FEED (LF)', 'char': '\x0A'},
-      {'name': 'LINE TABULATION', 'char': '\x0B'},
-      {'name': 'FORM FEED (FF)', 'char': '\x0C'},
-      {'name': 'CARRIAGE RETURN (CR)', 'char': '\x0D'},
-      ]
-  lines = [l.rstrip() for l in f.ReadFileLines()]
-  line_num = 1
-  for line in lines:
-    for character in banned_whitespace_characters:
-      if character['char'] in line:
-        errors.append(_ReportErrorFileAndLine(f.LocalPath(), line_num,
-          'Contains %s' % character['name']))
-    line_num += 1
-  return _GenerateWarnings('Aside from the line terminator sequence, the '
-      'ASCII horizontal space character (0x20) is the only whitespace '
-      'character that appears anywhere in a source file.', errors, output_api)
+  return _ScanLines(input_api, output_api, f, [_WhiteSpaceCharacterRule])[0][0]
+
+class _WhiteSpaceCharacterRule(_LineRule):
+  message = ('Aside from the line terminator sequence, the ASCII horizontal '
+      'space character (0x20) is the only whitespace character that appears '
+      'anywhere in a source file.')
+
+  def __init__(self, input_api, output_api, f):
+    super(_WhiteSpaceCharacterRule, self).__init__(input_api, output_api, f)
+    self.banned_whitespace_characters, self.banned_whitespace_re = (
+        _BannedWhitespace())
+
+  def Line(self, line_num, line):
+    if isinstance(line, str):
+      # Lines of plain ASCII without control characters are the common case,
+      # and have nothing to decode.
+      if not _NON_ASCII_OR_CONTROL_RE.search(line):
+        return
+      line = line.decode('utf-8', 'replace')
+    found = set(self.banned_whitespace_re.findall(line))
+    for character in self.banned_whitespace_characters:
+      if character['char'] in found:
+        self.errors.append(_ReportErrorFileAndLine(self.output_api,
+          self.f.LocalPath(), line_num, 'Contains %s' % character['name']))
+
+# Bytes outside of printable ASCII. Only lines with some can contain banned
+# whitespace.
+_NON_ASCII_OR_CONTROL_RE = re.compile(r'[^\x20-\x7e]')
+
+# The whitespace characters banned by _CheckWhiteSpaceCharacter and a regex
+# matching any of them. Built on first use by _BannedWhitespace.
+_banned_whitespace = None
+
+def _BannedWhitespace():
+  """Returns the banned whitespace characters and a regex matching any of them.
+
+  Finding them means looking up every Unicode code point, so it is only done
+  once per process.
+  """
+  global _banned_whitespace
+  if _banned_whitespace is None:
+    banned_whitespace_characters = []
+    for c in xrange(sys.maxunicode + 1):
+      u = unichr(c)
+      cat = unicodedata.category(u)
+      if (cat == 'Zs' or cat == 'Zl' or cat == 'Zp') and \
+          unicodedata.name(u) != 'SPACE':
+        banned_whitespace_characters.append({'name': unicodedata.name(u),
+          'char': u})
+    banned_whitespace_characters += [
+        {'name': 'CHARACTER TABULATION', 'char': u'\x09'},
+        {'name': 'LINE FEED (LF)', 'char': u'\x0A'},
+        {'name': 'LINE TABULATION', 'char': u'\x0B'},
+        {'name': 'FORM FEED (FF)', 'char': u'\x0C'},
+        {'name': 'CARRIAGE RETURN (CR)', 'char': u'\x0D'},
+        ]
+    banned_whitespace_re = re.compile(u'[%s]' % u''.join(
+        re.escape(c['char']) for c in banned_whitespace_characters),
+        re.UNICODE)
+    _banned_whitespace = (banned_whitespace_characters, banned_whitespace_re)
+  return _banned_whitespace
 
 def _CheckSpecialEscapeSequences(input_api, output_api, f):
   """2.3.2 Special escape sequences
@@ -95,37 +380,57 @@ def _CheckSpecialEscapeSequences(input_api, output_api, f):
   \", \', and \\ ), that sequence is used rather than the corresponding octal
   (e.g. \012 ) or Unicode (e.g. \u000a) escape.
   """
-  errors = []
-  special_escape_sequences = [
-      {'correct': 'b', 'octal': '010', 'unicode': 'u0008'},
-      {'correct': 't', 'octal': '011', 'unicode': 'u0009'},
-      {'correct': 'n', 'octal': '012', 'unicode': 'u000a'},
-      {'correct': 'f', 'octal': '014', 'unicode': 'u000c'},
-      {'correct': 'r', 'octal': '015', 'unicode': 'u000d'},
-      {'correct': '"', 'octal': '042', 'unicode': 'u0022'},
-      {'correct': '\'', 'octal': '047', 'unicode': 'u0027'},
-      {'correct': '\\', 'octal': '0134', 'unicode': 'u005c'},
-      ]
-  lines = [l.rstrip() for l in f.ReadFileLines()]
-  line_num = 1
-  for line in lines:
-    for index in range(len(line) - 1):
-      if line[index] == '\\':
-        sequence = line[index + 1:]
-        for seq in special_escape_sequences:
-          if sequence.startswith(seq['octal']):
-            errors.append(_ReportErrorFileAndLine(f.LocalPath(), line_num,
-              'Should have used \\%s instead of the octal \\%s'
-              % (seq['correct'], seq['octal'])))
-          if sequence.lower().startswith(seq['unicode']):
-            errors.append(_ReportErrorFileAndLine(f.LocalPath(), line_num,
-              'Should have used \\%s instead of the unicode \\%s'
-              % (seq['correct'], seq['unicode'])))
-    line_num += 1
-  return _GenerateWarnings('For any character that has a special escape '
-      'sequence ( \\b, \\t, \\n, \\f. \\r. \\". \\\', \\\\ ), that sequence '
-      'is used rather than the corresponding octal (e.g. \\012 ) or Unicode '
-      '(e.g. \\u000a ) escape.', errors, output_api)
+  return _ScanLines(input_api, output_api, f,
+      [_SpecialEscapeSequencesRule])[0][0]
+
+_SPECIAL_ESCAPE_SEQUENCES = [
+    {'correct': 'b', 'octal': '010', 'unicode': 'u0008'},
+    {'correct': 't', 'octal': '011', 'unicode': 'u0009'},
+    {'correct': 'n', 'octal': '012', 'unicode': 'u000a'},
+    {'correct': 'f', 'octal': '014', 'unicode': 'u000c'},
+    {'correct': 'r', 'octal': '015', 'unicode': 'u000d'},
+    {'correct': '"', 'octal': '042', 'unicode': 'u0022'},
+    {'correct': '\'', 'octal': '047', 'unicode': 'u0027'},
+    {'correct': '\\', 'octal': '0134', 'unicode': 'u005c'},
+    ]
+
+def _CaseInsensitive(s):
+  """Returns a regex matching s with its letters in either case."""
+  return ''.join('[%s%s]' % (c.lower(), c.upper()) if c.isalpha()
+      else re.escape(c) for c in s)
+
+# Matches a backslash followed by any of the octal or unicode escapes above,
+# with the escape in group 1. Unicode escapes are matched in either case.
+_SPECIAL_ESCAPE_SEQUENCES_RE = re.compile(r'\\(%s)' % '|'.join(
+    [re.escape(seq['octal']) for seq in _SPECIAL_ESCAPE_SEQUENCES] +
+    [_CaseInsensitive(seq['unicode']) for seq in _SPECIAL_ESCAPE_SEQUENCES]))
+
+# The message for each escape matched by _SPECIAL_ESCAPE_SEQUENCES_RE, keyed
+# by the lowercased escape.
+_SPECIAL_ESCAPE_MESSAGES = {}
+for _seq in _SPECIAL_ESCAPE_SEQUENCES:
+  _SPECIAL_ESCAPE_MESSAGES[_seq['octal']] = (
+      'Should have used \\%s instead of the octal \\%s'
+      % (_seq['correct'], _seq['octal']))
+  _SPECIAL_ESCAPE_MESSAGES[_seq['unicode']] = (
+      'Should have used \\%s instead of the unicode \\%s'
+      % (_seq['correct'], _seq['unicode']))
+del _seq
+
+class _SpecialEscapeSequencesRule(_LineRule):
+  message = ('For any character that has a special escape sequence ( \\b, '
+      '\\t, \\n, \\f. \\r. \\". \\\', \\\\ ), that sequence is used '
+      'rather than the corresponding octal (e.g. \\012 ) or Unicode (e.g. '
+      '\\u000a ) escape.')
+
+  def Line(self, line_num, line):
+    if '\\' not in line:
+      return
+    for match in _SPECIAL_ESCAPE_SEQUENCES_RE.finditer(line):
+      self.errors.append(_ReportErrorFileAndLine(self.output_api,
+        self.f.LocalPath(), line_num,
+        _SPECIAL_ESCAPE_MESSAGES[match.group(1).lower()],
+        match.start() + 1))
 
 def _CheckNonAsciiCharacters(input_api, output_api, f):
   """2.3.3 Non-ASCII characters
@@ -147,7 +452,11 @@ def _CheckLicense(input_api, output_api, f):
   If license or copyright information belongs in a file, it belongs here.
   """
   errors = []
-  if not f.ReadFile().startswith(input_api.License()):
+  license = input_api.License()
+  if isinstance(license, unicode):
+    license = license.encode('utf-8')
+  # Only compare the start of the file rather than copying all of it.
+  if f.ReadRawBytes()[:len(license)] != license:
     errors.append("Beginning of file does not match the following:\n%s"
         % input_api.License())
   return _GenerateWarnings('If license or copyright information belongs in a '
@@ -158,16 +467,16 @@ def _CheckWildcardImports(input_api, output_api, f):
 
   Wildcard imports, static or otherwise, are not used.
   """
-  errors = []
-  lines = [l.rstrip() for l in f.ReadFileLines()]
-  line_num = 1
-  for line in lines:
+  return _ScanLines(input_api, output_api, f, [_WildcardImportsRule])[0][0]
+
+class _WildcardImportsRule(_LineRule):
+  message = 'Wildcard imports, static or otherwise, are not used.'
+
+  def Line(self, line_num, line):
     if line.startswith('import '):
       if '*' in line:
-        errors.append(_ReportErrorFileAndLine(f.LocalPath(), line_num,
-          line))
-  return _GenerateWarnings('Wildcard imports, static or otherwise, are not '
-      'used.', errors, output_api)
+        self.errors.append(_ReportErrorFileAndLine(self.output_api,
+          self.f.LocalPath(), line_num, line))
 
 def _CheckImportOrderingAndSpacing(input_api, output_api, f):
   """3.3.3 Ordering and spacing
@@ -187,100 +496,156 @@ def _CheckImportOrderingAndSpacing(input_api, output_api, f):
   ASCII sort order. (Note: this is not the same as import statements being in
   ASCII sort order; the presence of semicolons warps the result.)
   """
-  class ImportLine(object):
-    def __init__(self, text, line_num):
-      self.text = text
-      self.line_num = line_num
-
-    def TextWithoutImport(self):
-      return self.text[7:]
-
-  def _GenerateImports(imports):
-    result = ""
-    for imp in imports['static']:
-      result += imp.text + '\n'
-    if len(imports['static']) > 0:
-      result += '\n'
-    for imp in imports['com_google']:
-      result += imp.text + '\n'
-    if len(imports['com_google']) > 0:
-      result += '\n'
-    for imp in imports['third_party']:
-      result += imp.text + '\n'
-    if len(imports['third_party']) > 0:
-      result += '\n'
-    for imp in imports['java']:
-      result += imp.text + '\n';
-    if len(imports['java']) > 0:
-      result += '\n'
-    for imp in imports['javax']:
-      result += imp.text + '\n'
-    return result.strip()
-
-  def _IndentedString(string, num_spaces):
-    if num_spaces == 0:
-      return string
-    return _IndentedString(' '.join((' ' + string).splitlines(True)),
-        num_spaces - 1)
-
-  def _SortedImports(import_lines):
-    imports = {
-        'static': [],
-        'com_google': [],
-        'third_party': [],
-        'java': [],
-        'javax': [],
-        }
-    for line in import_lines:
-      if 'static' in line.text:
-        imports['static'].append(line)
-      elif line.TextWithoutImport().startswith('com.google'):
-        imports['com_google'].append(line)
-      elif line.TextWithoutImport().startswith('javax'):
-        imports['javax'].append(line)
-      elif line.TextWithoutImport().startswith('java'):
-        imports['java'].append(line)
-      else:
-        imports['third_party'].append(line)
-    sorted_imports_dict = {imp : sorted(imports[imp],
-      key=operator.attrgetter('text')) for imp in imports}
-    return _GenerateImports(sorted_imports_dict)
-
-  def _OriginalImports(import_lines):
-    if len(import_lines) == 0:
-      return ''
-    result = ''
-    previous_line = import_lines[0]
-    for line in import_lines:
-      for i in range(previous_line.line_num, line.line_num):
-        result += '\n'
-      result += line.text
-      previous_line = line
-    return result
-
   errors = []
-  lines = [l.rstrip() for l in f.ReadFileLines()]
-  line_num = 1
+  # Only the import lines are needed, so they are stripped one by one.
+  lines = f.ReadFileLines()
   import_lines = []
-  for line in lines:
-    if line.startswith('import '):
-      import_lines.append(ImportLine(line, line_num))
-    line_num += 1
+  for node in f.JavaTree(header_only=True).children:
+    if node.thing != java_parser.IMPORT:
+      continue
+    if import_lines and import_lines[-1].line_num == node.line:
+      # Several imports on one line.
+      continue
+    import_lines.append(_ImportLine(lines[node.line - 1].rstrip(), node.line,
+        '.'.join(node.package + [node.name]), node.is_static))
 
-  original_imports = _OriginalImports(import_lines)
   sorted_imports = _SortedImports(import_lines)
+  sorted_text = '\n\n'.join('\n'.join(line.text for line in group)
+      for group in sorted_imports if group).strip()
 
-  if original_imports != sorted_imports:
-    errors.append(_ReportErrorFileAndLine(f.LocalPath(),
+  if _OriginalImports(import_lines) != sorted_text:
+    errors.append(_ReportErrorFileAndLine(output_api, f.LocalPath(),
       import_lines[0].line_num, 'Imports were not in correct format. Change '
         'the imports to the following sorted import format:\n%s' %
-        _IndentedString(sorted_imports, 4)))
+        _IndentedString(sorted_text, 4)))
+    errors += [_ReportErrorFileAndLine(output_api, f.LocalPath(), line_num,
+        msg) for line_num, msg in _ImportsDiff(import_lines, sorted_imports)]
 
   return _GenerateWarnings('Import statements are divided into the following '
       'groups, in this order, with each group separated by a single line: '
       'static imports, com.google imports, third-party imports, java imports, '
       'javax imports.', errors, output_api)
 
+# The groups of imports of _CheckImportOrderingAndSpacing, in order.
+_IMPORT_GROUPS = ('static', 'com_google', 'third_party', 'java', 'javax')
+
+class _ImportLine(object):
+  """A line with an import statement, and where it belongs."""
+  __slots__ = ('text', 'line_num', 'group', 'rank')
+
+  def __init__(self, text, line_num, name, is_static):
+    """
+    Args:
+      text: The line, without trailing whitespace.
+      line_num: The number of the line, 1-based.
+      name: The imported name, e.g. java.util.List.
+      is_static: Whether the import is static.
+    """
+    self.text = text
+    self.line_num = line_num
+    if is_static:
+      self.group = 0
+    elif name.startswith('com.google'):
+      self.group = 1
+    elif name.startswith('javax'):
+      self.group = 4
+    elif name.startswith('java'):
+      self.group = 3
+    else:
+      self.group = 2
+    # The position of the line once sorted, set by _SortedImports.
+    self.rank = None
+
+def _SortedImports(import_lines):
+  """Returns the import lines of each of _IMPORT_GROUPS, sorted, and sets the
+  rank of each line.
+  """
+  groups = [[] for _ in _IMPORT_GROUPS]
+  for line in import_lines:
+    groups[line.group].append(line)
+  rank = 0
+  for group in groups:
+    group.sort(key=operator.attrgetter('text'))
+    for line in group:
+      line.rank = rank
+      rank += 1
+  return groups
+
+def _OriginalImports(import_lines):
+  """Returns the import lines as they are, with a line break per line between
+  them."""
+  if not import_lines:
+    return ''
+  pieces = [import_lines[0].text]
+  for previous_line, line in zip(import_lines, import_lines[1:]):
+    pieces.append('\n' * (line.line_num - previous_line.line_num))
+    pieces.append(line.text)
+  return ''.join(pieces)
+
+def _IndentedString(string, num_spaces):
+  indent = ' ' * num_spaces
+  return indent + indent.join(string.splitlines(True))
+
+def _ImportsDiff(import_lines, sorted_imports):
+  """Tells which import lines are out of place.
+
+  The lines that can stay where they are are the longest run of lines already
+  in sorted order, found in O(n log n). Every other line is out of order. The
+  spacing is checked between neighbouring lines that are in order.
+
+  Args:
+    import_lines: The _ImportLine objects, in the order of the file, ranked by
+      _SortedImports.
+    sorted_imports: The groups returned by _SortedImports.
+
+  Return:
+    A list of (line_num, message), by line number.
+  """
+  sorted_lines = [line for group in sorted_imports for line in group]
+  # Longest increasing subsequence of the ranks: tails[k] is the index of the
+  # smallest rank ending a run of k + 1 lines, previous[i] the index of the
+  # line before import_lines[i] in its run.
+  tails = []
+  tail_ranks = []
+  previous = [None] * len(import_lines)
+  for i, line in enumerate(import_lines):
+    k = bisect.bisect_left(tail_ranks, line.rank)
+    if k:
+      previous[i] = tails[k - 1]
+    if k == len(tails):
+      tails.append(i)
+      tail_ranks.append(line.rank)
+    else:
+      tails[k] = i
+      tail_ranks[k] = line.rank
+  in_order = [False] * len(import_lines)
+  i = tails[-1] if tails else None
+  while i is not None:
+    in_order[i] = True
+    i = previous[i]
+
+  diff = []
+  previous_line = None
+  for i, line in enumerate(import_lines):
+    if not in_order[i]:
+      if line.rank:
+        diff.append((line.line_num, 'Out of order, belongs after line %d.'
+            % sorted_lines[line.rank - 1].line_num))
+      else:
+        diff.append((line.line_num, 'Out of order, belongs before line %d.'
+            % sorted_lines[1].line_num))
+      continue
+    if previous_line is not None:
+      gap = line.line_num - previous_line.line_num
+      if line.group == previous_line.group and gap != 1:
+        diff.append((line.line_num, 'Should directly follow the import on '
+            'line %d.' % previous_line.line_num))
+      elif line.group != previous_line.group and gap != 2:
+        diff.append((line.line_num, 'Should be separated from the import on '
+            'line %d by one blank line.' % previous_line.line_num))
+    previous_line = line
+  return diff
+
 def _CheckColumnLimit(input_api, output_api, f):
   """4.4 Column limit: 80 or 100
 
@@ -295,26 +660,53 @@ def _CheckColumnLimit(input_api, output_api, f):
      Import statements).
   3. Command lines in a commant that may be cut-and-pasted into a shell.
   """
-  lines = [l.rstrip() for l in f.ReadFileLines()]
-  line_num = 1
-  errors = []
-  for line in lines:
-    if not line.startswith('package ') and not line.startswith('import '):
-      if len(line) > COLUMN_LIMIT:
-        errors.append(_ReportErrorFileAndLine(f.LocalPath(), line_num,
-          'Line is %s characters, the limit is %s characters.' %
-          (len(line), COLUMN_LIMIT)))
-    line_num += 1
-  return _GenerateWarnings('Projects are free to choose a column limit of '
-      'either 80 or 100 characters. By default, it is 100 characters.',
-      errors, output_api)
+  return _ScanLines(input_api, output_api, f, [_ColumnLimitRule])[0][0]
+
+class _ColumnLimitRule(_LineRule):
+  message = ('Projects are free to choose a column limit of either 80 or 100 '
+      'characters. By default, it is 100 characters.')
 
-def _ReportErrorFileAndLine(filename, line_num, msg=''):
+  def __init__(self, input_api, output_api, f):
+    super(_ColumnLimitRule, self).__init__(input_api, output_api, f)
+    self.column_limit = _ColumnLimit(input_api)
+
+  def Line(self, line_num, line):
+    if len(line) > self.column_limit:
+      if not line.startswith('package ') and not line.startswith('import '):
+        self.errors.append(_ReportErrorFileAndLine(self.output_api,
+          self.f.LocalPath(), line_num,
+          'Line is %s characters, the limit is %s characters.' %
+          (len(line), self.column_limit)))
+
+# Every check run on a Java file, in the order they are run. Each takes
+# (input_api, output_api, f) and returns a list of results.
+JAVA_CHECKS = (
+    _CheckFileName,
+    _CheckWhiteSpaceCharacter,
+    _CheckSpecialEscapeSequences,
+    _CheckNonAsciiCharacters,
+    _CheckLicense,
+    _CheckWildcardImports,
+    _CheckColumnLimit,
+    _CheckImportOrderingAndSpacing,
+    )
+
+# The checks of JAVA_CHECKS that are line rules, and their _LineRule.
+_LINE_RULES = {
+    _CheckWhiteSpaceCharacter: _WhiteSpaceCharacterRule,
+    _CheckSpecialEscapeSequences: _SpecialEscapeSequencesRule,
+    _CheckWildcardImports: _WildcardImportsRule,
+    _CheckColumnLimit: _ColumnLimitRule,
+    }
+
+def _ColumnLimit(input_api):
+  """Returns the column_limit setting of presubmit.xml, or COLUMN_LIMIT."""
+  return input_api.Config().column_limit or COLUMN_LIMIT
+
+def _ReportErrorFileAndLine(output_api, filename, line_num, msg='',
+    column=None):
   """Default error formatter"""
-  if msg != '':
-    return '%s:%s MSG: %s' % (filename, line_num, msg)
-  else:
-    return '%s:%s' % (filename, line_num)
+  return output_api.PresubmitItem(filename, line_num, msg, column)
 
 def _GenerateWarnings(msg, errors, output_api):
   if errors:
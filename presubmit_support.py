@@ -10,19 +10,115 @@
 TODO(Sean Kirmani): DO NOT SUBMIT without a detailed description of test.
 """
 import sys, os, traceback, optparse
+import bisect
+import collections
+import cProfile
+import cStringIO
+import hashlib
+import heapq
+import imp
+import json
+import marshal
+import mmap
+import multiprocessing
+from multiprocessing import queues
+import subprocess
 import types
 import time
 import re
+import signal
 import xml.etree.ElementTree as ET
 
+try:
+  _scandir = os.scandir
+except AttributeError:
+  try:
+    from scandir import scandir as _scandir
+  except ImportError:
+    _scandir = None
+
+from parsers import java_parser
+
 PRESUBMIT_PREF_FILE = "presubmit.xml"
 PRESUBMIT_PREF_FILE_PATH = os.path.dirname(os.path.realpath(__file__))
 
+# Special values for the diff base of a change-aware run. Any other value is
+# handed to git as a revision (e.g. HEAD~1).
+DIFF_BASE_UPSTREAM = 'upstream'
+DIFF_BASE_INDEX = 'index'
+
+# Actions an AffectedFile can have, as reported by git diff --name-status.
+ACTION_ADDED = 'A'
+ACTION_MODIFIED = 'M'
+ACTION_DELETED = 'D'
+
+# Files at least this many bytes are memory-mapped rather than read.
+MMAP_THRESHOLD = 1 << 20
+
+# Where compiled scripts and check results are cached, relative to the
+# repository root, and how large the result cache may grow.
+DEFAULT_CACHE_DIR = '.presubmit_cache'
+DEFAULT_CACHE_SIZE = 256 << 20
+# How many bytes of file contents a WarmState keeps between runs.
+DEFAULT_WARM_CONTENTS_SIZE = 256 << 20
+# The file in a result cache directory that holds the estimated size of the
+# cache, see ResultCache.Trim.
+_CACHE_SIZE_FILE = 'size'
+
+# Number of the slowest checks, files etc. listed by --timings.
+DEFAULT_TIMINGS_TOP = 10
+
+# Seconds after which code that ran past its time budget is cancelled again,
+# if it caught the first cancellation.
+TIME_BUDGET_RETRY = 1.0
+
+# Seconds between writes of the results workers stream, while waiting for
+# presubmit scripts to finish.
+STREAM_WAIT = 0.1
+
+# The result file each shard of a sharded run writes by default, given the
+# shard index and the number of shards.
+DEFAULT_SHARD_OUTPUT = 'presubmit-shard-%d-of-%d.json'
+_SHARD_OUTPUT_RE = re.compile(r'presubmit-shard-\d+-of-\d+\.json$')
+
 def main():
   global options, args
   # TODO(Sean Kirmani): Do something more interesting here...
-  DoPresubmitChecks(verbose=True, output_stream=sys.stdout,
-      input_stream=sys.stdin, default_presubmit=None, may_prompt=True)
+  if options.merge_shards:
+    try:
+      output = MergeShards(args, sys.stdout, sys.stdin,
+          may_prompt=sys.stdin.isatty())
+    except PresubmitFailure, e:
+      sys.stderr.write('%s\n' % e)
+      sys.exit(1)
+    sys.exit(0 if output.should_continue() else 1)
+  shard = None
+  if options.total_shards:
+    shard = (options.shard_index, options.total_shards)
+    if not options.json_output:
+      options.json_output = DEFAULT_SHARD_OUTPUT % shard
+  json_output = None
+  if options.json_output:
+    json_output = open(options.json_output, 'w')
+  kwargs = dict(verbose=True, output_stream=sys.stdout,
+      input_stream=sys.stdin, default_presubmit=None, may_prompt=True,
+      diff_base=options.diff_base, jobs=options.jobs,
+      cache_dir=options.cache_dir, use_cache=not options.no_cache,
+      stream=options.stream, json_output=json_output,
+      timings=options.timings, changed_lines=options.changed_lines,
+      shard=shard)
+  try:
+    if options.profile:
+      profiler = cProfile.Profile()
+      try:
+        profiler.runcall(DoPresubmitChecks, **kwargs)
+      finally:
+        profiler.dump_stats(options.profile)
+    else:
+      DoPresubmitChecks(**kwargs)
+  finally:
+    if json_output:
+      json_output.close()
 
 class PresubmitFailure(Exception):
   pass
@@ -35,9 +131,17 @@ def normpath(path):
   return os.path.normpath(path)
 
 class PresubmitOutput(object):
-  def __init__(self, input_stream=None, output_stream=None):
+  def __init__(self, input_stream=None, output_stream=None,
+      keep_output=False):
+    """
+    Args:
+      input_stream: A stream to read input from the user.
+      output_stream: A stream to write output to.
+      keep_output: Keep a copy of everything written, for getvalue().
+    """
     self.input_stream = input_stream
     self.output_stream = output_stream
+    self.keep_output = keep_output
     self.written_output = []
     self.error_count = 0
 
@@ -57,22 +161,94 @@ class PresubmitOutput(object):
     return not self.error_count
 
   def write(self, s):
-    self.written_output.append(s)
+    if self.keep_output:
+      self.written_output.append(s)
     if self.output_stream:
       self.output_stream.write(s)
 
   def getvalue(self):
-    return ''.join(self.writting_output)
+    """Returns everything written so far. Requires keep_output."""
+    return ''.join(self.written_output)
+
+class _ResultStreamer(object):
+  """Writes results as soon as they are available, instead of at the end of
+  the run, and counts them for the summary.
+  """
+
+  def __init__(self, output=None, json_output=None):
+    """
+    Args:
+      output: The PresubmitOutput to write results as text to, or None.
+      json_output: A stream to write results as JSON lines to, or None.
+    """
+    self.output = output
+    self.json_output = json_output
+    self.counts = dict((name, 0) for name in _RESULT_KINDS)
+
+  def Write(self, results):
+    """Writes those of results that were not written yet."""
+    for result in results:
+      if result.streamed:
+        continue
+      result.streamed = True
+      kind = _ResultKind(result)
+      self.counts[kind] += 1
+      if self.output:
+        self.output.write('** Presubmit %s **\n' % kind)
+        result.handle(self.output)
+        self.output.write('\n')
+        if self.output.output_stream:
+          self.output.output_stream.flush()
+      if self.json_output:
+        self._WriteJson(result.json_record())
+
+  def WriteSummary(self, elapsed, shard=None):
+    """Writes the number of results of each kind.
+
+    Args:
+      elapsed: Wall time of the whole run, in seconds.
+      shard: The (shard_index, total_shards) of a sharded run, or None.
+    """
+    if self.output:
+      self.output.write('** Presubmit Summary **\n')
+      for name in _RESULT_KINDS:
+        self.output.write('%s: %d\n' % (name, self.counts[name]))
+      self.output.write('\n')
+    if self.json_output:
+      record = {'type': 'summary', 'elapsed': elapsed}
+      if shard:
+        record['shard_index'], record['total_shards'] = shard
+      for name in _RESULT_KINDS:
+        record[_JSON_SEVERITIES[name]] = self.counts[name]
+      self._WriteJson(record)
+
+  def _WriteJson(self, record):
+    self.json_output.write(json.dumps(record, sort_keys=True))
+    self.json_output.write('\n')
+    self.json_output.flush()
 
 class PresubmitExecuter(object):
-  def __init__(self, verbose):
+  def __init__(self, verbose, change=None, result_cache=None,
+      result_sink=None):
+    """
+    Args:
+      verbose: Prints debug info.
+      change: The Change shared by every presubmit script, or None to let each
+        InputApi build its own.
+      result_cache: The ResultCache checks may reuse results from, or None.
+      result_sink: Called with results scripts report through
+        OutputApi.StreamResults, or None.
+    """
     self.verbose = verbose
+    self.change = change
+    self.result_cache = result_cache
+    self.result_sink = result_sink
 
   def ExecPresubmitScript(self, script_text, presubmit_path):
     """Executes a single presubmit script.
 
     Args:
-      script_text: The text of the presubmit script.
+      script_text: The text of the presubmit script, or its code object.
       presubmit_path: The path to the presubmit file (this will be reported via
         input_api.PresubmitLocalPath()).
 
@@ -81,12 +257,30 @@ class PresubmitExecuter(object):
     """
     # Change to the presubmit file's directory to support local imports.
     main_path = os.getcwd()
+    script_start_time = time.time()
     os.chdir(os.path.dirname(presubmit_path))
+    try:
+      # Load the presubmit script into context.
+      # TODO: write InputApi
+      input_api = InputApi(presubmit_path, self.verbose, self.change,
+          self.result_cache)
+      time_budget = input_api.Config().script_time_budget
+      with TimeBudget(time_budget) as budget:
+        result = self._RunPresubmitScript(script_text, presubmit_path,
+            input_api)
+      if budget.expired:
+        result = [_PresubmitTimeout('%s did not finish within its time '
+            'budget of %gs.' % (presubmit_path, time_budget))]
+        _SetResultOrigin(result, presubmit_path, None,
+            time.time() - script_start_time)
+    finally:
+      # Return the process to the original working directory
+      os.chdir(main_path)
+    input_api.timings.Add('script', presubmit_path,
+        time.time() - script_start_time)
+    return result
 
-    # Load the presubmit script into context.
-    # TODO: write InputApi
-    input_api = InputApi(presubmit_path, self.verbose)
-
+  def _RunPresubmitScript(self, script_text, presubmit_path, input_api):
     context = {}
     try:
       exec script_text in context
@@ -94,26 +288,30 @@ class PresubmitExecuter(object):
       raise PresubmitFailure('"%s" has an exception.\n%s' % (presubmit_path, e))
 
     function_name = 'CheckChangeOnUpload'
-    if function_name in context:
-      # TODO: write OutputApi
-      context['__args'] = (input_api, OutputApi())
-      print('Running %s in %s' % (function_name, presubmit_path))
-      result = eval(function_name + '(*__args)', context)
-      print('Running %s done.' % function_name)
-      if not (isinstance(result, types.TupleType) or
-          isinstance(result, types.ListType)):
+    if function_name not in context:
+      return () # no error since the script doesn't care about current event.
+    start_time = time.time()
+    def StreamResults(results):
+      _SetResultOrigin(results, presubmit_path, function_name,
+          time.time() - start_time)
+      self.result_sink(results)
+    # TODO: write OutputApi
+    context['__args'] = (input_api,
+        OutputApi(self.result_sink and StreamResults))
+    print('Running %s in %s' % (function_name, presubmit_path))
+    result = eval(function_name + '(*__args)', context)
+    print('Running %s done.' % function_name)
+    elapsed = time.time() - start_time
+    if not (isinstance(result, types.TupleType) or
+        isinstance(result, types.ListType)):
+      raise PresubmitFailure(
+          'Presubmit functions must return a tuple or list')
+    for item in result:
+      if not isinstance(item, OutputApi.PresubmitResult):
         raise PresubmitFailure(
-            'Presubmit functions must return a tuple or list')
-      for item in result:
-        if not isinstance(item, OutputApi.PresubmitResult):
-          raise PresubmitFailure(
-              'All presubmit results must be of types derived from '
-              'output_api.PresubmitResult')
-    else:
-      result = () # no error since the script doesn't care about current event.
-
-    # Return the process to the original working directory
-    os.chdir(main_path)
+            'All presubmit results must be of types derived from '
+            'output_api.PresubmitResult')
+    _SetResultOrigin(result, presubmit_path, function_name, elapsed)
     return result
 
 
@@ -121,7 +319,18 @@ def DoPresubmitChecks(verbose,
     output_stream,
     input_stream,
     default_presubmit,
-    may_prompt):
+    may_prompt,
+    diff_base=None,
+    jobs=None,
+    cache_dir=None,
+    use_cache=True,
+    stream=False,
+    json_output=None,
+    timings=0,
+    state=None,
+    change=None,
+    changed_lines=False,
+    shard=None):
   """Runs all presubmit checks that apply to the files in the change.
 
   This finds all PRESUBMIT.py files in all directories enclosing the files in
@@ -132,12 +341,42 @@ def DoPresubmitChecks(verbose,
   when needed.
 
   Args:
-    change: The Change object.
     verbose: Prints debug info.
     output_stream: A stream to write output from presubmit tests to.
     input_stream: A stream to read input from the user.
     default_presubmit: A default presubmit script to execute in any case.
     may_prompt: Enable (y/n) questions on warning or error.
+    diff_base: If set, only the files changed against this base are checked.
+      One of DIFF_BASE_UPSTREAM, DIFF_BASE_INDEX or a git revision. Otherwise
+      every file in the tree is treated as affected.
+    jobs: Number of worker processes to run presubmit scripts in, and that
+      checks such as the Java checks run their files in. Results are still
+      reported in the order the scripts were found. Defaults to the jobs
+      setting of presubmit.xml, or 1 for scripts.
+    cache_dir: Directory to cache compiled presubmit scripts and check
+      results in. Defaults to the cache setting of presubmit.xml, or
+      DEFAULT_CACHE_DIR under the repository root.
+    use_cache: If False, nothing is read from or written to cache_dir.
+    stream: Write the results of each script, and of each check that uses
+      OutputApi.StreamResults, as soon as they are available rather than
+      grouped at the end. The end of the run only gets a summary.
+    json_output: A stream to write one JSON record per result to, as soon as
+      each is available, followed by a summary record. None to disable.
+    timings: If not 0, time discovery, each presubmit script, each check, and
+      the reading and parsing of each file, and report this many of the
+      slowest of each.
+    state: A WarmState kept between runs by a long-running process, so that
+      what did not change since the last run is not read again. None to
+      start from scratch.
+    change: The Change to check. By default one is built with BuildChange
+      from diff_base and changed_lines.
+    changed_lines: Only check the lines diff_base reports as added or
+      modified, in the checks that look at lines one by one. Requires
+      diff_base.
+    shard: A (shard_index, total_shards) tuple to check only the slice of the
+      affected files this shard gets, see ShardPaths. The results of every
+      shard are combined by MergeShards from their json_output. None checks
+      every affected file.
 
   Return:
     A PresubmitOutput object. Use output.should_continue() to figure out if
@@ -151,68 +390,761 @@ def DoPresubmitChecks(verbose,
 
     output = PresubmitOutput(input_stream, output_stream)
     start_time = time.time()
-    base_dir = _GetBaseDir()
+    timer = Timings(bool(timings))
+    config = state.Config() if state else LoadConfig()
+    if jobs is not None:
+      # Checks size their own pools from the config.
+      config = config._replace(jobs=jobs)
+    timer.Add('discovery', 'loading %s' % PRESUBMIT_PREF_FILE,
+        time.time() - start_time)
+    step_start_time = time.time()
+    if change is None:
+      change = BuildChange(diff_base, config, timer, state, changed_lines,
+          shard)
+    timer.Add('discovery', 'listing affected files',
+        time.time() - step_start_time)
+    if verbose:
+      output.write("Built change of %d files in %.2fs.\n"
+          % (len(change.AffectedPaths()), time.time() - start_time))
+    deleted_files = change.DeletedFiles()
+    if deleted_files and verbose:
+      output.write("Deleted files (not checked):\n")
+      for f in deleted_files:
+        output.write("  %s\n" % f.LocalPath())
+    base_dir = change.RepositoryRoot()
+    step_start_time = time.time()
     presubmit_files = ListRelevantPresubmitFiles(
-        _AbsoluteLocalPaths(base_dir),
-        base_dir)
+        [path for _, path in change.AffectedPaths()], base_dir)
+    timer.Add('discovery', 'finding presubmit scripts',
+        time.time() - step_start_time)
     if not presubmit_files and verbose:
       output.write("Warning, no PRESUBMIT.py found.\n")
     results = []
-    # TODO: write PresubmitExcecuter
-    executer = PresubmitExecuter(verbose)
+    scripts = []
+    if not use_cache:
+      cache_dir = None
+    elif cache_dir is None:
+      cache_dir = config.cache_dir
+    code_cache = _GetCodeCache(
+        cache_dir and os.path.join(cache_dir, 'code'))
+    result_cache = None
+    if cache_dir and state:
+      result_cache = state.ResultCache(os.path.join(cache_dir, 'results'),
+          config.cache_size)
+    elif cache_dir:
+      result_cache = ResultCache(os.path.join(cache_dir, 'results'),
+          config.cache_size)
+    hits, misses = code_cache.hits, code_cache.misses
+    step_start_time = time.time()
     if default_presubmit:
       if verbose:
         output.write("Running default presubmit script.\n")
       fake_path = os.path.join(base_dir, 'PRESUBMIT.py')
-      results += executer.ExecPresubmitScript(default_presubmit, fake_path)
+      scripts.append((code_cache.CompileText(default_presubmit, fake_path),
+          fake_path))
     for filename in presubmit_files:
       filename = os.path.abspath(filename)
       if verbose:
         output.write("Running %s\n" % filename)
-      #Accept CRLF presubmit script.
-      presubmit_script = file(filename).read()
-      results += executer.ExecPresubmitScript(presubmit_script, filename)
+      scripts.append((code_cache.CompileFile(filename), filename))
+    timer.Add('discovery', 'compiling presubmit scripts',
+        time.time() - step_start_time)
+    if verbose and scripts:
+      output.write("Presubmit script cache: %d hits, %d misses.\n"
+          % (code_cache.hits - hits, code_cache.misses - misses))
+    if jobs is None:
+      jobs = config.jobs or 1
+    streamer = None
+    if stream or json_output:
+      streamer = _ResultStreamer(stream and output, json_output)
+    if stream:
+      output.write('\n')
+    if jobs > 1 and len(scripts) > 1:
+      script_results = _ExecPresubmitScriptsInPool(
+          scripts, verbose, change, result_cache, jobs,
+          streamer and streamer.Write)
+    else:
+      # TODO: write PresubmitExcecuter
+      executer = PresubmitExecuter(verbose, change, result_cache,
+          streamer and streamer.Write)
+      script_results = (executer.ExecPresubmitScript(presubmit_script,
+          filename) for presubmit_script, filename in scripts)
+    for r in script_results:
+      if streamer:
+        streamer.Write(r)
+      if not stream:
+        results += r
+    if result_cache:
+      result_cache.Trim()
+      if verbose:
+        output.write("Result cache: %d hits, %d misses.\n"
+            % (result_cache.hits, result_cache.misses))
 
-    errors = []
-    notifications = []
-    warnings = []
-    for result in results:
-      if result.fatal:
-        errors.append(result)
-      elif result.should_prompt:
-        warnings.append(result)
-      else:
-        notifications.append(result)
+    if streamer:
+      streamer.WriteSummary(time.time() - start_time, shard)
+    if stream:
+      counts = streamer.counts
+    else:
+      counts = _WriteGroupedResults(output, results)
 
-    output.write('\n')
-    for name, items, in (('Messages', notifications),
-        ('Warnings', warnings),
-        ('ERRORS', errors)):
-      if items:
-        output.write('** Presubmit %s **\n' % name)
-        for item in items:
-          item.handle(output)
-          output.write('\n')
+    if timings:
+      timer.Report(output, timings)
 
     total_time = time.time() - start_time
     if total_time > 1.0:
       output.write("Presubmit checks took %.1fs to calculate.\n\n"
           % total_time)
 
-    if not errors:
-      if not warnings:
-        output.write('Presubmit checks passed.\n')
-      elif may_prompt:
-        output.prompt_yes_no('There were presubmit warnings. '
-            'Are you sure you wish to continue? (y/N): ')
-      else:
-        output.fail()
-
+    _WriteVerdict(output, counts, may_prompt)
     return output
     # TODO: finish
   finally:
     os.environ = old_environ
 
+def _WriteGroupedResults(output, results):
+  """Writes results grouped by kind.
+
+  Return:
+    A dict from each of _RESULT_KINDS to the number of results of that kind.
+  """
+  grouped = dict((name, []) for name in _RESULT_KINDS)
+  for result in results:
+    grouped[_ResultKind(result)].append(result)
+
+  output.write('\n')
+  for name in _RESULT_KINDS:
+    if grouped[name]:
+      output.write('** Presubmit %s **\n' % name)
+      for item in grouped[name]:
+        item.handle(output)
+        output.write('\n')
+  return dict((name, len(items)) for name, items in grouped.iteritems())
+
+def _WriteVerdict(output, counts, may_prompt):
+  """Tells whether the checks passed, prompting about warnings if allowed."""
+  if not counts['ERRORS'] and not counts['TIMEOUTS']:
+    if not counts['Warnings']:
+      output.write('Presubmit checks passed.\n')
+    elif may_prompt:
+      output.prompt_yes_no('There were presubmit warnings. '
+          'Are you sure you wish to continue? (y/N): ')
+    else:
+      output.fail()
+
+def MergeShards(paths, output_stream, input_stream, may_prompt):
+  """Combines the results of the shards of a sharded run into one report.
+
+  Args:
+    paths: The result files written by every shard, see DoPresubmitChecks.
+    output_stream: A stream to write the report to.
+    input_stream: A stream to read input from the user.
+    may_prompt: Enable (y/n) questions on warnings.
+
+  Return:
+    A PresubmitOutput object, as returned by DoPresubmitChecks.
+  """
+  output = PresubmitOutput(input_stream, output_stream)
+  results = []
+  # The results of scripts that ran on several shards, such as checks of the
+  # whole change, are only reported once.
+  seen = set()
+  shards = {}
+  for path in paths:
+    summary = None
+    try:
+      with open(path) as f:
+        for line in f:
+          record = json.loads(line)
+          if record['type'] == 'summary':
+            summary = record
+            continue
+          key = json.dumps(dict(record, elapsed=None), sort_keys=True)
+          if key not in seen:
+            seen.add(key)
+            results.append(_ResultFromRecord(record))
+    except (IOError, ValueError, KeyError), e:
+      raise PresubmitFailure('Cannot read the shard results in %s: %s'
+          % (path, e))
+    if summary is None or 'total_shards' not in summary:
+      raise PresubmitFailure('%s is not the result file of a complete shard.'
+          % path)
+    shard = (summary['shard_index'], summary['total_shards'])
+    if shard in shards:
+      raise PresubmitFailure('%s and %s are both results of shard %d of %d.'
+          % ((shards[shard], path) + shard))
+    shards[shard] = path
+  totals = set(total for _, total in shards)
+  if len(totals) > 1:
+    raise PresubmitFailure('The shard results are of runs with different '
+        'numbers of shards: %s.' % ', '.join(str(t) for t in sorted(totals)))
+  for total in totals:
+    missing = [str(index) for index in range(total)
+        if (index, total) not in shards]
+    if missing:
+      raise PresubmitFailure('The results of shard %s of %d are missing.'
+          % (', '.join(missing), total))
+  counts = _WriteGroupedResults(output, results)
+  _WriteVerdict(output, counts, may_prompt)
+  return output
+
+def _ResultFromRecord(record):
+  """Rebuilds a result from the record json_record() made of it."""
+  result_type = _RESULT_TYPES[record['severity']]
+  items = []
+  for item in record['items']:
+    if item['file'] is None:
+      items.append(_Utf8(item['text']))
+    else:
+      items.append(_PresubmitItem(_Utf8(item['file']), item['line'],
+          _Utf8(item['text']), item.get('column')))
+  result = result_type(_Utf8(record['message']), items,
+      _Utf8(record['long_text']))
+  result.presubmit_path = record['presubmit']
+  result.check_name = record['check']
+  result.elapsed = record['elapsed']
+  return result
+
+# The executer and scripts used by each worker process of
+# _ExecPresubmitScriptsInPool. Code objects cannot be pickled, so workers
+# inherit the scripts and are handed indices.
+_worker_executer = None
+_worker_scripts = None
+
+def _InitPresubmitWorker(verbose, change, result_cache, scripts,
+    stream_queue):
+  global _worker_executer, _worker_scripts
+  # Forget what the parent counted before the fork, it reports that itself.
+  if result_cache:
+    result_cache.TakeCounts()
+  change.Timings().Take()
+  result_sink = None
+  if stream_queue:
+    def result_sink(results):
+      stream_queue.put(results)
+      # The parent writes the copies it was sent, so the ones the script
+      # returns are not written again.
+      for result in results:
+        result.streamed = True
+  _worker_executer = PresubmitExecuter(verbose, change, result_cache,
+      result_sink)
+  _worker_scripts = scripts
+
+def _ExecPresubmitScriptInWorker(index):
+  """Runs the script at index of _worker_scripts in a worker process.
+
+  Any exception is turned into a PresubmitFailure naming the script, since
+  arbitrary exceptions may not survive the trip back to the parent process.
+
+  Return:
+    The results of the script, and the result cache counts and timings of the
+    worker.
+  """
+  script_text, presubmit_path = _worker_scripts[index]
+  result_cache = _worker_executer.result_cache
+  try:
+    results = list(_worker_executer.ExecPresubmitScript(script_text,
+        presubmit_path))
+    timings = _worker_executer.change.Timings().Take()
+    if result_cache:
+      return results, result_cache.TakeCounts(), timings
+    return results, (0, 0, 0), timings
+  except PresubmitFailure:
+    raise
+  except Exception:
+    raise PresubmitFailure('"%s" has an exception.\n%s'
+        % (presubmit_path, traceback.format_exc()))
+
+def WaitForPoolResults(pool, pool_results, wait, on_wait=None):
+  """Yields each result of an imap over pool as it arrives.
+
+  A worker process that dies takes the task it was running with it, and the
+  wait for that result would never end. The pool replaces dead workers, so a
+  change in its workers raises PresubmitFailure instead.
+
+  Args:
+    pool: The multiprocessing.Pool.
+    pool_results: The iterator pool.imap returned.
+    wait: Seconds to wait for a result at a time.
+    on_wait: Called whenever no result arrived within wait, or None.
+  """
+  workers = set(worker.pid for worker in pool._pool)
+  while True:
+    try:
+      result = pool_results.next(wait)
+    except multiprocessing.TimeoutError:
+      if on_wait:
+        on_wait()
+      if (set(worker.pid for worker in pool._pool) != workers or
+          any(worker.exitcode is not None for worker in pool._pool)):
+        raise PresubmitFailure('A worker process died before it was done.')
+      continue
+    except StopIteration:
+      return
+    yield result
+
+def _ExecPresubmitScriptsInPool(scripts, verbose, change, result_cache, jobs,
+    result_sink=None):
+  """Runs presubmit scripts in a pool of worker processes.
+
+  Each worker changes directory on its own, so scripts cannot step on each
+  other's working directory the way threads would.
+
+  Results that scripts stream are sent to the parent through a SimpleQueue,
+  which writes to its pipe before put returns. Everything a script streamed
+  is therefore passed to result_sink before its results are yielded.
+
+  Args:
+    scripts: List of (script_text or code, presubmit_path) tuples.
+    verbose: Prints debug info.
+    change: The Change shared by every script. Workers inherit it, and their
+      timings are merged into its Timings.
+    result_cache: The ResultCache, or None. Worker counts are added to it.
+    jobs: Number of worker processes.
+    result_sink: Called in this process with results scripts report through
+      OutputApi.StreamResults, or None.
+
+  Return:
+    A generator of the results of each script, in the order of scripts. The
+    results of a script are yielded as soon as it and the ones before it are
+    done.
+  """
+  stream_queue = result_sink and queues.SimpleQueue()
+  def WriteStreamed():
+    while stream_queue and not stream_queue.empty():
+      result_sink(stream_queue.get())
+  pool = multiprocessing.Pool(min(jobs, len(scripts)),
+      _InitPresubmitWorker,
+      (verbose, change, result_cache, scripts, stream_queue))
+  try:
+    pool_results = pool.imap(_ExecPresubmitScriptInWorker, range(len(scripts)))
+    for results, counts, timings in WaitForPoolResults(pool, pool_results,
+        STREAM_WAIT, WriteStreamed):
+      WriteStreamed()
+      if result_cache:
+        result_cache.AddCounts(*counts)
+      change.Timings().Merge(timings)
+      yield results
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+class CodeCache(object):
+  """Caches the compiled code of presubmit scripts.
+
+  Code is kept in memory, and optionally on disk, under the same key: a hash
+  of the path, mtime and contents of the script. Scripts are read on every
+  call so that the key is checked against their contents, and unchanged
+  scripts are compiled once.
+  """
+
+  def __init__(self, cache_dir=None):
+    """
+    Args:
+      cache_dir: Directory to also store compiled code in, or None to only
+        cache in memory.
+    """
+    self._cache_dir = cache_dir
+    self._memory = {}
+    self.hits = 0
+    self.misses = 0
+
+  def CompileFile(self, filename):
+    """Returns the code object of the script at filename."""
+    # Accept CRLF presubmit script.
+    with open(filename, 'rU') as f:
+      mtime = os.fstat(f.fileno()).st_mtime
+      script_text = f.read()
+    return self._Compile(script_text, filename, mtime)
+
+  def CompileText(self, script_text, filename):
+    """Returns the code object of script_text, reported as filename."""
+    return self._Compile(script_text, filename, None)
+
+  def _Compile(self, script_text, filename, mtime):
+    digest = hashlib.sha1('\0'.join((imp.get_magic(), filename, repr(mtime),
+        script_text))).hexdigest()
+    if digest in self._memory:
+      self.hits += 1
+      return self._memory[digest]
+    code = self._ReadDiskCache(digest)
+    if code is None:
+      self.misses += 1
+      code = compile(script_text, filename, 'exec')
+      self._WriteDiskCache(digest, code)
+    else:
+      self.hits += 1
+    self._memory[digest] = code
+    return code
+
+  def _DiskCachePath(self, digest):
+    return os.path.join(self._cache_dir, digest + '.code')
+
+  def _ReadDiskCache(self, digest):
+    if not self._cache_dir:
+      return None
+    try:
+      with open(self._DiskCachePath(digest), 'rb') as f:
+        return marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+      return None
+
+  def _WriteDiskCache(self, digest, code):
+    """Stores code on disk. Failures are ignored, the cache is optional."""
+    if not self._cache_dir:
+      return
+    path = self._DiskCachePath(digest)
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+      if not os.path.isdir(self._cache_dir):
+        os.makedirs(self._cache_dir)
+      with open(temp_path, 'wb') as f:
+        marshal.dump(code, f)
+      os.rename(temp_path, path)
+    except (IOError, OSError):
+      pass
+
+# The CodeCache of each cache directory, kept for the life of the process.
+_code_caches = {}
+
+def _GetCodeCache(cache_dir):
+  if cache_dir is not None:
+    cache_dir = os.path.abspath(cache_dir)
+  if cache_dir not in _code_caches:
+    _code_caches[cache_dir] = CodeCache(cache_dir)
+  return _code_caches[cache_dir]
+
+class ResultCache(object):
+  """Caches the results a check produced for a file, on disk.
+
+  Entries are keyed by whatever the check considers relevant, typically the
+  content hash of the file, the name and version of the check and the
+  settings it depends on. Least recently used entries are evicted once the
+  cache grows past its maximum size.
+  """
+
+  def __init__(self, cache_dir, max_size=DEFAULT_CACHE_SIZE):
+    self._cache_dir = cache_dir
+    self._max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    # Bytes written since the last Trim.
+    self.written = 0
+
+  def _EntryPath(self, key):
+    digest = hashlib.sha1(repr(key)).hexdigest()
+    return os.path.join(self._cache_dir, digest[:2], digest)
+
+  def Get(self, key, output_api):
+    """Returns the cached results for key, or None.
+
+    Args:
+      key: A tuple of str, unicode and number values.
+      output_api: The OutputApi to rebuild the results with.
+    """
+    path = self._EntryPath(key)
+    try:
+      with open(path, 'rb') as f:
+        entries = marshal.load(f)
+      # Mark the entry as recently used.
+      os.utime(path, None)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+      self.misses += 1
+      return None
+    self.hits += 1
+    results = []
+    for entry in entries:
+      if entry['fatal']:
+        result_type = output_api.PresubmitError
+      elif entry['should_prompt']:
+        result_type = output_api.PresubmitPromptWarning
+      else:
+        result_type = output_api.PresubmitResult
+      items = [output_api.PresubmitItem(item['file'], item['line'],
+          item['text'], item.get('column')) if isinstance(item, dict) else item
+          for item in entry['items']]
+      results.append(result_type(entry['message'], items,
+          entry['long_text']))
+    return results
+
+  def Put(self, key, results):
+    """Stores results under key. Failures are ignored, the cache is optional.
+    """
+    path = self._EntryPath(key)
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+      entries = [r.json_format() for r in results]
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      with open(temp_path, 'wb') as f:
+        marshal.dump(entries, f)
+        self.written += f.tell()
+      os.rename(temp_path, path)
+    except (IOError, OSError, ValueError):
+      pass
+
+  def TakeCounts(self):
+    """Returns (hits, misses, written) and resets them, e.g. in a worker
+    process.
+    """
+    counts = (self.hits, self.misses, self.written)
+    self.hits = self.misses = self.written = 0
+    return counts
+
+  def AddCounts(self, hits, misses, written):
+    self.hits += hits
+    self.misses += misses
+    self.written += written
+
+  def Trim(self):
+    """Evicts the least recently used entries if the cache may have grown past
+    its maximum size.
+
+    The size of the cache is kept in _CACHE_SIZE_FILE as of when it was last
+    measured, plus what was written since, so the cache is only walked when
+    that estimate is missing or over the maximum. Entries written again count
+    twice, so the estimate errs high; runs writing at the same time may lose
+    some of each other's bytes until the next walk.
+    """
+    written, self.written = self.written, 0
+    if not written:
+      return
+    size_path = os.path.join(self._cache_dir, _CACHE_SIZE_FILE)
+    try:
+      with open(size_path) as f:
+        total_size = int(f.read()) + written
+    except (IOError, OSError, ValueError):
+      total_size = None
+    if total_size is None or total_size > self._max_size:
+      total_size = self._Evict()
+    temp_path = '%s.%d.tmp' % (size_path, os.getpid())
+    try:
+      with open(temp_path, 'w') as f:
+        f.write('%d\n' % total_size)
+      os.rename(temp_path, size_path)
+    except (IOError, OSError):
+      pass
+
+  def _Evict(self):
+    """Evicts the least recently used entries until under the maximum size.
+
+    Return:
+      The size of the entries left.
+    """
+    entries = []
+    total_size = 0
+    for root, _, files in os.walk(self._cache_dir):
+      for name in files:
+        if root == self._cache_dir and name.startswith(_CACHE_SIZE_FILE):
+          continue
+        path = os.path.join(root, name)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total_size += st.st_size
+    if total_size <= self._max_size:
+      return total_size
+    for _, size, path in sorted(entries):
+      try:
+        os.remove(path)
+      except OSError:
+        continue
+      total_size -= size
+      if total_size <= self._max_size:
+        break
+    return total_size
+
+# The kinds of Timings entries, in the order they are reported, and their
+# titles.
+_TIMING_CATEGORIES = (
+    ('discovery', 'Discovery'),
+    ('script', 'Slowest presubmit scripts'),
+    ('check', 'Slowest checks'),
+    ('file', 'Slowest files to check'),
+    ('read', 'Slowest file reads'),
+    ('parse', 'Slowest file parses'),
+    )
+
+class Timings(object):
+  """Wall time spent in each part of a run, for --timings.
+
+  Entries are keyed by a category of _TIMING_CATEGORIES and a name, such as
+  ('check', '_CheckColumnLimit'), and add up the time and number of calls.
+  When disabled, nothing is recorded, so callers need not check.
+  """
+
+  def __init__(self, enabled=True):
+    self.enabled = enabled
+    # (category, name) -> [seconds, calls]
+    self._entries = {}
+
+  def Add(self, category, name, elapsed):
+    """Adds elapsed seconds spent on name."""
+    if not self.enabled:
+      return
+    entry = self._entries.get((category, name))
+    if entry is None:
+      self._entries[(category, name)] = [elapsed, 1]
+    else:
+      entry[0] += elapsed
+      entry[1] += 1
+
+  def Take(self):
+    """Returns the entries and resets them, e.g. in a worker process."""
+    entries = self._entries
+    self._entries = {}
+    return entries
+
+  def Merge(self, entries):
+    """Adds entries returned by Take() of another Timings."""
+    for key, (elapsed, calls) in entries.iteritems():
+      entry = self._entries.get(key)
+      if entry is None:
+        self._entries[key] = [elapsed, calls]
+      else:
+        entry[0] += elapsed
+        entry[1] += calls
+
+  def Report(self, output, top=DEFAULT_TIMINGS_TOP):
+    """Writes the slowest top entries of each category to output."""
+    output.write('** Presubmit Timings **\n')
+    for category, title in _TIMING_CATEGORIES:
+      entries = sorted(((elapsed, calls, name)
+          for (c, name), (elapsed, calls) in self._entries.iteritems()
+          if c == category), reverse=True)
+      if not entries:
+        continue
+      output.write('%s:\n' % title)
+      for elapsed, calls, name in entries[:top]:
+        output.write('  %9.3fs %6dx  %s\n' % (elapsed, calls, name))
+    output.write('\n')
+
+# The Timings of files that are not timed. Shared, as it never records
+# anything.
+_NO_TIMINGS = Timings(enabled=False)
+
+class _TimeBudgetExpired(BaseException):
+  """Raised in code that ran past its TimeBudget.
+
+  Derives from BaseException so that except Exception clauses in checks do
+  not swallow it.
+  """
+
+  def __init__(self, budget):
+    BaseException.__init__(self, budget.seconds)
+    self.budget = budget
+
+class TimeBudget(object):
+  """Cancels the code run under it once it runs past a wall-clock budget.
+
+    with input_api.TimeBudget(10) as budget:
+      results = SlowCheck()
+    if budget.expired:
+      ...
+
+  The code is cancelled by raising an exception in it from a SIGALRM handler,
+  which the with statement stops. Code that catches the exception anyway is
+  cancelled again every TIME_BUDGET_RETRY seconds. Budgets nest; an outer
+  budget that runs out cancels the code under the inner ones too.
+
+  Budgets are only enforced in the main thread of a process, on platforms
+  with SIGALRM. Code stuck in one call into C, such as a single regex match,
+  is only cancelled once that call returns.
+  """
+  # The budgets being enforced, outermost first, and the process they were
+  # entered in. Forked workers do not run the with statements of their parent,
+  # so they start with none.
+  _active = []
+  _active_pid = None
+  _previous_handler = None
+
+  def __init__(self, seconds):
+    """
+    Args:
+      seconds: The budget, or None for no budget.
+    """
+    self.seconds = seconds
+    self.expired = False
+    self._deadline = None
+    self._exiting = False
+
+  def __enter__(self):
+    if self.seconds is None or not hasattr(signal, 'setitimer'):
+      return self
+    active = TimeBudget._Active()
+    if not active:
+      try:
+        TimeBudget._previous_handler = signal.signal(signal.SIGALRM,
+            TimeBudget._Expire)
+      except ValueError:
+        # Not the main thread.
+        return self
+    self._deadline = time.time() + self.seconds
+    self._exiting = False
+    active.append(self)
+    TimeBudget._Arm()
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    if self._deadline is None or TimeBudget._active_pid != os.getpid():
+      return False
+    # Before anything else, so that the handler cannot raise out of here: it
+    # skips a budget being exited, and the timer is stopped until this budget
+    # is off the stack.
+    self._exiting = True
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    active = TimeBudget._active
+    if self in active:
+      # Inner budgets that an exception skipped the exit of go with it.
+      del active[active.index(self):]
+    if active:
+      TimeBudget._Arm()
+    else:
+      signal.signal(signal.SIGALRM, TimeBudget._previous_handler)
+    return (isinstance(exc_value, _TimeBudgetExpired) and
+        exc_value.budget is self)
+
+  @staticmethod
+  def _Active():
+    if TimeBudget._active_pid != os.getpid():
+      TimeBudget._active = []
+      TimeBudget._active_pid = os.getpid()
+    return TimeBudget._active
+
+  @staticmethod
+  def _Arm():
+    """Sets the timer to go off at the first deadline."""
+    deadlines = [budget._deadline for budget in TimeBudget._Active()]
+    if deadlines:
+      signal.setitimer(signal.ITIMER_REAL,
+          max(min(deadlines) - time.time(), 0.001))
+
+  @staticmethod
+  def _Expire(signum, frame):
+    if frame is not None and frame.f_code in _TIME_BUDGET_CODES:
+      # Raising in here would escape the with statement, e.g. when the timer
+      # went off before __exit__ got to stop it. Try again shortly, once it
+      # is done.
+      TimeBudget._Arm()
+      return
+    now = time.time()
+    for budget in TimeBudget._Active():
+      if budget._deadline <= now and not budget._exiting:
+        budget.expired = True
+        budget._deadline = now + TIME_BUDGET_RETRY
+        TimeBudget._Arm()
+        raise _TimeBudgetExpired(budget)
+    TimeBudget._Arm()
+
+# The code of TimeBudget that runs outside the with statements it manages.
+_TIME_BUDGET_CODES = frozenset([TimeBudget.__enter__.im_func.func_code,
+    TimeBudget.__exit__.im_func.func_code, TimeBudget._Active.func_code,
+    TimeBudget._Arm.func_code])
+
 def ListRelevantPresubmitFiles(files, root):
   """Finds all presubmit files that apply to a given set of source files.
 
@@ -243,50 +1175,384 @@ def ListRelevantPresubmitFiles(files, root):
         break
       directory = parent_dir
 
-    # Look for PRESUBMIT.py in all candidate directories.
-    results = []
-    for directory in sorted(list(candidates)):
-      p = os.path.join(directory, 'PRESUBMIT.py')
-      if os.path.isfile(p):
-        results.append(p)
+  # Look for PRESUBMIT.py in all candidate directories.
+  results = []
+  for directory in sorted(list(candidates)):
+    p = os.path.join(directory, 'PRESUBMIT.py')
+    if os.path.isfile(p):
+      results.append(p)
 
-    print('Presubmit files: %s' % ','.join(results))
-    return results;
+  print('Presubmit files: %s' % ','.join(results))
+  return results;
 
-def _AbsoluteLocalPaths(root):
+def _AbsoluteLocalPaths(root, config=None):
   """Finds all files in given source directroy with absolute path.
 
   Args:
     root: Path to find enclosing files.
+    config: The PresubmitConfig whose exclude settings apply, or None.
 
   Return:
-    List of absolute paths of all enclosing files.
+    A generator of the absolute paths of all enclosing files, see _LocalPaths.
   """
-  results = []
-  for r, dirs, files in os.walk(root):
-    for f in files:
-      results.append(os.path.join(r, f))
-  return results
+  for path in _LocalPaths(root, config):
+    yield os.path.join(root, path)
 
-def _LocalPaths(root):
+def _LocalPaths(root, config=None, state=None):
   """Finds all files in given source directroy.
 
+  Directories are pruned as soon as they are found to be excluded, so
+  nothing below them is listed. Excluded are .git, the cache directory, and
+  whatever .gitignore files and the exclude patterns of config match.
+
   Args:
     root: Path to find enclosing files.
+    config: The PresubmitConfig whose exclude settings apply, or None.
+    state: The WarmState to reuse the listings of unchanged directories from,
+      or None.
 
   Return:
-    List of absolute paths of all enclosing files.
+    A generator of the paths of all enclosing files, relative to root. The
+    tree is walked as the paths are consumed.
+  """
+  list_dir = state.ListDir if state else _ListDir
+  root = os.path.abspath(root)
+  pruned = set([os.path.join(root, '.git')])
+  excludes = None
+  use_gitignore = True
+  if config:
+    pruned.add(os.path.abspath(config.cache_dir))
+    if config.exclude:
+      excludes = _IgnoreRules('', config.exclude)
+    use_gitignore = config.use_gitignore
+  rules = []
+  if use_gitignore:
+    rules.append(_IgnoreRules.FromFile('',
+        os.path.join(root, '.git', 'info', 'exclude')))
+  # (absolute path, path relative to root with a trailing slash, rules)
+  stack = [(root, '', rules)]
+  while stack:
+    directory, local_dir, rules = stack.pop()
+    try:
+      entries = list(list_dir(directory))
+    except OSError:
+      continue
+    if use_gitignore:
+      for entry in entries:
+        if entry.name == '.gitignore' and not entry.is_dir():
+          rules = rules + [_IgnoreRules.FromFile(local_dir, entry.path)]
+          break
+    subdirs = []
+    for entry in entries:
+      path = local_dir + entry.name
+      is_dir = entry.is_dir()
+      if _IsIgnored(rules, excludes, path, entry.name, is_dir):
+        continue
+      if not is_dir:
+        yield path
+      elif not entry.is_symlink() and entry.path not in pruned:
+        subdirs.append((entry.path, path + '/', rules))
+    # Files come before the directories next to them, like with os.walk.
+    stack.extend(reversed(subdirs))
+
+def _IsIgnored(rules, excludes, path, name, is_dir):
+  """Whether the gitignore rules or the excludes of presubmit.xml match path.
+  """
+  ignored = False
+  for r in rules:
+    match = r.Match(path, name, is_dir)
+    if match is not None:
+      ignored = match
+  if ignored:
+    return True
+  return bool(excludes and excludes.Match(path, name, is_dir))
+
+class _DirEntry(object):
+  """The part of os.scandir entries _LocalPaths uses, for when scandir is not
+  available.
   """
+
+  def __init__(self, directory, name, is_dir=None, is_symlink=None):
+    self.name = name
+    self.path = os.path.join(directory, name)
+    self._is_dir = is_dir
+    self._is_symlink = is_symlink
+
+  def is_dir(self):
+    if self._is_dir is None:
+      self._is_dir = os.path.isdir(self.path)
+    return self._is_dir
+
+  def is_symlink(self):
+    if self._is_symlink is None:
+      self._is_symlink = os.path.islink(self.path)
+    return self._is_symlink
+
+def _ListDir(directory):
+  """Returns the entries of directory. With scandir, telling files from
+  directories needs no stat calls on most file systems.
+  """
+  if _scandir:
+    return _scandir(directory)
+  return [_DirEntry(directory, name) for name in os.listdir(directory)]
+
+class _IgnoreRules(object):
+  """Patterns in .gitignore syntax, which apply below one directory.
+
+  Supported are comments, !negation, a trailing / for directories only, a
+  leading or inner / to anchor to the directory, and the *, ?, [...] and **
+  wildcards.
+  """
+
+  def __init__(self, local_dir, patterns):
+    """
+    Args:
+      local_dir: The directory the patterns are relative to, relative to the
+        repository root, with a trailing slash. Empty for the root.
+      patterns: The lines of a .gitignore file.
+    """
+    self._local_dir = local_dir
+    # (regex, negate, dir_only, anchored)
+    self._rules = []
+    for pattern in patterns:
+      pattern = pattern.rstrip('\r\n')
+      if pattern.endswith(' ') and not pattern.endswith('\\ '):
+        pattern = pattern.rstrip(' ')
+      if not pattern or pattern.startswith('#'):
+        continue
+      negate = pattern.startswith('!')
+      if negate:
+        pattern = pattern[1:]
+      elif pattern.startswith('\\'):
+        pattern = pattern[1:]
+      dir_only = pattern.endswith('/')
+      pattern = pattern.rstrip('/')
+      if not pattern:
+        continue
+      anchored = '/' in pattern
+      self._rules.append((re.compile(_GlobToRegex(pattern.lstrip('/'))),
+          negate, dir_only, anchored))
+
+  @classmethod
+  def FromFile(cls, local_dir, path):
+    """Reads the rules of the .gitignore file at path. Missing files have
+    none.
+    """
+    try:
+      with open(path, 'rU') as f:
+        return cls(local_dir, f.readlines())
+    except IOError:
+      return cls(local_dir, [])
+
+  def Match(self, path, name, is_dir):
+    """Tells whether path is ignored.
+
+    Args:
+      path: A path relative to the repository root, without a trailing slash.
+      name: The last component of path.
+      is_dir: Whether path is a directory.
+
+    Return:
+      True if the last matching rule ignores path, False if it re-includes
+      it, and None if no rule matches or path is not below the directory.
+    """
+    if not path.startswith(self._local_dir):
+      return None
+    path = path[len(self._local_dir):]
+    result = None
+    for regex, negate, dir_only, anchored in self._rules:
+      if dir_only and not is_dir:
+        continue
+      if regex.match(path if anchored else name):
+        result = not negate
+    return result
+
+  def MatchPath(self, path):
+    """Tells whether a file at path, or a directory above it, is ignored."""
+    parts = path.split('/')
+    for index in xrange(1, len(parts) + 1):
+      if self.Match('/'.join(parts[:index]), parts[index - 1],
+          index < len(parts)):
+        return True
+    return False
+
+def _GlobToRegex(pattern):
+  """Translates a .gitignore glob into a regex matching a whole path."""
+  regex = []
+  index = 0
+  while index < len(pattern):
+    c = pattern[index]
+    if pattern.startswith('**/', index):
+      regex.append('(?:.*/)?')
+      index += 3
+      continue
+    if pattern.startswith('**', index):
+      regex.append('.*')
+      index += 2
+      continue
+    if c == '*':
+      regex.append('[^/]*')
+    elif c == '?':
+      regex.append('[^/]')
+    elif c == '[':
+      end = pattern.find(']', index + 2)
+      if end == -1:
+        regex.append(re.escape(c))
+      else:
+        chars = pattern[index + 1:end]
+        if chars.startswith('!'):
+          chars = '^' + chars[1:]
+        regex.append('[%s]' % chars.replace('\\', '\\\\'))
+        index = end
+    elif c == '\\' and index + 1 < len(pattern):
+      index += 1
+      regex.append(re.escape(pattern[index]))
+    else:
+      regex.append(re.escape(c))
+    index += 1
+  return ''.join(regex) + '$'
+
+def _GitDiffCommand(diff_base, *args):
+  """Returns the git diff command line that compares the tree to diff_base."""
+  command = ['git', 'diff', '--no-color', '--no-ext-diff', '--no-renames',
+      '--relative'] + list(args)
+  if diff_base == DIFF_BASE_INDEX:
+    command.append('--cached')
+  elif diff_base == DIFF_BASE_UPSTREAM:
+    command.append('@{upstream}')
+  else:
+    command.append(diff_base)
+  command.append('--')
+  return command
+
+def _GitDiff(root, diff_base, *args):
+  try:
+    return subprocess.check_output(_GitDiffCommand(diff_base, *args),
+        cwd=root)
+  except (OSError, subprocess.CalledProcessError), e:
+    raise PresubmitFailure('Could not diff against "%s".\n%s' % (diff_base, e))
+
+def _GitAffectedPaths(root, diff_base):
+  """Finds the files changed against a base with git diff --name-status -z,
+  which gives the paths as they are rather than quoted.
+
+  Renames are reported as a deletion plus an addition. Untracked files are not
+  part of the diff and are therefore not affected.
+
+  Args:
+    root: Path of the repository root. Paths are reported relative to it.
+    diff_base: DIFF_BASE_UPSTREAM to diff against the upstream branch,
+      DIFF_BASE_INDEX to diff the staged changes, or any git revision.
+
+  Return:
+    List of (action, path) tuples where action is one of ACTION_ADDED,
+    ACTION_MODIFIED or ACTION_DELETED.
+  """
+  fields = _GitDiff(root, diff_base, '--name-status', '-z').split('\0')
   results = []
-  for r, dirs, files in os.walk(root):
-    for f in files:
-      results.append(os.path.join(os.path.relpath(r, root), f))
+  # Each file is a status field followed by a path field.
+  for status, path in zip(fields[0::2], fields[1::2]):
+    action = status[0]
+    if action not in (ACTION_ADDED, ACTION_DELETED):
+      # Type changes and unmerged paths are checked like modifications.
+      action = ACTION_MODIFIED
+    results.append((action, path))
+  return results
+
+# The new side of a diff hunk header: @@ -a,b +c,d @@
+_HUNK_RE = re.compile(r'^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@')
+
+def _GitChangedLines(root, diff_base):
+  """Finds the lines added or modified against a base, from the hunks of
+  git diff -U0.
+
+  Args:
+    root: Path of the repository root. Paths are reported relative to it.
+    diff_base: See _GitAffectedPaths.
+
+  Return:
+    A dict from the normalized path of each added or modified file to the
+    sorted list of its changed line numbers, 1-based.
+  """
+  diff = _GitDiff(root, diff_base, '-U0', '--src-prefix=a/',
+      '--dst-prefix=b/')
+  results = {}
+  lines = None
+  for line in diff.splitlines():
+    if line.startswith('+++ '):
+      path = line[4:]
+      if path.endswith('\t'):
+        # git ends the names that contain a space with a tab.
+        path = path[:-1]
+      if path.startswith('"'):
+        path = path[1:-1].decode('string_escape')
+      if path.startswith('b/'):
+        lines = results.setdefault(normpath(path[2:]), [])
+      else:
+        # /dev/null, the file was deleted.
+        lines = None
+    elif line.startswith('@@') and lines is not None:
+      match = _HUNK_RE.match(line)
+      if match:
+        start = int(match.group(1))
+        count = int(match.group(2) or 1)
+        lines.extend(xrange(start, start + count))
   return results
 
+def _JsonText(s):
+  """Returns s as unicode, so that json can encode any bytes read from files.
+  """
+  if isinstance(s, str):
+    return s.decode('utf-8', 'replace')
+  return s
+
+def _Utf8(s):
+  """Returns text read back from JSON as the bytes checks report."""
+  if isinstance(s, unicode):
+    return s.encode('utf-8')
+  return s
+
+class _PresubmitItem(object):
+  """Where a problem was found: a line of a file, and what is wrong with it.
+  """
+
+  def __init__(self, filename, line, text='', column=None):
+    """
+    Args:
+      filename: The local path of the file.
+      line: The 1-based line number.
+      text: A short description of the problem, may be empty.
+      column: The 1-based column in the line, if known.
+    """
+    self.file = filename
+    self.line = line
+    self.text = text
+    self.column = column
+
+  def __str__(self):
+    location = '%s:%s' % (self.file, self.line)
+    if self.column is not None:
+      location += ':%s' % self.column
+    if self.text != '':
+      return '%s MSG: %s' % (location, self.text)
+    return location
+
+  def json_format(self):
+    """Returns the item as a dict of plain values."""
+    return {'file': self.file, 'line': self.line, 'text': self.text,
+        'column': self.column}
+
 class _PresubmitResult(object):
   """Base class for result objects."""
   fatal = False
   should_prompt = False
+  # Set once a streaming run has written the result.
+  streamed = False
+  # Where the result came from and how long it took, set by the framework
+  # unless the check that made the result set them already.
+  presubmit_path = None
+  check_name = None
+  elapsed = None
 
   def __init__(self, message, items=None, long_text=''):
     """
@@ -300,6 +1566,38 @@ class _PresubmitResult(object):
       self._items = items
     self._long_text = long_text.rstrip()
 
+  def json_format(self):
+    """Returns the result as a dict of plain values."""
+    return {
+        'message': self._message,
+        'items': [item.json_format() if isinstance(item, _PresubmitItem)
+            else str(item) for item in self._items],
+        'long_text': self._long_text,
+        'fatal': self.fatal,
+        'should_prompt': self.should_prompt,
+        }
+
+  def json_record(self):
+    """Returns the record written for the result by --json-output."""
+    items = []
+    for item in self._items:
+      if isinstance(item, _PresubmitItem):
+        items.append({'file': item.file, 'line': item.line,
+            'column': item.column, 'text': _JsonText(item.text)})
+      else:
+        items.append({'file': None, 'line': None, 'column': None,
+            'text': _JsonText(str(item))})
+    return {
+        'type': 'result',
+        'severity': _JSON_SEVERITIES[_ResultKind(self)],
+        'message': _JsonText(self._message),
+        'items': items,
+        'long_text': _JsonText(self._long_text),
+        'presubmit': self.presubmit_path,
+        'check': self.check_name,
+        'elapsed': self.elapsed,
+        }
+
   def handle(self, output):
     output.write(self._message)
     output.write('\n')
@@ -326,6 +1624,48 @@ class _PresubmitPromptWarning(_PresubmitResult):
   """A warning that prompts the user if they want to continue."""
   should_prompt = True
 
+class _PresubmitTimeout(_PresubmitError):
+  """A presubmit script or check that was cancelled for running past its time
+  budget. Its items name the files it did not finish."""
+
+# The kinds of results, in the order they are reported.
+_RESULT_KINDS = ('Messages', 'Warnings', 'ERRORS', 'TIMEOUTS')
+
+# The severity of each kind of result in --json-output records.
+_JSON_SEVERITIES = {
+    'Messages': 'notification',
+    'Warnings': 'prompt_warning',
+    'ERRORS': 'error',
+    'TIMEOUTS': 'timeout',
+    }
+
+# The result type of each severity of --json-output records.
+_RESULT_TYPES = {
+    'notification': _PresubmitResult,
+    'prompt_warning': _PresubmitPromptWarning,
+    'error': _PresubmitError,
+    'timeout': _PresubmitTimeout,
+    }
+
+def _ResultKind(result):
+  if isinstance(result, _PresubmitTimeout):
+    return 'TIMEOUTS'
+  if result.fatal:
+    return 'ERRORS'
+  if result.should_prompt:
+    return 'Warnings'
+  return 'Messages'
+
+def _SetResultOrigin(results, presubmit_path, check_name, elapsed):
+  """Records where results came from, unless they know it already."""
+  for result in results:
+    if result.presubmit_path is None:
+      result.presubmit_path = presubmit_path
+    if result.check_name is None:
+      result.check_name = check_name
+    if result.elapsed is None:
+      result.elapsed = elapsed
+
 class OutputApi(object):
   """An instance of OutputApi gets passed to presubmit scripts so that they can
   output various types of results.
@@ -333,45 +1673,634 @@ class OutputApi(object):
   PresubmitResult = _PresubmitResult
   PresubmitError = _PresubmitError
   PresubmitPromptWarning = _PresubmitPromptWarning
+  PresubmitTimeout = _PresubmitTimeout
+  PresubmitItem = _PresubmitItem
+
+  def __init__(self, result_sink=None):
+    """
+    Args:
+      result_sink: Called with the results passed to StreamResults, or None.
+    """
+    self._result_sink = result_sink
+
+  def StreamResults(self, results):
+    """Reports results before the presubmit function returns, if the run is
+    streaming. The results must still be returned by the presubmit function;
+    they are not reported twice.
+    """
+    if self._result_sink:
+      self._result_sink(results)
 
 class InputApi(object):
   """An instance of this object is passed to presubmit scripts so they can know
   stuff about the change they're looking at.
   """
-  DEFAULT_WHITE_LIST = ()
-  DEFAULT_BLACK_LIST = ()
-
-  def __init__(self, presubmit_path, verbose):
+  # Regexes of the local paths of source files, see AffectedSourceFiles.
+  DEFAULT_WHITE_LIST = (
+      r'.+\.java$',
+      r'.+\.py$',
+      )
+  # Regexes of the local paths of files that are never checked as source,
+  # such as code of other projects.
+  DEFAULT_BLACK_LIST = (
+      r'(|.*/)third_party/.*',
+      r'(|.*/)\.git/.*',
+      )
+  TimeBudget = TimeBudget
+  WaitForPoolResults = staticmethod(WaitForPoolResults)
+
+  def __init__(self, presubmit_path, verbose, change=None, result_cache=None):
     """Builds an InputApi object.
 
     Args:
       presubmit_path: The path to the presubmit script being processed.
+      verbose: Prints debug info.
+      change: The Change being checked. If None, one is built for the whole
+        tree.
+      result_cache: The ResultCache checks may reuse results from, or None.
     """
+    if change is None:
+      change = BuildChange()
+    self.change = change
+    self._repository_root = change.RepositoryRoot()
     # The local path of the currently-being-processed presubmit script.
-    self._repository_root = _GetBaseDir()
     self._current_presubmit_path = os.path.dirname(presubmit_path)
-    self._local_paths = _LocalPaths(self._repository_root)
-    self._license = _GetLicense()
     self.verbose = verbose
+    self.result_cache = result_cache
+    # The Timings checks add their own entries to.
+    self.timings = change.Timings()
 
   def GetAffectedFiles(self):
-    return [AffectedFile(f, self._repository_root) for f in self._local_paths]
+    """Returns a list of the added and modified files in the change. The
+    list is the caller's own; the AffectedFile objects are shared by every
+    script.
+    """
+    return list(self.change.AffectedFiles())
+
+  def AffectedFiles(self, file_filter=None, include=None, exclude=None):
+    """Returns the added and modified files in the change that pass the
+    filters, see Change.AffectedFiles.
+
+    Args:
+      file_filter: A function of an AffectedFile that returns whether to keep
+        it, or None.
+      include: Regexes of local paths. Only files matching one are kept. None
+        keeps every file.
+      exclude: Regexes of local paths. Files matching one are dropped.
+
+    Return:
+      A list of AffectedFile objects, in the order of the change.
+    """
+    return list(self.change.AffectedFiles(file_filter, include, exclude))
+
+  def AffectedSourceFiles(self, source_file_filter=None):
+    """Returns the affected files matching DEFAULT_WHITE_LIST and none of
+    DEFAULT_BLACK_LIST, that pass source_file_filter if given.
+    """
+    return self.AffectedFiles(source_file_filter, self.DEFAULT_WHITE_LIST,
+        self.DEFAULT_BLACK_LIST)
+
+  def GetDeletedFiles(self):
+    """Returns a list of the deleted files in the change. They cannot be
+    read.
+    """
+    return list(self.change.DeletedFiles())
 
   def License(self):
-    return self._license
+    return self.change.License()
+
+  def Config(self):
+    """Returns the PresubmitConfig of the run."""
+    return self.change.Config()
+
+class Change(object):
+  """A snapshot of the files in a change and the preferences that apply to
+  them.
+
+  It is built once per run and shared by the InputApi of every presubmit
+  script, so the tree is walked and presubmit.xml is parsed only once.
+  """
+
+  def __init__(self, repository_root, affected_paths, config, timings=None,
+      state=None, changed_lines=None):
+    """
+    Args:
+      repository_root: Absolute path of the repository root.
+      affected_paths: List of (action, path) tuples, relative to the root.
+      config: The PresubmitConfig of the run.
+      timings: The Timings of the run, or None to time nothing.
+      state: The WarmState to reuse unchanged AffectedFile objects from, or
+        None.
+      changed_lines: A dict from normalized path to the changed line numbers
+        of the file, see _GitChangedLines. None if every line is changed.
+    """
+    self._repository_root = repository_root
+    self._affected_paths = affected_paths
+    self._config = config
+    if timings is None:
+      timings = Timings(enabled=False)
+    self._timings = timings
+    live_paths = [(action, path) for action, path in affected_paths
+        if action != ACTION_DELETED]
+    if state:
+      files = state.AffectedFiles(repository_root, live_paths, timings)
+    else:
+      files = (AffectedFile(path, repository_root, action, timings)
+          for action, path in live_paths)
+    self._affected_files = _AffectedFileList(
+        _WithChangedLines(files, changed_lines))
+    self._deleted_files = _AffectedFileList(
+        AffectedFile(path, repository_root, action, timings)
+        for action, path in affected_paths if action == ACTION_DELETED)
+    # Built on the first filtered AffectedFiles call.
+    self._file_index = None
+    # (file_filter, include, exclude) -> tuple of AffectedFile
+    self._filtered_files = {}
+
+  def RepositoryRoot(self):
+    return self._repository_root
+
+  def AffectedPaths(self):
+    """Returns the (action, path) tuples of every file in the change."""
+    return self._affected_paths
+
+  def AffectedFiles(self, file_filter=None, include=None, exclude=None):
+    """Returns the added and modified files of the change that pass the
+    filters, see InputApi.AffectedFiles.
+
+    Without filters, this is an _AffectedFileList shared by every caller.
+    Otherwise it is a tuple, kept for identical calls for the rest of the run.
+    Files are looked up in an index by directory and extension where the
+    include regexes allow it, see _FilePattern, so that asking for the .java
+    files under some directory does not look at every other file.
+    """
+    if file_filter is None and include is None and not exclude:
+      return self._affected_files
+    key = (file_filter, include is not None and tuple(include),
+        tuple(exclude or ()))
+    files = self._filtered_files.get(key)
+    if files is None:
+      files = self._filtered_files[key] = self._FilterFiles(file_filter,
+          include, exclude)
+    return files
+
+  def _FilterFiles(self, file_filter, include, exclude):
+    if self._file_index is None:
+      self._file_index = _FileIndex(list(self._affected_files))
+    index = self._file_index
+    excludes = [_GetFilePattern(pattern).regex for pattern in exclude or ()]
+    if include is None:
+      includes = None
+      positions = xrange(len(index.files))
+    else:
+      includes = [_GetFilePattern(pattern) for pattern in include]
+      positions = set()
+      for pattern in includes:
+        positions.update(index.Candidates(pattern))
+      positions = sorted(positions)
+    files = []
+    for position in positions:
+      f = index.files[position]
+      path = f.LocalPath()
+      if includes is not None and not any(
+          pattern.regex.match(path) for pattern in includes):
+        continue
+      if any(regex.match(path) for regex in excludes):
+        continue
+      if file_filter is not None and not file_filter(f):
+        continue
+      files.append(f)
+    return tuple(files)
+
+  def DeletedFiles(self):
+    """Returns the deleted files of the change, as an _AffectedFileList
+    shared by every caller.
+    """
+    return self._deleted_files
+
+  def Timings(self):
+    """Returns the Timings of the run."""
+    return self._timings
+
+  def Config(self):
+    return self._config
+
+  def License(self):
+    return self._config.license
+
+def _WithChangedLines(files, changed_lines):
+  """Sets the changed lines of each of files as it is made, see Change."""
+  for f in files:
+    f.SetChangedLines(None if changed_lines is None
+        else changed_lines.get(f.LocalPath(), []))
+    yield f
+
+class _AffectedFileList(object):
+  """A read-only sequence of the AffectedFile objects of a change.
+
+  Files are made as iteration first reaches them, and kept, so that a change
+  of a large tree costs nothing until a script looks at its files, and
+  every script then shares the same objects.
+  """
+  __slots__ = ('_files', '_source')
+
+  def __init__(self, files):
+    """
+    Args:
+      files: An iterable of AffectedFile objects, consumed as needed.
+    """
+    self._files = []
+    self._source = iter(files)
+
+  def _Next(self):
+    """Makes the next file. Returns False once there are no more."""
+    if self._source is not None:
+      for f in self._source:
+        self._files.append(f)
+        return True
+      self._source = None
+    return False
+
+  def _All(self):
+    while self._Next():
+      pass
+    return self._files
+
+  def __iter__(self):
+    if self._source is None:
+      return iter(self._files)
+    return self._Iter()
+
+  def _Iter(self):
+    index = 0
+    while index < len(self._files) or self._Next():
+      yield self._files[index]
+      index += 1
+
+  def __len__(self):
+    return len(self._All())
+
+  def __nonzero__(self):
+    return bool(self._files) or self._Next()
+
+  def __getitem__(self, index):
+    return self._All()[index]
+
+class _FilePattern(object):
+  """A compiled regex of local paths, and what every path it matches has in
+  common: the directory the path is under and its extension, where the regex
+  tells for sure. These are found conservatively, e.g. r'src/main/.+\.java$'
+  gives 'src/main/' and '.java', while regexes with alternatives give
+  neither.
+  """
+  __slots__ = ('regex', 'directory', 'extension')
+
+  def __init__(self, pattern):
+    self.regex = re.compile(pattern)
+    # '' for any directory, or a directory ending in a slash.
+    self.directory = ''
+    # None for any extension, or an extension such as '.java'.
+    self.extension = None
+    if '|' in pattern or '(?' in pattern:
+      return
+    match = re.match(r'(.*)\\\.(\w+)\$$', pattern, re.DOTALL)
+    if match:
+      head = match.group(1)
+      # An odd number of backslashes before it would make the dot a wildcard.
+      if (len(head) - len(head.rstrip('\\'))) % 2 == 0:
+        self.extension = '.' + match.group(2)
+    if pattern.startswith('^'):
+      pattern = pattern[1:]
+    literal = re.match(r'(?:[\w-]|\\?/)*', pattern).group(0)
+    if pattern[len(literal):len(literal) + 1] in ('*', '+', '?', '{'):
+      # The quantifier applies to the last character.
+      literal = literal[:-1].rstrip('\\')
+    literal = literal.replace('\\/', '/')
+    self.directory = literal[:literal.rfind('/') + 1]
+
+# Pattern -> _FilePattern, so that every regex is compiled once per run.
+_file_patterns = {}
+
+def _GetFilePattern(pattern):
+  file_pattern = _file_patterns.get(pattern)
+  if file_pattern is None:
+    file_pattern = _file_patterns[pattern] = _FilePattern(pattern)
+  return file_pattern
+
+class _FileIndex(object):
+  """The positions of files in a list, by directory and extension."""
+
+  def __init__(self, files):
+    self.files = files
+    # Extension -> positions
+    self._by_extension = collections.defaultdict(list)
+    # Directory -> extension -> positions
+    self._by_directory = collections.defaultdict(
+        lambda: collections.defaultdict(list))
+    for position, f in enumerate(files):
+      path = f.LocalPath().replace(os.sep, '/')
+      slash = path.rfind('/')
+      directory, name = path[:slash + 1], path[slash + 1:]
+      dot = name.rfind('.')
+      extension = name[dot:] if dot != -1 else ''
+      self._by_extension[extension].append(position)
+      self._by_directory[directory][extension].append(position)
+    self._directories = sorted(self._by_directory)
+
+  def Candidates(self, pattern):
+    """Returns the positions of the files a _FilePattern may match."""
+    if not pattern.directory:
+      if pattern.extension is None:
+        return xrange(len(self.files))
+      return self._by_extension.get(pattern.extension, ())
+    positions = []
+    start = bisect.bisect_left(self._directories, pattern.directory)
+    for i in xrange(start, len(self._directories)):
+      directory = self._directories[i]
+      if not directory.startswith(pattern.directory):
+        break
+      by_extension = self._by_directory[directory]
+      if pattern.extension is None:
+        for extension_positions in by_extension.itervalues():
+          positions.extend(extension_positions)
+      else:
+        positions.extend(by_extension.get(pattern.extension, ()))
+    return positions
+
+def BuildChange(diff_base=None, config=None, timings=None, state=None,
+    changed_lines=False, shard=None):
+  """Builds the Change for a presubmit run.
+
+  Args:
+    diff_base: If set, only the files changed against this base are affected.
+      See DoPresubmitChecks. Otherwise every file in the tree is.
+    config: The PresubmitConfig of the run. Loaded if None.
+    timings: The Timings of the run, or None to time nothing.
+    state: A WarmState to reuse what did not change since the last run from,
+      or None.
+    changed_lines: Attach the lines changed against diff_base to each file,
+      see AffectedFile.ChangedContents. Requires diff_base.
+    shard: A (shard_index, total_shards) tuple to keep only the files of that
+      shard, see ShardPaths, or None to keep every file.
+
+  Return:
+    A Change object.
+  """
+  if config is None:
+    config = LoadConfig()
+  repository_root = config.base_dir
+  if changed_lines and not diff_base:
+    raise PresubmitFailure('Checking changed lines only needs a diff base.')
+  if diff_base:
+    affected_paths = _GitAffectedPaths(repository_root, diff_base)
+    if config.exclude:
+      excludes = _IgnoreRules('', config.exclude)
+      affected_paths = [(action, path) for action, path in affected_paths
+          if not excludes.MatchPath(path)]
+  else:
+    affected_paths = [(ACTION_MODIFIED, path)
+        for path in _LocalPaths(repository_root, config, state)]
+  if shard:
+    affected_paths = ShardPaths(repository_root, affected_paths, *shard)
+  if changed_lines:
+    # Empty if no lines were added, e.g. only modes changed or lines were
+    # deleted; then no lines are checked.
+    changed_lines = _GitChangedLines(repository_root, diff_base)
+  else:
+    changed_lines = None
+  return Change(repository_root, affected_paths, config, timings, state,
+      changed_lines)
+
+def ShardPaths(repository_root, affected_paths, shard_index, total_shards):
+  """Returns the affected paths that shard shard_index of total_shards checks.
+
+  Every shard computes the same split on its own, so every shard must see the
+  same affected paths. Files are dealt out largest first, each to the shard
+  with the fewest bytes so far, or the fewest files among those, so that
+  shards read about as much. Files of the same size are dealt in the order of
+  a stable hash of their local path. Result files of shards, named like
+  DEFAULT_SHARD_OUTPUT, are left out: a shard run earlier in the same tree
+  would otherwise change the split.
+
+  Args:
+    repository_root: Absolute path of the repository root.
+    affected_paths: List of (action, path) tuples, relative to the root.
+    shard_index: The shard to return the paths of, from 0.
+    total_shards: The number of shards.
+
+  Return:
+    The (action, path) tuples of the shard, in the order of affected_paths.
+  """
+  if not 0 <= shard_index < total_shards:
+    raise PresubmitFailure('Shard %d of %d does not exist.'
+        % (shard_index, total_shards))
+  affected_paths = [(action, path) for action, path in affected_paths
+      if not _SHARD_OUTPUT_RE.match(os.path.basename(path))]
+  files = []
+  for action, path in affected_paths:
+    size = 0
+    if action != ACTION_DELETED:
+      try:
+        size = os.path.getsize(os.path.join(repository_root, path))
+      except OSError:
+        pass
+    files.append((-size, hashlib.sha1(normpath(path)).hexdigest(), path))
+  files.sort()
+  # (bytes, files, shard) of each shard.
+  loads = [(0, 0, index) for index in range(total_shards)]
+  selected = set()
+  for size, _, path in files:
+    total_size, count, index = heapq.heappop(loads)
+    if index == shard_index:
+      selected.add(path)
+    heapq.heappush(loads, (total_size - size, count + 1, index))
+  return [(action, path) for action, path in affected_paths
+      if path in selected]
+
+def _FileStamp(path):
+  """Returns what changes when the file at path is modified or replaced."""
+  st = os.stat(path)
+  return (st.st_mtime, st.st_size, st.st_ino)
+
+class _WarmContents(object):
+  """The contents of a file and its parsed Java tree, kept by a WarmState."""
+  __slots__ = ('data', 'java_tree')
+
+  def __init__(self, data, java_tree):
+    self.data = data
+    self.java_tree = java_tree
+
+class WarmState(object):
+  """What a long-running process, such as presubmit_daemon, keeps between
+  presubmit runs.
+
+  Everything is checked against the mtime of the file or directory it came
+  from before it is reused, so edits are picked up by the next run. Compiled
+  presubmit scripts are kept by _GetCodeCache in any case.
+
+  The contents and Java trees that files drop on AffectedFile.Release are kept
+  by content hash, up to max_contents_size bytes of contents, least recently
+  used first out. Files that did not change are not read or parsed again.
+  """
+
+  def __init__(self, max_contents_size=DEFAULT_WARM_CONTENTS_SIZE):
+    # Path of presubmit.xml -> (stamp, PresubmitConfig)
+    self._configs = {}
+    # Directory -> (mtime, list of _DirEntry)
+    self._dirs = {}
+    # Repository root -> {path: (stamp, AffectedFile)}
+    self._files = {}
+    # Cache directory -> ResultCache
+    self._result_caches = {}
+    # Content hash -> _WarmContents, least recently used first.
+    self._contents = collections.OrderedDict()
+    self._contents_size = 0
+    self._max_contents_size = max_contents_size
+    # Worker processes inherit the state, but what they would add to it is
+    # lost when they exit.
+    self._pid = os.getpid()
+
+  def Config(self):
+    """Returns the PresubmitConfig for the current directory, like LoadConfig.
+    """
+    path = _FindPresubmitPrefFile()
+    try:
+      stamp = _FileStamp(path)
+    except OSError:
+      return LoadConfig(path)
+    cached = self._configs.get(path)
+    if cached is None or cached[0] != stamp:
+      cached = self._configs[path] = (stamp, LoadConfig(path))
+    return cached[1]
+
+  def ListDir(self, directory):
+    """Returns the entries of directory, like _ListDir. Adding or removing an
+    entry changes the mtime of the directory, so listings are reused until it
+    changes.
+    """
+    mtime = os.stat(directory).st_mtime
+    cached = self._dirs.get(directory)
+    if cached is None or cached[0] != mtime:
+      entries = [_DirEntry(directory, e.name, e.is_dir(), e.is_symlink())
+          for e in _ListDir(directory)]
+      cached = self._dirs[directory] = (mtime, entries)
+    return cached[1]
+
+  def AffectedFiles(self, repository_root, affected_paths, timings=None):
+    """Generates an AffectedFile for each (action, path) of affected_paths.
+
+    Files that did not change since the last run are the same objects as
+    then, so their content hash need not be computed again.
+    Files this run does not get to are forgotten.
+    """
+    cached_files = self._files.get(repository_root, {})
+    files = self._files[repository_root] = {}
+    for action, path in affected_paths:
+      try:
+        stamp = _FileStamp(os.path.join(repository_root, path))
+      except OSError:
+        stamp = None
+      cached = cached_files.get(path)
+      if (stamp is not None and cached is not None and cached[0] == stamp and
+          cached[1].Action() == action):
+        f = cached[1]
+        # The file outlives the run it was made for.
+        f._timings = timings or _NO_TIMINGS
+      else:
+        f = AffectedFile(path, repository_root, action, timings)
+        f._warm = self
+      files[path] = (stamp, f)
+      yield f
+
+  def Warm(self):
+    """Reads the files of the last run that no contents are kept for, such as
+    those worker processes read, so that the next run finds them. Meant to be
+    called between runs.
+    """
+    for files in self._files.itervalues():
+      for stamp, f in files.itervalues():
+        if self._contents_size >= self._max_contents_size:
+          return
+        if stamp is None or f._content_hash in self._contents:
+          continue
+        try:
+          f.ReadRawBytes()
+        except (IOError, OSError):
+          continue
+        f.Release()
+
+  def _GetContents(self, content_hash):
+    """Returns the _WarmContents kept for content_hash, or None."""
+    contents = self._contents.pop(content_hash, None)
+    if contents is not None:
+      self._contents[content_hash] = contents
+    return contents
+
+  def _KeepContents(self, content_hash, data, java_tree):
+    if os.getpid() != self._pid:
+      return
+    contents = self._GetContents(content_hash)
+    if contents is not None:
+      if java_tree is not None and (contents.java_tree is None or
+          contents.java_tree.header_only):
+        contents.java_tree = java_tree
+      return
+    if len(data) > self._max_contents_size:
+      return
+    if isinstance(data, mmap.mmap):
+      data = data[:]
+    self._contents[content_hash] = _WarmContents(data, java_tree)
+    self._contents_size += len(data)
+    while self._contents_size > self._max_contents_size:
+      _, evicted = self._contents.popitem(last=False)
+      self._contents_size -= len(evicted.data)
+
+  def ResultCache(self, cache_dir, max_size=DEFAULT_CACHE_SIZE):
+    """Returns the ResultCache of cache_dir, with its counts reset."""
+    result_cache = self._result_caches.get(cache_dir)
+    if result_cache is None or result_cache._max_size != max_size:
+      result_cache = self._result_caches[cache_dir] = ResultCache(cache_dir,
+          max_size)
+    result_cache.TakeCounts()
+    return result_cache
 
 class AffectedFile(object):
-  """Representation of a file in a change."""
+  """Representation of a file in a change.
+
+  The contents are read on first use and kept until Release() is called, so
+  any number of checks can look at the file for the cost of one read. There
+  is one per file in the tree on full runs, so they are kept small.
+  """
+  __slots__ = ('_path', '_local_path', '_local_root', '_action', '_timings',
+      '_data', '_lines', '_stripped_lines', '_text', '_content_hash',
+      '_java_tree', '_changed_lines', '_warm')
 
-  def __init__(self, path, repository_root):
+  def __init__(self, path, repository_root, action=ACTION_MODIFIED,
+      timings=None):
     self._path = path
+    self._local_path = normpath(path)
     self._local_root = repository_root
+    self._action = action
+    self._timings = timings or _NO_TIMINGS
+    self._data = None
+    self._lines = None
+    self._stripped_lines = None
+    self._text = None
+    self._content_hash = None
+    self._java_tree = None
+    self._changed_lines = None
+    # The WarmState that keeps the contents and tree on Release, or None.
+    self._warm = None
+
+  def Action(self):
+    """Returns what was done to this file, e.g. ACTION_ADDED."""
+    return self._action
 
   def LocalPath(self):
     """Returns the path of the file on the local disk relative to the client
     root.
     """
-    return normpath(self._path)
+    return self._local_path
 
   def AbsoluteLocalPath(self):
     """Returns the absolute path of this file on the local disk.
@@ -385,35 +2314,268 @@ class AffectedFile(object):
     print(os.path.basename(self._path))
     return os.path.basename(self._path)
 
+  def ReadRawBytes(self):
+    """Returns the contents of the file as bytes.
+
+    Files of MMAP_THRESHOLD bytes or more are returned as a read-only mmap,
+    which supports len(), indexing, slicing and find() like a str.
+    """
+    if self._data is None and self._warm and self._content_hash:
+      contents = self._warm._GetContents(self._content_hash)
+      if contents is not None:
+        self._data = contents.data
+    if self._data is None:
+      start_time = time.time()
+      with open(self.AbsoluteLocalPath(), 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+          self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+          self._data = f.read()
+      self._timings.Add('read', self.LocalPath(), time.time() - start_time)
+    return self._data
+
   def ReadFile(self):
-    return open(self.AbsoluteLocalPath()).read()
+    """Returns the contents of the file as a str."""
+    data = self.ReadRawBytes()
+    if isinstance(data, mmap.mmap):
+      return data[:]
+    return data
+
+  def ReadFileText(self):
+    """Returns the contents of the file decoded as UTF-8."""
+    if self._text is None:
+      self._text = self.ReadFile().decode('utf-8', 'replace')
+    return self._text
 
   def ReadFileLines(self):
-    return open(self.AbsoluteLocalPath()).readlines()
+    """Returns the lines of the file, with their line terminators."""
+    if self._lines is None:
+      data = self.ReadRawBytes()
+      if isinstance(data, mmap.mmap):
+        data.seek(0)
+        self._lines = list(iter(data.readline, ''))
+      else:
+        self._lines = cStringIO.StringIO(data).readlines()
+    return self._lines
+
+  def ReadFileStrippedLines(self):
+    """Returns the lines of the file without trailing whitespace."""
+    if self._stripped_lines is None:
+      self._stripped_lines = [l.rstrip() for l in self.ReadFileLines()]
+    return self._stripped_lines
 
-def _GetPresubmitPrefTree():
-  return ET.parse(PRESUBMIT_PREF_FILE)
+  def JavaTree(self, header_only=False):
+    """Returns the file parsed as Java, see parsers.java_parser.JavaLexer.
 
-def _GetBaseDir():
-  tree = _GetPresubmitPrefTree()
-  root = tree.getroot()
+    The file is parsed on first use, and the tree is kept until Release() is
+    called so that every check can share it.
+
+    Args:
+      header_only: Only the package and import statements are needed. A full
+        tree, if there is one already, is returned all the same.
+    """
+    if self._java_tree is None and self._warm:
+      contents = self._warm._GetContents(self.ContentHash())
+      if contents is not None:
+        self._java_tree = contents.java_tree
+    if self._java_tree is None or (self._java_tree.header_only and
+        not header_only):
+      data = self.ReadFile()
+      start_time = time.time()
+      self._java_tree = java_parser.JavaLexer(data, header_only)
+      self._timings.Add('parse', self.LocalPath(), time.time() - start_time)
+    return self._java_tree
+
+  def SetChangedLines(self, line_numbers):
+    """Sets the changed line numbers, sorted and 1-based, or None if the
+    whole file counts as changed.
+    """
+    self._changed_lines = line_numbers
+
+  def ChangedLineNumbers(self):
+    """Returns the sorted, 1-based numbers of the lines added or modified in
+    the change, or None if the whole file counts as changed.
+    """
+    return self._changed_lines
+
+  def ChangedContents(self):
+    """Returns an iterable of (line_num, line) for each line added or
+    modified in the change, every line unless only changed lines are
+    checked. Lines are without trailing whitespace, like
+    ReadFileStrippedLines.
+    """
+    if self._changed_lines is None:
+      return enumerate(self.ReadFileStrippedLines(), 1)
+    lines = self.ReadFileLines()
+    return [(line_num, lines[line_num - 1].rstrip())
+        for line_num in self._changed_lines if line_num <= len(lines)]
+
+  def ContentHash(self):
+    """Returns the SHA-1 hex digest of the contents of the file."""
+    if self._content_hash is None:
+      self._content_hash = hashlib.sha1(self.ReadRawBytes()).hexdigest()
+    return self._content_hash
+
+  def Release(self):
+    """Drops the cached contents and parsed tree. They are read and parsed
+    again if needed, unless a WarmState kept them.
+    """
+    if self._warm and self._data is not None:
+      self._warm._KeepContents(self.ContentHash(), self._data,
+          self._java_tree)
+    if isinstance(self._data, mmap.mmap):
+      self._data.close()
+    self._data = None
+    self._lines = None
+    self._stripped_lines = None
+    self._text = None
+    self._java_tree = None
+
+# Settings of one check, see PresubmitConfig.
+CheckConfig = collections.namedtuple('CheckConfig',
+    'name enabled time_budget')
+
+class PresubmitConfig(collections.namedtuple('PresubmitConfig', [
+    'name', 'base_dir', 'license', 'jobs', 'cache_dir', 'cache_size',
+    'column_limit', 'script_time_budget', 'check_time_budget', 'checks',
+    'exclude', 'use_gitignore'])):
+  """The settings of presubmit.xml. Settings left out are None.
+
+  An example with every setting:
+
+    <presubmit name="project" basedir=".">
+      <license>/* Copyright ... */</license>
+      <jobs>8</jobs>
+      <cache dir=".presubmit_cache" size="268435456"/>
+      <files gitignore="true">
+        <exclude>build/</exclude>
+        <exclude>*.jar</exclude>
+      </files>
+      <column_limit>100</column_limit>
+      <scripts time_budget="120"/>
+      <checks time_budget="10">
+        <check name="CheckColumnLimit" enabled="false"/>
+        <check name="CheckImportOrderingAndSpacing" time_budget="30"/>
+      </checks>
+    </presubmit>
+
+  Paths are absolute. Time budgets are in seconds. checks is a tuple of
+  CheckConfig, for the checks that have settings of their own. exclude is a
+  tuple of patterns in .gitignore syntax, relative to base_dir, of files that
+  are never checked. use_gitignore tells whether files ignored by .gitignore
+  are skipped too when checking the whole tree; it defaults to True.
+  """
+  __slots__ = ()
+
+  def _Check(self, name):
+    for check in self.checks:
+      if check.name == name:
+        return check
+    return None
+
+  def CheckEnabled(self, name):
+    """Whether the check called name (e.g. CheckColumnLimit) should run."""
+    check = self._Check(name)
+    return check is None or check.enabled is not False
+
+  def CheckTimeBudget(self, name):
+    """Returns the time budget of the check called name, or None."""
+    check = self._Check(name)
+    if check is not None and check.time_budget is not None:
+      return check.time_budget
+    return self.check_time_budget
+
+def _FindPresubmitPrefFile(start_dir=None):
+  """Finds presubmit.xml in start_dir or the closest directory above it.
+
+  Falls back to the one next to this script.
+  """
+  directory = os.path.abspath(start_dir or os.getcwd())
+  while True:
+    path = os.path.join(directory, PRESUBMIT_PREF_FILE)
+    if os.path.isfile(path):
+      return path
+    parent_dir = os.path.dirname(directory)
+    if parent_dir == directory:
+      break
+    directory = parent_dir
+  return os.path.join(PRESUBMIT_PREF_FILE_PATH, PRESUBMIT_PREF_FILE)
+
+def _ParseValue(element, value, convert):
+  if value is None:
+    return None
+  try:
+    return convert(value.strip())
+  except ValueError:
+    raise PresubmitFailure('%s: invalid value "%s" in <%s>.'
+        % (PRESUBMIT_PREF_FILE, value, element.tag))
+
+def _ParseBool(value):
+  if value.lower() in ('true', '1', 'yes'):
+    return True
+  if value.lower() in ('false', '0', 'no'):
+    return False
+  raise ValueError(value)
+
+def LoadConfig(path=None):
+  """Parses presubmit.xml into a PresubmitConfig.
+
+  Args:
+    path: Path of presubmit.xml. By default it is looked up from the current
+      directory upwards.
+
+  Return:
+    A PresubmitConfig. Relative paths in it are resolved against the directory
+    of presubmit.xml, not the current one.
+  """
+  if path is None:
+    path = _FindPresubmitPrefFile()
+  pref_dir = os.path.dirname(os.path.abspath(path))
+  try:
+    root = ET.parse(path).getroot()
+  except (IOError, ET.ParseError), e:
+    raise PresubmitFailure('Could not read %s.\n%s' % (path, e))
   if root.tag != 'presubmit':
-    raise Exception("presubmit tag not found in root")
-  attributes = root.attrib
-  if 'basedir' not in attributes:
-    return '.'
-  return os.path.abspath(attributes['basedir'])
-
-def _GetLicense():
-  tree = _GetPresubmitPrefTree()
-  root = tree.getroot()
-  children_tags = [child.tag for child in root]
-  if 'license' not in children_tags:
-    return ''
-  license = root.find('license').text
-  if not license:
-    return ''
-  return license
+    raise PresubmitFailure("presubmit tag not found in root")
+  base_dir = os.path.abspath(
+      os.path.join(pref_dir, root.get('basedir', '.')))
+
+  def Text(tag, convert=str):
+    element = root.find(tag)
+    if element is None:
+      return None
+    return _ParseValue(element, element.text, convert)
+
+  def Attribute(tag, name, convert=str):
+    element = root.find(tag)
+    if element is None:
+      return None
+    return _ParseValue(element, element.get(name), convert)
+
+  cache_dir = Attribute('cache', 'dir')
+  cache_dir = os.path.join(base_dir, cache_dir or DEFAULT_CACHE_DIR)
+  checks = []
+  for element in root.findall('checks/check'):
+    checks.append(CheckConfig(element.get('name'),
+        _ParseValue(element, element.get('enabled'), _ParseBool),
+        _ParseValue(element, element.get('time_budget'), float)))
+  license = root.find('license')
+  use_gitignore = Attribute('files', 'gitignore', _ParseBool)
+  return PresubmitConfig(
+      name=root.get('name'),
+      base_dir=base_dir,
+      license=license is not None and license.text or '',
+      jobs=Text('jobs', int),
+      cache_dir=cache_dir,
+      cache_size=Attribute('cache', 'size', int) or DEFAULT_CACHE_SIZE,
+      column_limit=Text('column_limit', int),
+      script_time_budget=Attribute('scripts', 'time_budget', float),
+      check_time_budget=Attribute('checks', 'time_budget', float),
+      checks=tuple(checks),
+      exclude=tuple(e.text.strip() for e in root.findall('files/exclude')
+          if e.text and e.text.strip()),
+      use_gitignore=use_gitignore is not False)
 
 if __name__ == '__main__':
   try:
@@ -422,9 +2584,59 @@ if __name__ == '__main__':
         usage=globals()['__doc__'], version='$Id$')
     parser.add_option('-v','--verbose', action='store_true', default=False, \
         help='verbose output')
+    parser.add_option('--diff-base', default=None, \
+        help='only check files changed against this base: "%s", "%s" or a '
+        'git revision such as HEAD~1 (default: the whole tree)'
+        % (DIFF_BASE_UPSTREAM, DIFF_BASE_INDEX))
+    parser.add_option('-j', '--jobs', type='int', default=None, \
+        help='number of processes to run presubmit scripts and the Java '
+        'checks in (default: the jobs setting of %s, or 1 for scripts and '
+        'the number of CPUs for the Java checks)' % PRESUBMIT_PREF_FILE)
+    parser.add_option('--cache-dir', default=None, \
+        help='directory to cache compiled presubmit scripts and check '
+        'results in (default: the cache setting of %s, or %s under the '
+        'repository root)' % (PRESUBMIT_PREF_FILE, DEFAULT_CACHE_DIR))
+    parser.add_option('--no-cache', action='store_true', default=False, \
+        help='do not read or write any cached results')
+    parser.add_option('--stream', action='store_true', default=False, \
+        help='write results as soon as they are available and only a '
+        'summary at the end')
+    parser.add_option('--json-output', metavar='FILE', \
+        help='also write one JSON record per result to FILE as soon as it is '
+        'available, followed by a summary record')
+    parser.add_option('--timings', action='store_const', default=0, \
+        const=DEFAULT_TIMINGS_TOP, \
+        help='report the slowest presubmit scripts, checks and files')
+    parser.add_option('--timings-top', type='int', dest='timings', \
+        metavar='N', help='like --timings, listing N of each')
+    parser.add_option('--profile', metavar='FILE', \
+        help='run under cProfile and write the stats to FILE, for pstats. '
+        'Worker processes are not profiled, use -j 1 for a full profile')
+    parser.add_option('--changed-lines', action='store_true', default=False, \
+        help='with --diff-base, only check the lines that changed in the '
+        'checks that look at one line at a time')
+    parser.add_option('--total-shards', type='int', default=None, \
+        metavar='N', help='split the affected files between N shards, e.g. '
+        'CI machines, and check only those of --shard-index. The results go '
+        'to --json-output (default: presubmit-shard-I-of-N.json)')
+    parser.add_option('--shard-index', type='int', default=None, \
+        metavar='I', help='with --total-shards, the shard to check, from 0')
+    parser.add_option('--merge-shards', action='store_true', default=False, \
+        help='report the results of all shards, from the files given as '
+        'arguments, and exit with a non-zero status if they did not pass')
     (options, args) = parser.parse_args()
     # if len(args) < 1:
     #   parser.error('missing argument')
+    if options.changed_lines and not options.diff_base:
+      parser.error('--changed-lines needs --diff-base')
+    if (options.shard_index is None) != (options.total_shards is None):
+      parser.error('--shard-index and --total-shards go together')
+    if options.total_shards is not None and not (
+        0 <= options.shard_index < options.total_shards):
+      parser.error('--shard-index must be at least 0 and less than '
+          '--total-shards')
+    if options.merge_shards and not args:
+      parser.error('--merge-shards needs the result files of the shards')
     if options.verbose: print(time.asctime())
     main()
     if options.verbose: print(time.asctime())
@@ -0,0 +1,215 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2015 Sean Kirmani <sean@kirmani.io>
+#
+# Distributed under terms of the MIT license.
+"""Unit tests for parsers/java_parser.py.
+
+  python test/java_parser_test.py
+"""
+import os
+import sys
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from parsers import java_parser
+
+def _Tokens(text):
+  """Returns (kind, text, line, column) of each token of text."""
+  return [tuple(token) for token in java_parser.Tokenize(text)]
+
+def _Texts(text):
+  return [token.text for token in java_parser.Tokenize(text)]
+
+def _Tree(nodes):
+  """Returns the Printable of each node, followed by the tree of its
+  children, if it has any.
+  """
+  tree = []
+  for node in nodes:
+    tree.append(node.Printable())
+    children = getattr(node, 'children', None)
+    if children:
+      tree.append(_Tree(children))
+  return tree
+
+def _Parse(text, header_only=False):
+  return _Tree(java_parser.JavaLexer(text, header_only).children)
+
+class TokenizeTest(unittest.TestCase):
+  def testKindsAndPositions(self):
+    self.assertEqual([
+        ('word', 'int', 1, 1),
+        ('word', 'x', 1, 5),
+        ('op', '=', 1, 7),
+        ('number', '0x1F', 1, 9),
+        ('op', '+', 1, 14),
+        ('number', '1.5e-3', 1, 16),
+        ('op', ';', 1, 22),
+        ('word', 'x', 2, 3),
+        ('op', '>>>=', 2, 5),
+        ('number', '2', 2, 10),
+        ('op', ';', 2, 11),
+        ], _Tokens('int x = 0x1F + 1.5e-3;\n  x >>>= 2;'))
+
+  def testStringsAndChars(self):
+    self.assertEqual([
+        ('word', 's', 1, 1),
+        ('op', '=', 1, 3),
+        ('string', r'"a \"b\" // c /* d"', 1, 5),
+        ('op', '+', 1, 25),
+        ('char', r"'\''", 1, 27),
+        ('op', '+', 1, 32),
+        ('char', "'\"'", 1, 34),
+        ], _Tokens(r's = "a \"b\" // c /* d" + '"'\\'' + '\"'"))
+
+  def testComments(self):
+    self.assertEqual([
+        ('word', 'a', 1, 1),
+        ('word', 'b', 1, 13),
+        ('word', 'c', 3, 6),
+        ('word', 'd', 4, 1),
+        ], _Tokens('a /* x { */ b // y }\n/* z\n  */ c /* w */\nd\n'))
+
+  def testUnterminatedBlockComment(self):
+    self.assertEqual(['a'], _Texts('a /* b\nc\n'))
+
+  def testLineTerminators(self):
+    # Lines end at \n only, so that they are numbered the way
+    # AffectedFile.ReadFileLines splits them. \r is whitespace.
+    self.assertEqual([
+        ('word', 'a', 1, 1),
+        ('word', 'b', 2, 1),
+        ('word', 'c', 2, 4),
+        ('word', 'd', 3, 1),
+        ], _Tokens('a\r\nb\r c\r\nd'))
+    # A line comment runs to the \n, past a lone \r.
+    self.assertEqual([
+        ('word', 'a', 1, 1),
+        ('word', 'c', 2, 1),
+        ], _Tokens('a // b\rb\nc'))
+
+  def testNonAsciiWords(self):
+    self.assertEqual(['caf\xc3\xa9', '=', '1'], _Texts('caf\xc3\xa9 = 1'))
+
+  def testIterTokensStopsEarly(self):
+    tokens = java_parser.IterTokens('a b\n' + '"unterminated\n' * 1000)
+    self.assertEqual(['a', 'b'], [next(tokens).text, next(tokens).text])
+
+class JavaLexerTest(unittest.TestCase):
+  def testHeader(self):
+    self.assertEqual([
+        'package: com.example',
+        "import: ['java', 'util'] List",
+        "import: static ['org', 'junit', 'Assert'] *",
+        ], _Parse('package com . example;\n'
+        'import java.util.List;\n'
+        'import static org.junit.Assert.*;\n'))
+
+  def testClass(self):
+    self.assertEqual([
+        "class: ['public', 'final'] A",
+        [
+            "variable: ['private', 'static'] int COUNT",
+            "variable: ['private'] Map<String, Integer> map",
+            "method: ['public'] A",
+            "method: ['public', 'void'] run",
+            ['parameters', [
+                "variable: ['final'] String name",
+                'variable: [] int[] values',
+                ]],
+            "method: ['abstract', 'int'] size",
+            ],
+        ], _Parse('public final class A {\n'
+        '  private static int COUNT = 0;\n'
+        '  private Map<String, Integer> map;\n'
+        '  public A() {}\n'
+        '  @Override\n'
+        '  public void run(final String name, int[] values) {}\n'
+        '  abstract int size();\n'
+        '}\n'))
+
+  def testNestedBlocks(self):
+    self.assertEqual([
+        "class: [] A",
+        [
+            "method: ['void'] f",
+            [
+                'variable: [] int i',
+                'conditional: if',
+                [
+                    'conditional: for',
+                    ['variable: [] String s'],
+                    ],
+                'conditional: else',
+                'block',
+                ],
+            "class: ['static'] B",
+            ["variable: [] int j"],
+            ],
+        ], _Parse('class A {\n'
+        '  void f() {\n'
+        '    int i = 0;\n'
+        '    if (i > 0) {\n'
+        '      for (int k = 0; k < i; k++) { String s = "}"; }\n'
+        '    } else { }\n'
+        '    { }\n'
+        '  }\n'
+        '  static class B { int j = 1; }\n'
+        '}\n'))
+
+  def testExpressionBraces(self):
+    # The braces of array initializers, anonymous classes and lambdas do not
+    # open blocks of the tree.
+    self.assertEqual([
+        "class: [] A",
+        [
+            'variable: [] int[] a',
+            'variable: [] Runnable r',
+            "method: ['void'] f",
+            ['variable: [] Object o'],
+            ],
+        ], _Parse('class A {\n'
+        '  int[] a = {1, 2};\n'
+        '  Runnable r = new Runnable() { public void run() {} };\n'
+        '  void f() {\n'
+        '    Object o = list.forEach(x -> { g(x); });\n'
+        '  }\n'
+        '}\n'))
+
+  def testLineNumbers(self):
+    nodes = java_parser.JavaLexer('package a;\r\n\rimport b.C;\n\n'
+        'class D {\n  int e;\n}\n').children
+    self.assertEqual([1, 2, 4], [node.line for node in nodes])
+    self.assertEqual([5], [node.line for node in nodes[2].children])
+
+  def testHeaderOnly(self):
+    source = ('package a;\n'
+        'import b.C;\n'
+        '/* { */\n'
+        'import d.E;\n'
+        'class F {\n'
+        '  int g;\n'
+        '}\n'
+        'import h.I;\n')
+    lexer = java_parser.JavaLexer(source, header_only=True)
+    self.assertTrue(lexer.header_only)
+    self.assertEqual([
+        'package: a',
+        "import: ['b'] C",
+        "import: ['d'] E",
+        ], _Tree(lexer.children))
+    self.assertEqual(_Parse(source)[:3], _Tree(lexer.children))
+
+  def testFileObject(self):
+    with open(os.path.join(ROOT_DIR, 'test', 'java', 'Import.java')) as f:
+      from_file = _Tree(java_parser.JavaLexer(f).children)
+    with open(os.path.join(ROOT_DIR, 'test', 'java', 'Import.java')) as f:
+      self.assertEqual(_Parse(f.read()), from_file)
+
+if __name__ == '__main__':
+  unittest.main()
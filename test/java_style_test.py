@@ -0,0 +1,186 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2015 Sean Kirmani <sean@kirmani.io>
+#
+# Distributed under terms of the MIT license.
+"""Unit tests for presubmit_rules/java_style.py.
+
+  python test/java_style_test.py
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import presubmit_support
+from parsers import java_parser
+from presubmit_rules import java_style
+
+def _ImportLines(source):
+  """Returns the _ImportLine objects of the Java source, ranked."""
+  lines = source.split('\n')
+  import_lines = [java_style._ImportLine(lines[node.line - 1].rstrip(),
+      node.line, '.'.join(node.package + [node.name]), node.is_static)
+      for node in java_parser.JavaLexer(source).children
+      if node.thing == java_parser.IMPORT]
+  return import_lines, java_style._SortedImports(import_lines)
+
+def _ImportsDiff(source):
+  return java_style._ImportsDiff(*_ImportLines(source))
+
+def _LongestIncreasingLength(values):
+  """The length of the longest increasing subsequence, the slow way."""
+  lengths = []
+  for i, value in enumerate(values):
+    lengths.append(1 + max([lengths[j] for j in range(i)
+        if values[j] < value] or [0]))
+  return max(lengths or [0])
+
+class ImportLineTest(unittest.TestCase):
+  def testGroups(self):
+    import_lines, _ = _ImportLines('\n'.join([
+        'package a;',
+        'import static org.junit.Assert.assertEquals;',
+        'import com.google.common.base.Joiner;',
+        'import android.os.Bundle;',
+        'import java.util.List;',
+        'import javax.inject.Inject;',
+        ]))
+    self.assertEqual([0, 1, 2, 3, 4], [line.group for line in import_lines])
+
+  def testIndentedAndSpacedImports(self):
+    import_lines, _ = _ImportLines('\n'.join([
+        'package a;',
+        '  import com.google.common.base.Joiner;',
+        'import   java.util.List;',
+        'import static  org.junit.Assert.assertEquals;',
+        '\timport javax.inject.Inject;',
+        ]))
+    self.assertEqual([1, 3, 0, 4], [line.group for line in import_lines])
+
+class ImportsDiffTest(unittest.TestCase):
+  def testSortedAndSpaced(self):
+    self.assertEqual([], _ImportsDiff('\n'.join([
+        'package a;',
+        '',
+        'import static org.junit.Assert.assertEquals;',
+        '',
+        'import com.google.common.base.Joiner;',
+        '',
+        'import android.os.Bundle;',
+        'import org.junit.Test;',
+        '',
+        'import java.util.ArrayList;',
+        'import java.util.List;',
+        ])))
+
+  def testOutOfOrder(self):
+    # List and Map stay, as the longest run already in order.
+    self.assertEqual([
+        (5, 'Out of order, belongs before line 3.'),
+        ], _ImportsDiff('\n'.join([
+        'package a;',
+        '',
+        'import java.util.List;',
+        'import java.util.Map;',
+        'import java.util.ArrayList;',
+        ])))
+
+  def testSpacing(self):
+    self.assertEqual([
+        (5, 'Should directly follow the import on line 3.'),
+        (6, 'Should be separated from the import on line 5 by one blank '
+            'line.'),
+        ], _ImportsDiff('\n'.join([
+        'package a;',
+        '',
+        'import android.os.Bundle;',
+        '',
+        'import org.junit.Test;',
+        'import java.util.List;',
+        ])))
+
+  def testKeepsLongestRunInPlace(self):
+    rand = random.Random(7)
+    names = ['java.util.C%03d' % i for i in range(60)]
+    for _ in range(50):
+      count = rand.randint(2, 60)
+      chosen = rand.sample(names, count)
+      source = '\n'.join(['package a;', ''] +
+          ['import %s;' % name for name in chosen])
+      import_lines, sorted_imports = _ImportLines(source)
+      moved = [line_num for line_num, message in
+          java_style._ImportsDiff(import_lines, sorted_imports)
+          if message.startswith('Out of order')]
+      ranks = [line.rank for line in import_lines]
+      self.assertEqual(count - _LongestIncreasingLength(ranks), len(moved))
+      # What stays is in order.
+      kept = [line.rank for line in import_lines
+          if line.line_num not in moved]
+      self.assertEqual(sorted(kept), kept)
+
+def _CheckImports(root, path):
+  """Returns the (line, text) of each error of the import check on path."""
+  config = presubmit_support.LoadConfig(
+      os.path.join(ROOT_DIR, presubmit_support.PRESUBMIT_PREF_FILE))
+  change = presubmit_support.Change(root,
+      [(presubmit_support.ACTION_MODIFIED, path)], config)
+  input_api = presubmit_support.InputApi(
+      os.path.join(root, 'PRESUBMIT.py'), False, change)
+  f, = change.AffectedFiles()
+  results = java_style._CheckImportOrderingAndSpacing(input_api,
+      presubmit_support.OutputApi(), f)
+  return [(item.line, item.text) for result in results
+      for item in result._items]
+
+class CheckImportOrderingAndSpacingTest(unittest.TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def _CheckSource(self, source):
+    with open(os.path.join(self.root, 'X.java'), 'wb') as f:
+      f.write(source)
+    return _CheckImports(self.root, 'X.java')
+
+  def testStrayCarriageReturn(self):
+    # Lines are numbered the way ReadFileLines splits them, on \n only.
+    self.assertEqual([], self._CheckSource(
+        'package a;\r\rimport b.C;\n'))
+    self.assertEqual([
+        (3, 'Out of order, belongs after line 4.'),
+        ], self._CheckSource('package a;\n// a\rb\nimport b.C;\n'
+        'import a.B;\nclass X {}\n')[1:])
+
+  def testCarriageReturnLineFeed(self):
+    self.assertEqual([], self._CheckSource(
+        'package a;\r\n\r\nimport a.B;\r\nimport b.C;\r\n'))
+
+  def testImportFixture(self):
+    items = _CheckImports(ROOT_DIR, 'test/java/Import.java')
+    self.assertEqual((10, 'Imports were not in correct format. Change the '
+        'imports to the following sorted import format:\n'
+        '    import static org.junit.assert.*;\n'
+        '    \n'
+        '    import com.google.blah;\n'
+        '    \n'
+        '    import java.util.ArrayList;\n'
+        '    import java.util.List;'), items[0])
+    self.assertEqual([
+        (10, 'Out of order, belongs after line 11.'),
+        (11, 'Out of order, belongs after line 14.'),
+        (14, 'Should be separated from the import on line 13 by one blank '
+            'line.'),
+        ], items[1:])
+
+if __name__ == '__main__':
+  unittest.main()
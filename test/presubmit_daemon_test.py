@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2015 Sean Kirmani <sean@kirmani.io>
+#
+# Distributed under terms of the MIT license.
+"""Unit tests for presubmit_daemon.py.
+
+  python test/presubmit_daemon_test.py
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import presubmit_daemon
+
+DAEMON = os.path.join(ROOT_DIR, 'presubmit_daemon.py')
+
+PRESUBMIT = '''
+def CheckChangeOnUpload(input_api, output_api):
+  return [output_api.PresubmitError('Saw %d files.' %
+      len(input_api.GetAffectedFiles()))]
+'''
+
+class DaemonTest(unittest.TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.socket = os.path.join(self.root, 'daemon.sock')
+    self.tree = os.path.join(self.root, 'tree')
+    os.mkdir(self.tree)
+    self.WriteFile('presubmit.xml',
+        '<presubmit name="test" basedir="."/>')
+    self.WriteFile('PRESUBMIT.py', PRESUBMIT)
+    self.WriteFile('A.java', 'class A {}\n')
+    self.server = None
+
+  def tearDown(self):
+    if self.server and self.server.poll() is None:
+      self.server.kill()
+      self.server.wait()
+    shutil.rmtree(self.root)
+
+  def WriteFile(self, path, contents):
+    with open(os.path.join(self.tree, path), 'wb') as f:
+      f.write(contents)
+
+  def Serve(self):
+    with open(os.devnull, 'wb') as devnull:
+      self.server = subprocess.Popen([sys.executable, DAEMON, 'serve',
+          '--socket', self.socket], stdout=devnull, stderr=devnull)
+    deadline = time.time() + 10
+    while presubmit_daemon.SendRequest(self.socket,
+        {'command': 'ping'}) is None:
+      self.assertIsNone(self.server.poll())
+      self.assertLess(time.time(), deadline)
+      time.sleep(0.05)
+
+  def Check(self):
+    """Runs check in the tree. Returns its exit code and output."""
+    with open(os.devnull, 'rb') as devnull:
+      process = subprocess.Popen([sys.executable, DAEMON, 'check',
+          '--socket', self.socket, '--no-cache'], cwd=self.tree,
+          stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output, _ = process.communicate()
+    return process.returncode, output
+
+  def testServeCheckStop(self):
+    self.Serve()
+    exit_code, output = self.Check()
+    self.assertEqual(1, exit_code)
+    self.assertIn('Saw 3 files.', output)
+    # The warm state of the daemon picks up new files.
+    self.WriteFile('B.java', 'class B {}\n')
+    exit_code, output = self.Check()
+    self.assertEqual(1, exit_code)
+    self.assertIn('Saw 4 files.', output)
+
+    self.assertEqual(0, presubmit_daemon.SendRequest(self.socket,
+        {'command': 'stop'}))
+    deadline = time.time() + 10
+    while self.server.poll() is None:
+      self.assertLess(time.time(), deadline)
+      time.sleep(0.05)
+    self.assertEqual(0, self.server.returncode)
+    self.assertFalse(os.path.exists(self.socket))
+
+  def testCheckWithoutDaemon(self):
+    exit_code, output = self.Check()
+    self.assertEqual(1, exit_code)
+    self.assertIn('Saw 3 files.', output)
+    self.assertIsNone(presubmit_daemon.SendRequest(self.socket,
+        {'command': 'stop'}))
+
+if __name__ == '__main__':
+  unittest.main()
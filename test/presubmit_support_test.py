@@ -0,0 +1,857 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2015 Sean Kirmani <sean@kirmani.io>
+#
+# Distributed under terms of the MIT license.
+"""Unit tests for presubmit_support.py.
+
+  python test/presubmit_support_test.py
+"""
+import cStringIO
+import os
+import multiprocessing
+import random
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import presubmit_support
+
+class TempTreeTest(unittest.TestCase):
+  """A test with a repository root of its own, removed afterwards."""
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def WriteFile(self, path, contents=''):
+    path = os.path.join(self.root, path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+      f.write(contents)
+
+  def LoadConfig(self, xml='<presubmit name="test" basedir="."/>'):
+    self.WriteFile(presubmit_support.PRESUBMIT_PREF_FILE, xml)
+    return presubmit_support.LoadConfig(
+        os.path.join(self.root, presubmit_support.PRESUBMIT_PREF_FILE))
+
+  def MakeChange(self, paths, config=None):
+    affected_paths = [(presubmit_support.ACTION_MODIFIED, path)
+        for path in paths]
+    return presubmit_support.Change(self.root, affected_paths,
+        config or self.LoadConfig())
+
+class FilePatternTest(unittest.TestCase):
+  def assertPattern(self, pattern, directory, extension):
+    file_pattern = presubmit_support._FilePattern(pattern)
+    self.assertEqual((directory, extension),
+        (file_pattern.directory, file_pattern.extension))
+
+  def testExtension(self):
+    self.assertPattern(r'.+\.java$', '', '.java')
+    self.assertPattern(r'.*\.py$', '', '.py')
+
+  def testDirectoryAndExtension(self):
+    self.assertPattern(r'src/main/.+\.java$', 'src/main/', '.java')
+    self.assertPattern(r'^src/.*', 'src/', None)
+    self.assertPattern(r'src\/x\.py$', 'src/', '.py')
+    self.assertPattern(r'a/b\.java$', 'a/', '.java')
+    self.assertPattern(r'third-party/lib_1/.*', 'third-party/lib_1/', None)
+
+  def testQuantifierShortensDirectory(self):
+    self.assertPattern(r'src/a*/x\.py$', 'src/', '.py')
+    self.assertPattern(r'foo/bar?/x', 'foo/', None)
+    self.assertPattern(r'foo/b+/x', 'foo/', None)
+    self.assertPattern(r'foo/b{2}/x', 'foo/', None)
+
+  def testWildcardEndsDirectory(self):
+    self.assertPattern(r'src/main.java$', 'src/', None)
+    self.assertPattern(r'src/[ab]/x\.java$', 'src/', '.java')
+    self.assertPattern(r'src(/x)', '', None)
+
+  def testEscapedBackslashIsNotAnExtension(self):
+    # A literal backslash followed by any character.
+    self.assertPattern(r'.+\\.java$', '', None)
+    self.assertPattern(r'.+\\\.java$', '', '.java')
+
+  def testUnanchoredExtension(self):
+    self.assertPattern(r'.+\.java', '', None)
+    self.assertPattern(r'.+\.java$|x', '', None)
+
+  def testAlternativesAndFlagsTellNothing(self):
+    self.assertPattern(r'src/a\.java$|lib/b\.java$', '', None)
+    self.assertPattern(r'(?i)src/.+\.JAVA$', '', None)
+    self.assertPattern(r'(?:src|lib)/.+\.java$', '', None)
+
+class FileIndexTest(TempTreeTest):
+  PATHS = [
+      'a.java',
+      'src/A.java',
+      'src/b.py',
+      'src/main/C.java',
+      'src/main/d.txt',
+      'srcx/E.java',
+      'lib/F.java',
+      'Makefile',
+      ]
+
+  def Candidates(self, pattern):
+    files = [presubmit_support.AffectedFile(path, self.root)
+        for path in self.PATHS]
+    index = presubmit_support._FileIndex(files)
+    return sorted(files[position].LocalPath() for position in
+        index.Candidates(presubmit_support._FilePattern(pattern)))
+
+  def testAnyFile(self):
+    self.assertEqual(sorted(self.PATHS), self.Candidates(r'.*'))
+
+  def testByExtension(self):
+    self.assertEqual(['a.java', 'lib/F.java', 'src/A.java',
+        'src/main/C.java', 'srcx/E.java'], self.Candidates(r'.+\.java$'))
+    self.assertEqual([], self.Candidates(r'.+\.cc$'))
+
+  def testByDirectory(self):
+    self.assertEqual(['src/A.java', 'src/b.py', 'src/main/C.java',
+        'src/main/d.txt'], self.Candidates(r'src/.*'))
+    self.assertEqual([], self.Candidates(r'out/.*'))
+
+  def testByDirectoryAndExtension(self):
+    self.assertEqual(['src/A.java', 'src/main/C.java'],
+        self.Candidates(r'src/.+\.java$'))
+    self.assertEqual(['src/main/C.java'],
+        self.Candidates(r'src/main/.+\.java$'))
+
+  def testNameWithoutDirectoryOrExtension(self):
+    # Nothing narrows the search, so every file is a candidate.
+    self.assertEqual(sorted(self.PATHS), self.Candidates(r'Makefile$'))
+
+class ChangeAffectedFilesTest(TempTreeTest):
+  def testFilters(self):
+    change = self.MakeChange(['a/X.java', 'a/y.py', 'a/third_party/Z.java',
+        'b/W.java'])
+    def Paths(files):
+      return [f.LocalPath() for f in files]
+    self.assertEqual(['a/X.java', 'a/third_party/Z.java', 'b/W.java'],
+        Paths(change.AffectedFiles(include=[r'.+\.java$'])))
+    self.assertEqual(['a/X.java', 'b/W.java'],
+        Paths(change.AffectedFiles(include=[r'.+\.java$'],
+            exclude=[r'(|.*/)third_party/.*'])))
+    self.assertEqual(['a/y.py'],
+        Paths(change.AffectedFiles(include=[r'a/.*'],
+            file_filter=lambda f: not f.LocalPath().endswith('.java'))))
+    self.assertEqual(['a/X.java', 'a/y.py', 'b/W.java'],
+        Paths(change.AffectedFiles(exclude=[r'.*/third_party/.*'])))
+
+  def testIdenticalCallsShareResults(self):
+    change = self.MakeChange(['a/X.java', 'b/y.py'])
+    self.assertIs(change.AffectedFiles(include=[r'.+\.java$']),
+        change.AffectedFiles(include=(r'.+\.java$',)))
+
+  def testMatchesRegexesOnEveryFile(self):
+    # The index must never drop a file the regexes match.
+    rand = random.Random(42)
+    parts = ['src', 'lib', 'main', 'a-b', 'x_1', 'third_party']
+    names = ['A.java', 'b.py', 'c.txt', 'Makefile', 'd.java.orig', 'e.JAVA']
+    paths = set()
+    for _ in range(300):
+      depth = rand.randint(0, 3)
+      paths.add('/'.join([rand.choice(parts) for _ in range(depth)] +
+          [rand.choice(names)]))
+    paths = sorted(paths)
+    change = self.MakeChange(paths)
+    patterns = [r'.+\.java$', r'.*\.py$', r'src/.*', r'^src/main/.+\.java$',
+        r'lib/.*\.txt$', r'(|.*/)third_party/.*', r'src/a*/.*', r'x_1\/.*',
+        r'.*/Makefile$', r'Makefile', r'.+\.java', r'(?i).+\.java$',
+        r'src/.+\.java$|lib/.+\.py$', r'.+\\.java$', r'a-b/[lm].*',
+        r'src/main.java$', r'.*']
+    for _ in range(200):
+      include = rand.sample(patterns, rand.randint(1, 3))
+      exclude = rand.sample(patterns, rand.randint(0, 1))
+      expected = [path for path in paths
+          if any(re.match(p, path) for p in include) and
+          not any(re.match(p, path) for p in exclude)]
+      self.assertEqual(expected, [f.LocalPath() for f in
+          change.AffectedFiles(include=include, exclude=exclude)],
+          (include, exclude))
+
+class InputApiTest(TempTreeTest):
+  def testGetAffectedFilesIsAList(self):
+    # Scripts may change the list they get, as they always could.
+    change = self.MakeChange(['b/W.java', 'a/X.java'])
+    input_api = presubmit_support.InputApi(
+        os.path.join(self.root, 'PRESUBMIT.py'), False, change)
+    files = input_api.GetAffectedFiles()
+    self.assertIsInstance(files, list)
+    files.sort(key=lambda f: f.LocalPath())
+    files += files[:1]
+    del files[0]
+    self.assertEqual(['b/W.java', 'a/X.java'],
+        [f.LocalPath() for f in files])
+    self.assertEqual(['b/W.java', 'a/X.java'],
+        [f.LocalPath() for f in input_api.GetAffectedFiles()])
+    self.assertIs(files[0], input_api.GetAffectedFiles()[0])
+    self.assertIsInstance(input_api.GetDeletedFiles(), list)
+
+class ShardPathsTest(TempTreeTest):
+  def setUp(self):
+    super(ShardPathsTest, self).setUp()
+    self.paths = []
+    for i in range(40):
+      path = 'd%d/F%d.java' % (i % 3, i)
+      self.WriteFile(path, 'x' * (i * 37 % 500))
+      self.paths.append((presubmit_support.ACTION_MODIFIED, path))
+    self.paths.append((presubmit_support.ACTION_DELETED, 'gone/G.java'))
+
+  def Shards(self, affected_paths, total_shards):
+    return [presubmit_support.ShardPaths(self.root, affected_paths, index,
+        total_shards) for index in range(total_shards)]
+
+  def testEveryPathInExactlyOneShard(self):
+    for total_shards in (1, 2, 3, 7):
+      shards = self.Shards(self.paths, total_shards)
+      selected = [path for shard in shards for path in shard]
+      self.assertEqual(sorted(self.paths), sorted(selected))
+      for shard in shards:
+        # In the order of affected_paths.
+        self.assertEqual([p for p in self.paths if p in shard], shard)
+
+  def testSplitDoesNotDependOnOrder(self):
+    shuffled = list(self.paths)
+    random.Random(3).shuffle(shuffled)
+    self.assertEqual([sorted(shard) for shard in self.Shards(self.paths, 3)],
+        [sorted(shard) for shard in self.Shards(shuffled, 3)])
+
+  def testBalancesBytes(self):
+    shards = self.Shards(self.paths, 3)
+    sizes = [sum(os.path.getsize(os.path.join(self.root, path))
+        for action, path in shard
+        if action != presubmit_support.ACTION_DELETED) for shard in shards]
+    self.assertLessEqual(max(sizes) - min(sizes), 500)
+
+  def testLargeFileGetsAShardOfItsOwn(self):
+    self.WriteFile('big/Big.java', 'x' * 100000)
+    paths = self.paths + [(presubmit_support.ACTION_MODIFIED,
+        'big/Big.java')]
+    for shard in self.Shards(paths, 2):
+      if (presubmit_support.ACTION_MODIFIED, 'big/Big.java') in shard:
+        self.assertEqual(1, len(shard))
+
+  def testLeavesOutShardResults(self):
+    self.WriteFile('presubmit-shard-0-of-2.json', 'x' * 10000)
+    paths = self.paths + [(presubmit_support.ACTION_MODIFIED,
+        'presubmit-shard-0-of-2.json')]
+    self.assertEqual(self.Shards(self.paths, 2), self.Shards(paths, 2))
+
+  def testMissingShard(self):
+    self.assertRaises(presubmit_support.PresubmitFailure,
+        presubmit_support.ShardPaths, self.root, self.paths, 2, 2)
+    self.assertRaises(presubmit_support.PresubmitFailure,
+        presubmit_support.ShardPaths, self.root, self.paths, -1, 2)
+
+class MergeShardsTest(TempTreeTest):
+  def Result(self, result_type, message, path, line, presubmit_path):
+    result = result_type(message,
+        [presubmit_support._PresubmitItem(path, line, 'text', 3)])
+    presubmit_support._SetResultOrigin([result], presubmit_path,
+        'CheckChangeOnUpload', 0.5)
+    return result
+
+  def WriteShard(self, shard, results, elapsed=0.5):
+    path = os.path.join(self.root, presubmit_support.DEFAULT_SHARD_OUTPUT
+        % (shard[0], shard[1]))
+    with open(path, 'w') as f:
+      streamer = presubmit_support._ResultStreamer(json_output=f)
+      for result in results:
+        result.elapsed = elapsed
+      streamer.Write(results)
+      streamer.WriteSummary(1.0, shard)
+    return path
+
+  def Merge(self, paths):
+    output_stream = cStringIO.StringIO()
+    output = presubmit_support.MergeShards(paths, output_stream, None, False)
+    return output, output_stream.getvalue()
+
+  def testMergesAndDedupes(self):
+    warning = presubmit_support._PresubmitPromptWarning
+    error = presubmit_support._PresubmitError
+    # Whole-change checks run on every shard, with different timings.
+    paths = [
+        self.WriteShard((0, 2), [self.Result(warning, 'W', 'a/A.java', 1,
+            '/r/PRESUBMIT.py'), self.Result(error, 'Whole change', 'x', 1,
+            '/r/PRESUBMIT.py')], elapsed=0.1),
+        self.WriteShard((1, 2), [self.Result(warning, 'W', 'b/B.java', 2,
+            '/r/PRESUBMIT.py'), self.Result(error, 'Whole change', 'x', 1,
+            '/r/PRESUBMIT.py')], elapsed=0.9),
+        ]
+    output, text = self.Merge(paths)
+    self.assertFalse(output.should_continue())
+    self.assertEqual(1, text.count('Whole change'))
+    self.assertIn('a/A.java:1:3', text)
+    self.assertIn('b/B.java:2:3', text)
+    self.assertEqual(1, text.count('** Presubmit ERRORS **'))
+
+  def testPassesWithoutResults(self):
+    output, text = self.Merge([self.WriteShard((0, 2), []),
+        self.WriteShard((1, 2), [])])
+    self.assertTrue(output.should_continue())
+    self.assertIn('Presubmit checks passed.', text)
+
+  def testMissingShard(self):
+    paths = [self.WriteShard((0, 3), []), self.WriteShard((2, 3), [])]
+    with self.assertRaisesRegexp(presubmit_support.PresubmitFailure,
+        'shard 1 of 3 are missing'):
+      self.Merge(paths)
+
+  def testDuplicateShard(self):
+    path = self.WriteShard((0, 2), [])
+    copy = os.path.join(self.root, 'copy.json')
+    shutil.copy(path, copy)
+    with self.assertRaisesRegexp(presubmit_support.PresubmitFailure,
+        'both results of shard 0 of 2'):
+      self.Merge([path, copy, self.WriteShard((1, 2), [])])
+
+  def testDifferentNumbersOfShards(self):
+    with self.assertRaisesRegexp(presubmit_support.PresubmitFailure,
+        'different numbers of shards'):
+      self.Merge([self.WriteShard((0, 1), []), self.WriteShard((0, 2), []),
+          self.WriteShard((1, 2), [])])
+
+  def testIncompleteShard(self):
+    path = self.WriteShard((0, 1), [self.Result(
+        presubmit_support._PresubmitPromptWarning, 'W', 'a/A.java', 1,
+        '/r/PRESUBMIT.py')])
+    with open(path) as f:
+      lines = f.readlines()
+    with open(path, 'w') as f:
+      # Cut off before the summary, e.g. by a crash.
+      f.writelines(lines[:-1])
+    with self.assertRaisesRegexp(presubmit_support.PresubmitFailure,
+        'not the result file of a complete shard'):
+      self.Merge([path])
+
+  def testUnreadableShard(self):
+    with self.assertRaisesRegexp(presubmit_support.PresubmitFailure,
+        'Cannot read the shard results'):
+      self.Merge([os.path.join(self.root, 'missing.json')])
+
+class GlobToRegexTest(unittest.TestCase):
+  def assertMatches(self, pattern, matched, unmatched):
+    regex = re.compile(presubmit_support._GlobToRegex(pattern))
+    for path in matched:
+      self.assertTrue(regex.match(path), (pattern, path))
+    for path in unmatched:
+      self.assertFalse(regex.match(path), (pattern, path))
+
+  def testStar(self):
+    self.assertMatches('*.java', ['A.java', '.java'], ['a/A.java', 'A.jav'])
+    self.assertMatches('a/*', ['a/b', 'a/'], ['a/b/c'])
+
+  def testDoubleStar(self):
+    self.assertMatches('**/foo', ['foo', 'a/foo', 'a/b/foo'], ['afoo'])
+    self.assertMatches('a/**', ['a/b', 'a/b/c'], ['b/a/c'])
+    self.assertMatches('a/**/b', ['a/b', 'a/x/b', 'a/x/y/b'], ['a/xb'])
+
+  def testQuestionMark(self):
+    self.assertMatches('a?c', ['abc'], ['ac', 'a/c', 'abbc'])
+
+  def testCharacterClasses(self):
+    self.assertMatches('[ab].txt', ['a.txt', 'b.txt'], ['c.txt'])
+    self.assertMatches('[!ab].txt', ['c.txt'], ['a.txt'])
+    self.assertMatches('[a-c]x', ['bx'], ['dx'])
+    self.assertMatches('[]x', ['[]x'], ['x'])
+
+  def testEscapes(self):
+    self.assertMatches(r'\*.txt', ['*.txt'], ['a.txt'])
+    self.assertMatches('a+b(c).txt', ['a+b(c).txt'], ['aab(c).txt'])
+
+class IgnoreRulesTest(unittest.TestCase):
+  def Ignored(self, patterns, path, local_dir=''):
+    return presubmit_support._IgnoreRules(local_dir, patterns).MatchPath(path)
+
+  def testNameMatchesAtAnyDepth(self):
+    self.assertTrue(self.Ignored(['*.class'], 'A.class'))
+    self.assertTrue(self.Ignored(['*.class'], 'a/b/A.class'))
+    self.assertTrue(self.Ignored(['build'], 'a/build/x.java'))
+    self.assertFalse(self.Ignored(['*.class'], 'a/A.java'))
+
+  def testSlashAnchors(self):
+    self.assertTrue(self.Ignored(['/build'], 'build/x'))
+    self.assertFalse(self.Ignored(['/build'], 'a/build/x'))
+    self.assertTrue(self.Ignored(['a/build'], 'a/build/x'))
+    self.assertFalse(self.Ignored(['a/build'], 'b/a/build/x'))
+
+  def testDirectoryOnly(self):
+    self.assertTrue(self.Ignored(['out/'], 'out/x'))
+    self.assertFalse(self.Ignored(['out/'], 'a/out'))
+
+  def testNegation(self):
+    self.assertFalse(self.Ignored(['*.log', '!keep.log'], 'keep.log'))
+    self.assertTrue(self.Ignored(['!keep.log', '*.log'], 'keep.log'))
+    # A file in an ignored directory cannot be re-included.
+    self.assertTrue(self.Ignored(['out/', '!out/keep'], 'out/keep'))
+
+  def testCommentsBlanksAndSpaces(self):
+    self.assertFalse(self.Ignored(['# a', '', '   '], 'a'))
+    self.assertTrue(self.Ignored(['\\#a'], '#a'))
+    self.assertTrue(self.Ignored(['a   '], 'a'))
+    self.assertTrue(self.Ignored(['a\\ '], 'a '))
+    self.assertTrue(self.Ignored(['\\!a'], '!a'))
+
+  def testLocalDirectory(self):
+    self.assertTrue(self.Ignored(['/x'], 'sub/x', 'sub/'))
+    self.assertFalse(self.Ignored(['/x'], 'x', 'sub/'))
+    self.assertFalse(self.Ignored(['/x'], 'other/x', 'sub/'))
+
+def _HasGit():
+  try:
+    subprocess.check_output(['git', '--version'])
+  except OSError:
+    return False
+  return True
+
+@unittest.skipUnless(_HasGit(), 'needs git')
+class LocalPathsTest(TempTreeTest):
+  """Checks that _LocalPaths leaves out what git ignores."""
+
+  def testMatchesGit(self):
+    subprocess.check_call(['git', 'init', '-q', self.root])
+    self.WriteFile('.git/info/exclude', '*.swp\n')
+    self.WriteFile('.gitignore', '\n'.join([
+        '# Build output',
+        'out/',
+        '*.class',
+        '!Keep.class',
+        '/top.txt',
+        'docs/**/*.html',
+        'logs/*',
+        '!logs/keep.log',
+        '[Tt]emp*',
+        ]) + '\n')
+    self.WriteFile('sub/.gitignore', '/local.txt\n!*.tmp2\nx?z\n')
+    paths = [
+        'A.java', 'A.class', 'Keep.class', 'top.txt', 'sub/top.txt',
+        'out/B.java', 'sub/out/C.java', 'docs/a.html', 'docs/x/y/b.html',
+        'docs/c.md', 'logs/a.log', 'logs/keep.log', 'Temp1', 'temp/x',
+        'item', 'sub/local.txt', 'sub/deeper/local.txt', 'sub/xyz', 'sub/xz',
+        'sub/a.tmp2', 'a.swp', 'sub/b.swp', 'sub/d/Temporary/e',
+        ]
+    for path in paths:
+      self.WriteFile(path)
+    config = self.LoadConfig()
+    expected = subprocess.check_output(['git', 'ls-files', '--others',
+        '--exclude-standard'], cwd=self.root).splitlines()
+    actual = presubmit_support._LocalPaths(self.root, config)
+    expected.remove(presubmit_support.PRESUBMIT_PREF_FILE)
+    actual = [path for path in actual
+        if path != presubmit_support.PRESUBMIT_PREF_FILE]
+    self.assertEqual(sorted(expected), sorted(actual))
+
+  def testExcludes(self):
+    self.WriteFile('a/B.java')
+    self.WriteFile('gen/C.java')
+    self.WriteFile('a/gen/D.java')
+    config = self.LoadConfig('<presubmit name="test" basedir=".">'
+        '<files gitignore="false"><exclude>/gen/</exclude></files>'
+        '</presubmit>')
+    self.assertEqual(['a/B.java', 'a/gen/D.java'],
+        sorted(path for path in presubmit_support._LocalPaths(self.root,
+            config) if path != presubmit_support.PRESUBMIT_PREF_FILE))
+
+class WarmStateTest(TempTreeTest):
+  def setUp(self):
+    super(WarmStateTest, self).setUp()
+    self.state = presubmit_support.WarmState()
+    self.WriteFile('A.java', 'import a.B;\nclass A {}\n')
+
+  def Run(self, path='A.java'):
+    """Returns the AffectedFile of path in a new run."""
+    f, = self.state.AffectedFiles(self.root,
+        [(presubmit_support.ACTION_MODIFIED, path)])
+    return f
+
+  def testKeepsContentsAndTree(self):
+    f = self.Run()
+    data = f.ReadRawBytes()
+    tree = f.JavaTree()
+    f.Release()
+    f = self.Run()
+    self.assertIs(data, f.ReadRawBytes())
+    self.assertIs(tree, f.JavaTree())
+    self.assertIs(tree, f.JavaTree(header_only=True))
+
+  def testHeaderTreeIsReplacedByFullTree(self):
+    f = self.Run()
+    header = f.JavaTree(header_only=True)
+    f.Release()
+    f = self.Run()
+    self.assertIs(header, f.JavaTree(header_only=True))
+    tree = f.JavaTree()
+    self.assertFalse(tree.header_only)
+    f.Release()
+    self.assertIs(tree, self.Run().JavaTree(header_only=True))
+
+  def testChangedFileIsReadAgain(self):
+    f = self.Run()
+    f.ReadRawBytes()
+    f.Release()
+    self.WriteFile('A.java', 'class A { int b; }\n')
+    f = self.Run()
+    self.assertEqual('class A { int b; }\n', f.ReadRawBytes())
+    self.assertEqual(['class'], [node.thing for node in f.JavaTree().children])
+
+  def testWarm(self):
+    # As if a worker process had read the file, which the state never sees.
+    self.Run()
+    self.state.Warm()
+    f = self.Run()
+    self.assertEqual('import a.B;\nclass A {}\n', f.ReadRawBytes())
+    self.assertIs(self.state._GetContents(f.ContentHash()).data,
+        f.ReadRawBytes())
+
+  def testSizeLimit(self):
+    self.state = presubmit_support.WarmState(max_contents_size=30)
+    self.WriteFile('B.java', 'class B {}\n')
+    for path in ('A.java', 'B.java'):
+      f = self.Run(path)
+      f.ReadRawBytes()
+      f.Release()
+    # A.java went first, to make room for B.java.
+    self.assertEqual(['class B {}\n'],
+        [contents.data for contents in self.state._contents.values()])
+    self.assertEqual(11, self.state._contents_size)
+
+class ResultCacheTest(TempTreeTest):
+  def setUp(self):
+    super(ResultCacheTest, self).setUp()
+    self.output_api = presubmit_support.OutputApi()
+
+  def Put(self, cache, count, start=0):
+    for i in range(start, start + count):
+      cache.Put(('key', i), [self.output_api.PresubmitPromptWarning('x' * 50,
+          [presubmit_support._PresubmitItem('A.java', i, 'text', 1)])])
+
+  def DiskSize(self):
+    return sum(os.path.getsize(os.path.join(directory, name))
+        for directory, _, names in os.walk(self.root) for name in names
+        if name != presubmit_support._CACHE_SIZE_FILE)
+
+  def EstimatedSize(self):
+    with open(os.path.join(self.root,
+        presubmit_support._CACHE_SIZE_FILE)) as f:
+      return int(f.read())
+
+  def testRoundTrip(self):
+    cache = presubmit_support.ResultCache(self.root)
+    self.Put(cache, 1)
+    result, = cache.Get(('key', 0), self.output_api)
+    self.assertTrue(result.should_prompt)
+    item, = result._items
+    self.assertEqual(('A.java', 0, 'text', 1),
+        (item.file, item.line, item.text, item.column))
+    self.assertIsNone(cache.Get(('key', 1), self.output_api))
+    self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+  def testTrimKeepsSizeUnderMaximum(self):
+    cache = presubmit_support.ResultCache(self.root, 2000)
+    self.Put(cache, 50)
+    cache.Trim()
+    self.assertLessEqual(self.DiskSize(), 2000)
+    self.assertEqual(self.DiskSize(), self.EstimatedSize())
+    # The most recently used entries are kept.
+    self.assertIsNotNone(cache.Get(('key', 49), self.output_api))
+    self.assertIsNone(cache.Get(('key', 0), self.output_api))
+
+  def testTrimAddsWhatWasWritten(self):
+    cache = presubmit_support.ResultCache(self.root)
+    self.Put(cache, 5)
+    cache.Trim()
+    size = self.EstimatedSize()
+    self.assertEqual(self.DiskSize(), size)
+    self.Put(cache, 5, start=5)
+    cache.Trim()
+    self.assertEqual(2 * size, self.EstimatedSize())
+    self.assertEqual(self.DiskSize(), self.EstimatedSize())
+
+  def testTrimWithoutWritesDoesNotWalk(self):
+    cache = presubmit_support.ResultCache(self.root)
+    self.Put(cache, 5)
+    cache.Trim()
+    walks = []
+    old_walk = os.walk
+    def Walk(*args):
+      walks.append(args)
+      return old_walk(*args)
+    presubmit_support.os.walk = Walk
+    try:
+      cache.Get(('key', 0), self.output_api)
+      cache.Trim()
+      # Under the maximum, writes do not need a walk either.
+      self.Put(cache, 1, start=5)
+      cache.Trim()
+    finally:
+      presubmit_support.os.walk = old_walk
+    self.assertEqual([], walks)
+
+  def testWorkersReportWrites(self):
+    cache = presubmit_support.ResultCache(self.root)
+    self.Put(cache, 3)
+    hits, misses, written = cache.TakeCounts()
+    self.assertEqual(self.DiskSize(), written)
+    other = presubmit_support.ResultCache(self.root)
+    other.AddCounts(hits, misses, written)
+    other.Trim()
+    self.assertEqual(self.DiskSize(), self.EstimatedSize())
+
+@unittest.skipUnless(_HasGit(), 'needs git')
+class GitTreeTest(TempTreeTest):
+  """A test in a git repository of its own."""
+
+  def setUp(self):
+    super(GitTreeTest, self).setUp()
+    self.Git('init', '-q')
+    self.lines = ['line %d\n' % i for i in range(1, 21)]
+
+  def Git(self, *args):
+    return subprocess.check_output(['git', '-c', 'user.name=test', '-c',
+        'user.email=test@example.com', '-c', 'core.fileMode=true'] +
+        list(args), cwd=self.root)
+
+  def Commit(self, files):
+    for path, lines in files.iteritems():
+      self.WriteFile(path, ''.join(lines))
+    self.Git('add', '-A')
+    self.Git('commit', '-q', '-m', 'base')
+
+class GitAffectedPathsTest(GitTreeTest):
+  def AffectedPaths(self):
+    return sorted(presubmit_support._GitAffectedPaths(self.root, 'HEAD'),
+        key=lambda (action, path): path)
+
+  def testActions(self):
+    self.Commit({'A.java': self.lines, 'B.java': self.lines})
+    self.WriteFile('A.java', 'changed\n')
+    os.remove(os.path.join(self.root, 'B.java'))
+    self.WriteFile('C.java', 'new\n')
+    self.Git('add', '-A')
+    self.assertEqual([
+        (presubmit_support.ACTION_MODIFIED, 'A.java'),
+        (presubmit_support.ACTION_DELETED, 'B.java'),
+        (presubmit_support.ACTION_ADDED, 'C.java'),
+        ], self.AffectedPaths())
+
+  def testQuotedPaths(self):
+    # git quotes these unless run with -z.
+    names = ['\xc3\xa9t\xc3\xa9.java', 'a b.java', 'tab\there.java',
+        'quote".java']
+    self.Commit(dict((name, self.lines) for name in names))
+    for name in names:
+      self.WriteFile(name, 'changed\n')
+    self.assertEqual([(presubmit_support.ACTION_MODIFIED, name)
+        for name in sorted(names)], self.AffectedPaths())
+
+class GitChangedLinesTest(GitTreeTest):
+  def ChangedLines(self):
+    return presubmit_support._GitChangedLines(self.root, 'HEAD')
+
+  def testHunks(self):
+    self.Commit({'A.java': self.lines})
+    lines = list(self.lines)
+    lines[1] = 'changed\n'
+    # Two lines inserted after line 5, now lines 6 and 7.
+    lines[5:5] = ['new\n', 'new\n']
+    # Old lines 10 and 11 deleted; nothing to check for them.
+    del lines[11:13]
+    lines.append('last\n')
+    self.WriteFile('A.java', ''.join(lines))
+    self.assertEqual({'A.java': [2, 6, 7, 21]}, self.ChangedLines())
+
+  def testAddedAndDeletedFiles(self):
+    self.Commit({'A.java': self.lines, 'old/B.java': self.lines})
+    self.WriteFile('new/C.java', 'a\nb\nc\n')
+    self.Git('add', 'new/C.java')
+    os.remove(os.path.join(self.root, 'old/B.java'))
+    self.assertEqual({'new/C.java': [1, 2, 3]}, self.ChangedLines())
+
+  def testOnlyDeletedLines(self):
+    self.Commit({'A.java': self.lines})
+    self.WriteFile('A.java', ''.join(self.lines[:5] + self.lines[8:]))
+    self.assertEqual({'A.java': []}, self.ChangedLines())
+
+  def testModeChangeOnly(self):
+    self.Commit({'A.java': self.lines})
+    os.chmod(os.path.join(self.root, 'A.java'), 0755)
+    self.assertEqual({}, self.ChangedLines())
+    # Nothing is checked, rather than every line.
+    change = presubmit_support.BuildChange('HEAD', self.LoadConfig(),
+        changed_lines=True)
+    files = dict((f.LocalPath(), f) for f in change.AffectedFiles())
+    self.assertEqual([], files['A.java'].ChangedLineNumbers())
+    self.assertEqual([], list(files['A.java'].ChangedContents()))
+
+  def testQuotedPath(self):
+    names = ['\xc3\xa9t\xc3\xa9.java', 'a b.java', 'tab\there.java',
+        'space .java']
+    self.Commit(dict((name, self.lines[:2]) for name in names))
+    for name in names:
+      self.WriteFile(name, ''.join(self.lines[:3]))
+    self.assertEqual(dict((name, [3]) for name in names),
+        self.ChangedLines())
+
+  def testChangedContents(self):
+    self.Commit({'A.java': self.lines})
+    lines = list(self.lines)
+    lines[3] = 'changed   \n'
+    self.WriteFile('A.java', ''.join(lines))
+    change = presubmit_support.BuildChange('HEAD', self.LoadConfig(),
+        changed_lines=True)
+    f, = change.AffectedFiles(include=[r'.+\.java$'])
+    self.assertEqual([(4, 'changed')], list(f.ChangedContents()))
+
+def _SpinUntilCancelled(seconds):
+  """Loops until cancelled by a budget of seconds. Returns whether the budget
+  expired, and how long that took.
+  """
+  start_time = time.time()
+  with presubmit_support.TimeBudget(seconds) as budget:
+    while time.time() - start_time < 10:
+      try:
+        time.sleep(0.001)
+      except Exception:
+        pass
+  return budget.expired, time.time() - start_time
+
+@unittest.skipUnless(hasattr(signal, 'setitimer'), 'needs SIGALRM')
+class TimeBudgetTest(unittest.TestCase):
+  def setUp(self):
+    self.handler = signal.getsignal(signal.SIGALRM)
+
+  def tearDown(self):
+    # Nothing is left armed, and the handler is restored.
+    self.assertEqual((0.0, 0.0), signal.getitimer(signal.ITIMER_REAL))
+    self.assertEqual(self.handler, signal.getsignal(signal.SIGALRM))
+    self.assertEqual([], presubmit_support.TimeBudget._Active())
+
+  def testFinishesInTime(self):
+    with presubmit_support.TimeBudget(10) as budget:
+      value = sum(range(100))
+    self.assertFalse(budget.expired)
+    self.assertEqual(4950, value)
+
+  def testNoBudget(self):
+    with presubmit_support.TimeBudget(None) as budget:
+      time.sleep(0.01)
+    self.assertFalse(budget.expired)
+
+  def testCancels(self):
+    expired, elapsed = _SpinUntilCancelled(0.05)
+    self.assertTrue(expired)
+    self.assertLess(elapsed, 1)
+
+  def testExceptClausesDoNotSwallowIt(self):
+    with presubmit_support.TimeBudget(0.05) as budget:
+      try:
+        time.sleep(10)
+      except Exception:
+        self.fail('caught by except Exception')
+    self.assertTrue(budget.expired)
+
+  def testCancelsAgainIfCaught(self):
+    old_retry = presubmit_support.TIME_BUDGET_RETRY
+    presubmit_support.TIME_BUDGET_RETRY = 0.05
+    try:
+      caught = []
+      start_time = time.time()
+      with presubmit_support.TimeBudget(0.05) as budget:
+        try:
+          time.sleep(10)
+        except BaseException:
+          caught.append(time.time() - start_time)
+        time.sleep(10)
+    finally:
+      presubmit_support.TIME_BUDGET_RETRY = old_retry
+    self.assertTrue(budget.expired)
+    self.assertEqual(1, len(caught))
+    self.assertLess(time.time() - start_time, 1)
+
+  def testInnerBudgetExpires(self):
+    with presubmit_support.TimeBudget(10) as outer:
+      expired, _ = _SpinUntilCancelled(0.05)
+      after_inner = True
+    self.assertTrue(expired)
+    self.assertTrue(after_inner)
+    self.assertFalse(outer.expired)
+
+  def testOuterBudgetCancelsInnerCode(self):
+    reached = []
+    start_time = time.time()
+    with presubmit_support.TimeBudget(0.05) as outer:
+      with presubmit_support.TimeBudget(10) as inner:
+        time.sleep(10)
+      reached.append('after inner')
+    self.assertTrue(outer.expired)
+    self.assertFalse(inner.expired)
+    self.assertEqual([], reached)
+    self.assertLess(time.time() - start_time, 1)
+
+  def testExpiringWhileExiting(self):
+    # Budgets short enough to run out around the time the with statement
+    # exits, also from inside __exit__. Nothing may escape the with statement.
+    for i in range(20000):
+      with presubmit_support.TimeBudget(10):
+        with presubmit_support.TimeBudget((i % 50) * 0.000001):
+          sum(range(i % 20))
+
+  def testForkedWorkers(self):
+    with presubmit_support.TimeBudget(30) as outer:
+      pool = multiprocessing.Pool(2)
+      try:
+        # The workers do not inherit the budget of the parent, and enforce
+        # their own.
+        results = pool.map(_SpinUntilCancelled, [0.05, 0.1, 0.05])
+      finally:
+        pool.close()
+        pool.join()
+    self.assertFalse(outer.expired)
+    for expired, elapsed in results:
+      self.assertTrue(expired)
+      self.assertLess(elapsed, 1)
+
+def _ExitIfOdd(value):
+  if value % 2:
+    os._exit(1)
+  return value
+
+class WaitForPoolResultsTest(unittest.TestCase):
+  def _Wait(self, values):
+    pool = multiprocessing.Pool(2)
+    try:
+      return list(presubmit_support.WaitForPoolResults(pool,
+          pool.imap(_ExitIfOdd, values), 0.05))
+    finally:
+      pool.terminate()
+      pool.join()
+
+  def testResults(self):
+    self.assertEqual([0, 2, 4], self._Wait([0, 2, 4]))
+
+  def testWorkerDied(self):
+    # The task the worker died in is lost, waiting for it must not hang.
+    self.assertRaises(presubmit_support.PresubmitFailure, self._Wait,
+        [0, 1, 2])
+
+if __name__ == '__main__':
+  unittest.main()